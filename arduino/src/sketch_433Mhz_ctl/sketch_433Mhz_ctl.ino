@@ -5,11 +5,27 @@ RCSwitch outputLine = RCSwitch();
 
 #define PROTOCOL_HEADER "CLS" // (C)LUSTER (L)IGHT (S)WITCH
 #define PROTOCOL_VERSION '0'
+#define PROTOCOL_VERSION_FRAMED '1'
+
+// Protocol v1 frames need no handshake once "CLS1" has been acknowledged:
+// <FRAME_START><1-byte: sequence><1-byte: instruction><1-byte: length>
+// <#-bytes: payload><1-byte: CRC-8 of everything after FRAME_START>
+// Each frame is answered with a frame carrying the same sequence number.
+#define FRAME_START       '~'
+#define MAX_FRAME_PAYLOAD 16
+#define MAX_MESSAGE       4 // bytes, as messages are sent as an unsigned long
 
 // input messages
 #define READ_433  '1' // <2-byte: message_num><2-byte: radio_timeout>
+                      // (0 for no limit); any byte received while waiting
+                      // ends the read, and is consumed if it is STOP_READ
 #define WRITE_433 '2' // <2-byte: protocol><2-byte: delay><2-byte: repetitions>
                       // <2-byte: byte-length><#-bytes: message>
+#define WRITE_433_BATCH '3' // <2-byte: message_num>, then per message after
+                            // each AWAITING_DATA: <WRITE_433 payload>
+#define STOP_READ '4'
+#define PING      '?' // needs no handshake; answered with HELLO once the
+                      // device is ready
 
 // output messages
 #define AWAITING_DATA    'B'
@@ -20,6 +36,7 @@ RCSwitch outputLine = RCSwitch();
 #define BAD_HEADER       'G'
 #define WRONG_VERSION    'H'
 #define HEARTBEAT        'I'
+#define BAD_FRAME        'J'
 #define UNKNOWN_OP_CODE  'Z'
 
 #define RADIO_POLL_RATE  10 // milliseconds
@@ -43,19 +60,20 @@ void setup() {
     }
 }
 
-unsigned int readShort(){
-    unsigned int val = 0x00;
-    byte buffer[2];
-    Serial.readBytes(buffer, 2);
-    val = buffer[1];
+unsigned int toShort(const byte *buffer){
+    unsigned int val = buffer[1];
     val <<= 8;
     val |= buffer[0];
     return val;
 }
 
-unsigned long readMessage(int byteLength){
-    byte buffer[byteLength];
-    Serial.readBytes(buffer, byteLength);
+unsigned int readShort(){
+    byte buffer[2];
+    Serial.readBytes(buffer, 2);
+    return toShort(buffer);
+}
+
+unsigned long toLong(const byte *buffer, int byteLength){
     unsigned long val = buffer[byteLength - 1];
     for (int i = 1; i < byteLength; i++){
         val <<= 8;
@@ -65,6 +83,22 @@ unsigned long readMessage(int byteLength){
     return val;
 }
 
+unsigned long readMessage(int byteLength){
+    byte buffer[byteLength];
+    Serial.readBytes(buffer, byteLength);
+    return toLong(buffer, byteLength);
+}
+
+bool readInterrupted(){
+    if (Serial.available() == 0){
+        return false;
+    }
+    if (Serial.peek() == STOP_READ){
+        Serial.read();
+    }
+    return true;
+}
+
 char readChar(){
     return (char) readMessage(1);
 }
@@ -75,12 +109,104 @@ void writeShort(unsigned int val){
     Serial.write(val & 0xFF);
 }
 
+void transmit(){
+    unsigned int messageLength;
+    unsigned long message;
+
+    // Read and set the sending parameters.
+    outputLine.setProtocol(readShort());
+    outputLine.setPulseLength(readShort());
+    outputLine.setRepeatTransmit(readShort());
+
+    // Read the message payload.
+    messageLength = readShort();
+    message = readMessage(messageLength);
+    outputLine.send(message, messageLength * 8);
+}
+
+byte crc8(const byte *data, int length, byte crc){
+    for (int i = 0; i < length; i++){
+        crc ^= data[i];
+        for (int j = 0; j < 8; j++){
+            crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+        }
+    }
+    return crc;
+}
+
+void writeFrame(byte sequence, byte response){
+    byte fields[3] = {sequence, response, 0};
+    Serial.write(FRAME_START);
+    Serial.write(fields, 3);
+    Serial.write(crc8(fields, 3, 0));
+}
+
+void handleFrame(){
+    byte fields[3]; // sequence, instruction, payload length
+    byte payload[MAX_FRAME_PAYLOAD];
+    byte checksum;
+
+    if (Serial.readBytes(fields, 3) < 3){
+        return;
+    }
+    if (fields[2] > MAX_FRAME_PAYLOAD){
+        // Skip the payload and CRC, so that they are not taken for frames.
+        for (int i = 0; i <= fields[2]; i++){
+            if (Serial.readBytes(&checksum, 1) < 1){
+                return;
+            }
+        }
+        writeFrame(fields[0], BAD_FRAME);
+        return;
+    }
+    if (Serial.readBytes(payload, fields[2]) < fields[2]
+            || Serial.readBytes(&checksum, 1) < 1){
+        return;
+    }
+    if (crc8(payload, fields[2], crc8(fields, 3, 0)) != checksum){
+        writeFrame(fields[0], BAD_FRAME);
+        return;
+    }
+
+    switch (fields[1]) {
+        case WRITE_433:
+            // The payload is the same as that of a protocol v0 WRITE_433.
+            if (fields[2] < 9 || fields[2] != 8 + toShort(payload + 6)
+                    || fields[2] > 8 + MAX_MESSAGE){
+                writeFrame(fields[0], BAD_FRAME);
+                return;
+            }
+            outputLine.setProtocol(toShort(payload));
+            outputLine.setPulseLength(toShort(payload + 2));
+            outputLine.setRepeatTransmit(toShort(payload + 4));
+            outputLine.send(toLong(payload + 8, fields[2] - 8),
+                            (fields[2] - 8) * 8);
+            writeFrame(fields[0], GOODBYE);
+            break;
+
+        default:
+            writeFrame(fields[0], UNKNOWN_OP_CODE);
+    }
+}
+
 void loop() {
 
     if (Serial.available() == 0) {
         return;
     }
 
+    if (Serial.peek() == FRAME_START) {
+        Serial.read();
+        handleFrame();
+        return;
+    }
+
+    if (Serial.peek() == PING) {
+        Serial.read();
+        Serial.write(HELLO);
+        return;
+    }
+
     // Get the protocol indicator signal
     char receivedHeader[4];
     receivedHeader[3] = '\0';
@@ -93,6 +219,13 @@ void loop() {
 
     char receivedVersion = readChar();
 
+    if (receivedVersion == PROTOCOL_VERSION_FRAMED) {
+        // Only negotiates the version; frames follow with no further
+        // handshakes.
+        Serial.write(HELLO);
+        return;
+    }
+
     if (receivedVersion != PROTOCOL_VERSION) {
         Serial.write(WRONG_VERSION);
         return;
@@ -105,8 +238,9 @@ void loop() {
     char inst = readChar();
 
     // Instruction variables.
-    int messageNum, radioTimeout, timeoutCount;
+    unsigned int messageNum, radioTimeout, waited, polls;
     unsigned int repetitions, messageLength;
+    bool stopped = false;
     unsigned long message;
 
     switch (inst) {
@@ -117,22 +251,32 @@ void loop() {
             messageNum = readShort();
             radioTimeout = readShort(); // milliseconds
 
-            for (int i = 0; i < messageNum; i++){
+            for (unsigned int i = 0; messageNum == 0 || i < messageNum; i++){
 
-                timeoutCount = radioTimeout;
+                waited = 0;
+                polls = 0;
 
                 // Wait for the radio to pick something up.
                 while (!inputLine.available()) {
-                    if (timeoutCount <= 0){
+                    if (readInterrupted()){
+                        stopped = true;
+                        break;
+                    }
+                    if (radioTimeout > 0 && waited >= radioTimeout){
                         Serial.write(RADIO_TIMEOUT);
                         return;
                     }
                     delay(RADIO_POLL_RATE);
-                    timeoutCount -= RADIO_POLL_RATE;
-                    if (timeoutCount % 100 == 0) {
+                    if (radioTimeout > 0){
+                        waited += RADIO_POLL_RATE;
+                    }
+                    if (++polls % (100 / RADIO_POLL_RATE) == 0) {
                         Serial.write(HEARTBEAT);
                     }
                 }
+                if (stopped){
+                    break;
+                }
                 Serial.write(INCOMING_DATA);
 
                 writeShort(inputLine.getReceivedProtocol());
@@ -156,16 +300,22 @@ void loop() {
         case WRITE_433:
 
             Serial.write(AWAITING_DATA);
+            transmit();
 
-            // Read and set the sending parameters.
-            outputLine.setProtocol(readShort());
-            outputLine.setPulseLength(readShort());
-            outputLine.setRepeatTransmit(readShort());
+            break;
+
+        case WRITE_433_BATCH:
+
+            Serial.write(AWAITING_DATA);
 
-            // Read the message payload.
-            messageLength = readShort();
-            message = readMessage(messageLength);
-            outputLine.send(message, messageLength * 8);
+            messageNum = readShort();
+
+            for (int i = 0; i < messageNum; i++){
+                // Request each message only once the previous one has been
+                // sent so the receive buffer never overflows.
+                Serial.write(AWAITING_DATA);
+                transmit();
+            }
 
             break;
 
@@ -1,3 +1,6 @@
+from ..plugins import ADAPTERS, load, NoSuchPluginError
+
+
 class Adapter(object):
     """
     An adapter to be used by the driver for
@@ -11,9 +14,12 @@ class Adapter(object):
         """
         raise NotImplementedError
 
-    def reset(self):
+    def reset(self, wait=True):
         """
         Performs a reset function on the external device.
+
+        :param wait: whether to wait out the device's worst-case boot time
+                     (callers able to probe for readiness need not)
         """
         raise NotImplementedError
 
@@ -30,6 +36,22 @@ class Adapter(object):
         """
         raise NotImplementedError
 
+    def read_available(self, size=1):
+        """
+        Read at least `size` bytes (or until timeout) from the underlying
+        communication stream, plus whatever else is already buffered.
+
+        Adapters that cannot tell what is buffered only read `size` bytes.
+        """
+        return self.read(size)
+
+    def set_timeout(self, timeout):
+        """
+        Sets how long reads wait for data, in seconds (None restores the
+        default). Adapters unable to change it may ignore this.
+        """
+        pass
+
     def write(self, *args, **kwargs):
         """
         Write to the underlying communication stream.
@@ -47,9 +69,38 @@ class NoSuchAdapterException(Exception):
     pass
 
 
+def parse_adapter_args(adapter_args):
+    """
+    Parses comma separated name-value adapter arguments (e.g. "x=1,y=2").
+
+    :returns: dict of keyword arguments for the adapter's constructor
+    """
+    return dict(pair.split('=', 1) for pair in adapter_args.split(',') if pair)
+
+
+def parse_device_specs(devices):
+    """
+    Parses semicolon separated device specifications of the form
+    "name=adapter[:x=1,y=2,...]".
+
+    :returns: list of (name, adapter name, adapter kwargs)
+    """
+    specs = []
+    for spec in devices.split(';'):
+        if not spec:
+            continue
+        name, _, adapter = spec.partition('=')
+        adapter, _, adapter_args = adapter.partition(':')
+        specs.append((name, adapter, parse_adapter_args(adapter_args)))
+    return specs
+
+
 def get_adapter(name):
-    if name.lower() == 'rpi':
-        from .rpi import RPiAdapter
-        return RPiAdapter
-    else:
+    """
+    Imports an adapter class by name: "rpi", "sim", or one provided by
+    another package through a `lights_433.adapters` entry point.
+    """
+    try:
+        return load(ADAPTERS, name.lower())
+    except NoSuchPluginError:
         raise NoSuchAdapterException(name)
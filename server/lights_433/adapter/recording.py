@@ -0,0 +1,345 @@
+from collections import namedtuple
+import codecs
+import logging
+import struct
+from threading import Lock
+import time
+
+from . import Adapter, get_adapter
+
+import clip
+
+log = logging.getLogger(__name__)
+
+# Recordings start with a magic number and version, followed by a record per
+# adapter call:
+#
+#   <kind><microseconds since the previous record><length><data>
+#
+# Times are clamped so that they never run backwards, even if the wall clock
+# is stepped, and idle periods longer than ~71 minutes are shortened.
+_MAGIC = b'L433REC1'
+_RECORD = struct.Struct('<BIH')  # kind, delay, data length
+_MAX_DELAY = 0xFFFFFFFF  # microseconds
+_MAX_DATA = 0xFFFF
+_TIMEOUT = struct.Struct('<d')
+
+# Record kinds; data is what was written, what was read (empty if the read
+# timed out), or the new read timeout (empty for the default).
+INITIALIZE = 1
+RESET = 2
+CLOSE = 3
+WRITE = 4
+FLUSH = 5
+READ = 6
+SET_TIMEOUT = 7
+
+_KIND_NAMES = {
+    INITIALIZE: 'initialize',
+    RESET: 'reset',
+    CLOSE: 'close',
+    WRITE: 'write',
+    FLUSH: 'flush',
+    READ: 'read',
+    SET_TIMEOUT: 'set_timeout',
+}
+
+Record = namedtuple('Record', ['kind', 'time', 'data'])
+
+
+class BadRecordingError(Exception):
+    pass
+
+
+def read_recording(path):
+    """
+    Reads the records of a recording, ignoring a final record cut short
+    (i.e. by a crash while it was written).
+
+    :returns: generator of `Record`, timed in seconds from the first
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise BadRecordingError("[%s] is not a recording" % path)
+        elapsed = 0
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            kind, delay, length = _RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            elapsed += delay
+            yield Record(kind, elapsed / 1e6, data)
+
+
+class RecordingAdapter(Adapter):
+
+    def __init__(self, path, adapter, **adapter_args):
+        """
+        Wraps an adapter, appending every call made through it (and the data
+        read and written) to a recording that can be inspected with
+        lights433-dump or played back with `ReplayAdapter`.
+
+        :param path: the file to append the recording to
+        :param adapter: the name of the adapter to wrap
+        :param adapter_args: the arguments of the wrapped adapter
+        """
+        self.adapter = get_adapter(adapter)(**adapter_args)
+        self.path = path
+        self._lock = Lock()
+        # Unbuffered, so that a crash loses at most the record being written.
+        self._file = open(path, 'ab', 0)
+        if self._file.tell() == 0:
+            self._file.write(_MAGIC)
+        self._last = None
+
+    def _record(self, kind, data=b'', started=None):
+        with self._lock:
+            now = time.time() if started is None else started
+            if self._last is None:
+                delay = 0
+            else:
+                delay = min(max(int((now - self._last) * 1e6), 0),
+                            _MAX_DELAY)
+            self._last = max(now, self._last or now)
+            for i in range(0, max(len(data), 1), _MAX_DATA):
+                chunk = data[i:i + _MAX_DATA]
+                self._file.write(_RECORD.pack(kind, delay, len(chunk)) +
+                                 chunk)
+                delay = 0
+
+    # The host's calls are timed from when they were made, and reads from
+    # when they returned, so that time spent blocked on the device (i.e.
+    # flushing, or waiting out a reset) counts towards its response times.
+
+    def initialize(self):
+        started = time.time()
+        self.adapter.initialize()
+        self._record(INITIALIZE, started=started)
+
+    def reset(self, wait=True):
+        started = time.time()
+        self.adapter.reset(wait)
+        self._record(RESET, started=started)
+
+    def close(self):
+        started = time.time()
+        self.adapter.close()
+        self._record(CLOSE, started=started)
+        self._file.close()
+
+    def read(self, size=1):
+        data = self.adapter.read(size)
+        self._record(READ, data)
+        return data
+
+    def read_available(self, size=1):
+        data = self.adapter.read_available(size)
+        self._record(READ, data)
+        return data
+
+    def set_timeout(self, timeout):
+        started = time.time()
+        self.adapter.set_timeout(timeout)
+        self._record(SET_TIMEOUT,
+                     b'' if timeout is None else _TIMEOUT.pack(timeout),
+                     started)
+
+    def write(self, data):
+        started = time.time()
+        result = self.adapter.write(data)
+        self._record(WRITE, bytes(data), started)
+        return result
+
+    def flush(self):
+        started = time.time()
+        self.adapter.flush()
+        self._record(FLUSH, started=started)
+
+    def __getattr__(self, name):
+        # Anything else particular to the wrapped adapter (i.e. injecting
+        # signals into a simulated one).
+        if name == 'adapter':
+            raise AttributeError(name)
+        return getattr(self.adapter, name)
+
+
+class ReplayAdapter(Adapter):
+
+    def __init__(self, path, speed=1.0):
+        """
+        Plays a recording back to the driver in place of a device.
+
+        What the device sent is served as a stream, so the driver may read
+        it in different chunks than were recorded. Each chunk becomes
+        readable as long after the host's preceding call (i.e. the write it
+        answers) as it was in the recording, so the device's response times
+        are reproduced while the driver's own are measured afresh. Calls
+        that differ from the recording (i.e. by a driver whose behaviour has
+        changed) are logged and counted as divergences.
+
+        :param path: the recording to play back
+        :param speed: how many times faster than recorded to play back (0
+                      for as fast as possible)
+        :type speed: float
+        """
+        self.path = path
+        self.speed = float(speed)
+        self.divergences = 0
+        self._records = list(read_recording(path))
+        self._position = 0
+        self._buffered = b''
+        self._expected_write = b''
+        self._anchor = (0.0, time.time())  # recorded time, replay time
+        self._lock = Lock()
+
+    def _next(self):
+        if self._position < len(self._records):
+            return self._records[self._position]
+        return None
+
+    def _diverged(self, message):
+        self.divergences += 1
+        log.warning("Replay of [%s] diverged at record %d: %s"
+                    % (self.path, self._position, message))
+
+    def _host(self, kind, data=b''):
+        """
+        Plays back a call made by the host, re-anchoring the timing of
+        whatever the device sends next.
+        """
+        # Anything the device sent that the driver has not read stays
+        # buffered, as it would in the serial port.
+        record = self._next()
+        while record is not None and record.kind == READ:
+            self._buffered += record.data
+            self._position += 1
+            record = self._next()
+
+        if kind == WRITE:
+            expected = self._expected_write
+            while len(expected) < len(data) and record is not None and \
+                    record.kind == WRITE:
+                expected += record.data
+                self._position += 1
+                self._anchor = (record.time, time.time())
+                record = self._next()
+            if expected[:len(data)] != data:
+                self._diverged("wrote %r where %r was recorded"
+                               % (data, expected[:len(data)]))
+            self._expected_write = expected[len(data):]
+            return
+
+        if record is None or record.kind != kind:
+            self._diverged("%s where %s was recorded" % (
+                _KIND_NAMES[kind],
+                _KIND_NAMES[record.kind] if record else 'the end'))
+            return
+        self._position += 1
+        self._anchor = (record.time, time.time())
+
+    def _wait_for(self, record):
+        if self.speed <= 0:
+            return
+        recorded, replayed = self._anchor
+        delay = replayed + (record.time - recorded) / self.speed - \
+            time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _read(self, size, available):
+        with self._lock:
+            while len(self._buffered) < size:
+                record = self._next()
+                if record is None or record.kind != READ:
+                    break  # The device sent nothing more before the host
+                self._wait_for(record)
+                self._position += 1
+                if not record.data:
+                    break  # The read timed out
+                self._buffered += record.data
+            if available:
+                # Plus whatever else had arrived by now.
+                record = self._next()
+                while record is not None and record.kind == READ and \
+                        record.data and (self.speed <= 0 or
+                                         self._anchor[1] + (
+                                             record.time -
+                                             self._anchor[0]) /
+                                         self.speed <= time.time()):
+                    self._buffered += record.data
+                    self._position += 1
+                    record = self._next()
+                size = max(size, len(self._buffered))
+            data, self._buffered = self._buffered[:size], \
+                self._buffered[size:]
+            return data
+
+    def initialize(self):
+        with self._lock:
+            self._host(INITIALIZE)
+
+    def reset(self, wait=True):
+        with self._lock:
+            self._buffered = b''
+            self._host(RESET)
+
+    def close(self):
+        with self._lock:
+            self._host(CLOSE)
+
+    def read(self, size=1):
+        return self._read(size, False)
+
+    def read_available(self, size=1):
+        return self._read(size, True)
+
+    def set_timeout(self, timeout):
+        with self._lock:
+            self._host(SET_TIMEOUT)
+
+    def write(self, data):
+        with self._lock:
+            self._host(WRITE, bytes(data))
+
+    def flush(self):
+        with self._lock:
+            self._host(FLUSH)
+
+
+app = clip.App()
+
+
+@app.main(description='Prints a recording made with the "record" adapter')
+@clip.arg('path', required=True, type=str, help='The recording to print')
+def dump(path):
+    try:
+        for record in read_recording(path):
+            if record.kind == SET_TIMEOUT:
+                detail = '%gs' % _TIMEOUT.unpack(record.data)[0] \
+                    if record.data else 'default'
+            elif record.kind == READ and not record.data:
+                detail = '(timed out)'
+            else:
+                detail = codecs.encode(record.data, 'hex')
+                if record.data.isalnum():
+                    detail += '  %r' % record.data
+            clip.echo('%12.6f  %-11s %s' % (record.time,
+                                            _KIND_NAMES.get(record.kind,
+                                                            record.kind),
+                                            detail))
+    except (IOError, BadRecordingError) as e:
+        clip.exit("Failed to read the recording: %s" % e, err=True)
+
+
+def main():
+    try:
+        app.run()
+    except clip.ClipExit:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -7,22 +7,30 @@ import RPi.GPIO as GPIO
 
 
 SERIAL_HANDLE_FILE = "/dev/ttyAMA0"
+SERIAL_TIMEOUT = 1  # seconds
 
 
 class RPiAdapter(Adapter):
 
-    def __init__(self, reset_pin):
+    def __init__(self, reset_pin, serial_file=SERIAL_HANDLE_FILE,
+                 reset_hold=1):
         """
         Initializes a serial port connection from a Raspberry Pi.
 
         :param reset_pin: Pin that the reset port of the external device
                            is connected to.
+        :param serial_file: Serial device the external device is connected
+                            to (e.g. /dev/ttyUSB0 for a USB adapter).
+        :param reset_hold: Seconds the reset pin is held low for (long
+                           enough by default to ensure the device resets).
         """
         self._gpio_ready = False
         if isinstance(reset_pin, basestring):
             self._reset_pin = int(reset_pin)
         else:
             self._reset_pin = reset_pin
+        self._serial_file = serial_file
+        self._reset_hold = float(reset_hold)
         self._serial_connection = None
 
     def _assert_ready(self):
@@ -33,7 +41,7 @@ class RPiAdapter(Adapter):
 
     def _reset_serial_connection(self):
         self._serial_connection = serial.Serial(
-            SERIAL_HANDLE_FILE, 9600, timeout=1)
+            self._serial_file, 9600, timeout=SERIAL_TIMEOUT)
         self._serial_connection.reset_input_buffer()
 
     def _set_gpio(self):
@@ -51,7 +59,7 @@ class RPiAdapter(Adapter):
             self._set_gpio()
             self._reset_serial_connection()
 
-    def reset(self):
+    def reset(self, wait=True):
 
         self._assert_ready()
 
@@ -60,9 +68,10 @@ class RPiAdapter(Adapter):
         self._set_gpio()
 
         GPIO.output(self._reset_pin, GPIO.LOW)
-        time.sleep(1)  # Long delay to ensure device has reset.
+        time.sleep(self._reset_hold)
         GPIO.output(self._reset_pin, GPIO.HIGH)
-        time.sleep(2)  # Device reboot waiting period.
+        if wait:
+            time.sleep(2)  # Device reboot waiting period.
 
         self._serial_connection.reset_input_buffer()
 
@@ -77,6 +86,16 @@ class RPiAdapter(Adapter):
         self._assert_ready()
         return self._serial_connection.read(*args, **kwargs)
 
+    def read_available(self, size=1):
+        self._assert_ready()
+        return self._serial_connection.read(
+            max(size, self._serial_connection.in_waiting))
+
+    def set_timeout(self, timeout):
+        self._assert_ready()
+        self._serial_connection.timeout = SERIAL_TIMEOUT \
+            if timeout is None else timeout
+
     def write(self, *args, **kwargs):
         self._assert_ready()
         return self._serial_connection.write(*args, **kwargs)
@@ -0,0 +1,568 @@
+from . import Adapter
+from ..driver import airtime
+
+from collections import deque
+import random
+import threading
+import time
+
+
+# Protocol constants, mirrored from sketch_433Mhz_ctl.ino (not imported from
+# the driver so that disagreements between the two surface as errors).
+PROTOCOL_HEADER = b'CLS'
+PROTOCOL_VERSION = b'0'
+PROTOCOL_VERSION_FRAMED = b'1'
+FRAME_START = b'~'
+MAX_FRAME_PAYLOAD = 16
+MAX_MESSAGE = 4
+
+READ_433 = b'1'
+WRITE_433 = b'2'
+WRITE_433_BATCH = b'3'
+STOP_READ = b'4'
+PING = b'?'
+
+AWAITING_DATA = b'B'
+INCOMING_DATA = b'C'
+RADIO_TIMEOUT = b'D'
+HELLO = b'E'
+GOODBYE = b'F'
+BAD_HEADER = b'G'
+WRONG_VERSION = b'H'
+HEARTBEAT = b'I'
+BAD_FRAME = b'J'
+UNKNOWN_OP_CODE = b'Z'
+
+RADIO_POLL_RATE = 10  # milliseconds
+SERIAL_TIMEOUT = 1.0  # seconds (Serial.setTimeout(1000))
+RX_BUFFER_SIZE = 64  # bytes (Arduino hardware serial receive buffer)
+
+_POLL_INTERVAL = 0.001  # seconds
+
+
+def _coerce(value, to_type):
+    if isinstance(value, basestring):
+        if to_type is bool:
+            return value.lower() in ('1', 'true', 'yes', 'on')
+        return to_type(value)
+    return value
+
+
+def _int16(value):
+    """
+    Interprets an unsigned short as the signed 16-bit `int` of an AVR.
+    """
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def crc8(data, crc=0):
+    for byte in bytearray(data):
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xFF
+    return crc
+
+
+class Reboot(Exception):
+    """
+    Raised inside the firmware thread to abandon the current loop() when the
+    simulated device is reset or closed.
+    """
+    pass
+
+
+class SerialLine(object):
+    """
+    One direction of a simulated UART. Bytes written become readable one at
+    a time, each after a single character time at the configured baud rate.
+    """
+
+    def __init__(self, baud, capacity=None, deaf_for=0.0):
+        # 10 bits per character (start + 8 data + stop).
+        self._byte_time = 10.0 / baud if baud else 0.0
+        self._capacity = capacity
+        # Bytes arriving before this time are lost (i.e. the device is still
+        # booting).
+        self._deaf_until = time.time() + deaf_for
+        self._cond = threading.Condition()
+        self._in_flight = deque()
+        self._buffer = bytearray()
+        self._last_arrival = 0.0
+        self.dropped = 0
+
+    def _deliver(self, now):
+        while self._in_flight and self._in_flight[0][0] <= now:
+            arrival, byte = self._in_flight.popleft()
+            if arrival < self._deaf_until:
+                continue
+            if self._capacity is not None and \
+                    len(self._buffer) >= self._capacity:
+                self.dropped += 1
+            else:
+                self._buffer.append(byte)
+
+    def put(self, data):
+        with self._cond:
+            arrival = max(time.time(), self._last_arrival)
+            for byte in bytearray(data):
+                arrival += self._byte_time
+                self._in_flight.append((arrival, byte))
+            self._last_arrival = arrival
+            self._cond.notify_all()
+
+    def drain_time(self):
+        """
+        :returns: seconds until every byte written so far has arrived
+        """
+        with self._cond:
+            return max(self._last_arrival - time.time(), 0.0)
+
+    def available(self):
+        with self._cond:
+            self._deliver(time.time())
+            return len(self._buffer)
+
+    def peek(self):
+        with self._cond:
+            self._deliver(time.time())
+            return bytes(self._buffer[:1])
+
+    def _sleep(self, seconds):
+        # Timed condition waits poll coarsely on Python 2, so sleep outside
+        # the lock instead to keep simulated latencies accurate.
+        self._cond.release()
+        try:
+            time.sleep(max(seconds, 0))
+        finally:
+            self._cond.acquire()
+
+    def interrupt(self):
+        """
+        Wakes up any thread blocked in `wait`.
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, interrupted):
+        """
+        Blocks until at least one byte is available to read.
+
+        :param interrupted: `threading.Event` that aborts the wait (set it,
+                            then call `interrupt`)
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                self._deliver(now)
+                if self._buffer:
+                    return
+                if interrupted.is_set():
+                    raise Reboot()
+                if self._in_flight:
+                    self._sleep(self._in_flight[0][0] - now)
+                else:
+                    self._cond.wait()
+
+    def read(self, size, timeout, interrupted=None):
+        """
+        Reads up to `size` bytes, blocking until all of them have arrived or
+        the timeout elapses (pyserial/Arduino `readBytes` semantics).
+
+        :param interrupted: optional `threading.Event` that aborts the wait
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                self._deliver(now)
+                if len(self._buffer) >= size:
+                    break
+                if interrupted is not None and interrupted.is_set():
+                    raise Reboot()
+                if deadline is not None and now >= deadline:
+                    break
+                needed = size - len(self._buffer)
+                if len(self._in_flight) >= needed:
+                    wait = self._in_flight[needed - 1][0] - now
+                elif self._in_flight:
+                    wait = self._in_flight[-1][0] - now
+                else:
+                    wait = _POLL_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - now)
+                self._sleep(wait)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+    def clear(self):
+        with self._cond:
+            self._in_flight.clear()
+            self._buffer = bytearray()
+            self._last_arrival = 0.0
+
+
+class SimulatedFirmware(threading.Thread):
+    """
+    A line-by-line emulation of `sketch_433Mhz_ctl.ino` running on a daemon
+    thread against a pair of `SerialLine`s.
+    """
+
+    def __init__(self, adapter, boot_time):
+        super(SimulatedFirmware, self).__init__(name='lights433-sim-firmware')
+        self.daemon = True
+        self.adapter = adapter
+        self.halted = threading.Event()
+        self.wedged = False
+        self._boot_time = boot_time
+
+    # -- Arduino primitives --------------------------------------------------
+
+    def _delay(self, ms):
+        end = time.time() + ms / 1000.0
+        while True:
+            if self.halted.is_set():
+                raise Reboot()
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.05))
+
+    def _read_bytes(self, n, pad=True):
+        data = self.adapter.rx.read(n, SERIAL_TIMEOUT, self.halted)
+        if not pad:
+            return data
+        # Unfilled buffer positions hold whatever was on the stack; zero is as
+        # good a guess as any.
+        return data + b'\x00' * (n - len(data))
+
+    def _read_short(self):
+        buf = bytearray(self._read_bytes(2))
+        return buf[0] | (buf[1] << 8)
+
+    def _read_message(self, byte_length):
+        buf = bytearray(self._read_bytes(byte_length))
+        val = 0
+        for byte in reversed(buf):
+            val = ((val << 8) | byte) & 0xFFFFFFFF
+        return val
+
+    def _read_interrupted(self):
+        if not self.adapter.rx.available():
+            return False
+        if self.adapter.rx.peek() == STOP_READ:
+            self._read_bytes(1)
+        return True
+
+    def _write(self, data):
+        self.adapter.tx_from_device(data)
+
+    def _write_short(self, val):
+        self._write(bytes(bytearray([val & 0xFF, (val >> 8) & 0xFF])))
+
+    # -- Sketch --------------------------------------------------------------
+
+    def run(self):
+        try:
+            self._delay(self._boot_time * 1000)
+            while True:
+                self.loop()
+        except Reboot:
+            pass
+
+    def write_frame(self, sequence, response):
+        fields = bytearray([sequence, ord(response), 0])
+        self._write(FRAME_START + bytes(fields) +
+                    bytes(bytearray([crc8(fields)])))
+
+    def handle_frame(self):
+        fields = bytearray(self._read_bytes(3, pad=False))
+        if len(fields) < 3:
+            return
+        sequence, inst, length = fields
+        payload = bytearray(self._read_bytes(length, pad=False))
+        checksum = bytearray(self._read_bytes(1, pad=False))
+        if len(payload) < length or not checksum:
+            return
+        if length > MAX_FRAME_PAYLOAD:
+            # Read (and dropped) all the same, so as to stay in sync.
+            self.write_frame(sequence, BAD_FRAME)
+            return
+        if crc8(fields + payload) != checksum[0]:
+            self.write_frame(sequence, BAD_FRAME)
+            return
+
+        if self.adapter.roll_fault('hang'):
+            self.wedged = True
+            return
+
+        if inst == ord(WRITE_433):
+            shorts = [payload[i] | (payload[i + 1] << 8)
+                      for i in range(0, min(length, 8) - 1, 2)]
+            if length < 9 or length != 8 + shorts[3] or \
+                    shorts[3] > MAX_MESSAGE:
+                self.write_frame(sequence, BAD_FRAME)
+                return
+            message = 0
+            for byte in reversed(payload[8:]):
+                message = ((message << 8) | byte) & 0xFFFFFFFF
+            self.adapter.transmit(shorts[0], shorts[1], shorts[2], message,
+                                  (length - 8) * 8)
+            self.write_frame(sequence, GOODBYE)
+        else:
+            self.write_frame(sequence, UNKNOWN_OP_CODE)
+
+    def transmit(self):
+        protocol = self._read_short()
+        pulse_length = self._read_short()
+        repetitions = self._read_short()
+        message_length = self._read_short()
+        message = self._read_message(message_length)
+        self.adapter.transmit(protocol, pulse_length, repetitions,
+                              message, message_length * 8)
+
+    def loop(self):
+        if self.wedged:
+            self._delay(50)
+            return
+        self.adapter.rx.wait(self.halted)
+
+        if self.adapter.framing and self.adapter.rx.peek() == FRAME_START:
+            self._read_bytes(1)
+            self.handle_frame()
+            return
+
+        if self.adapter.framing and self.adapter.rx.peek() == PING:
+            self._read_bytes(1)
+            self._write(HELLO)
+            return
+
+        if self._read_bytes(3) != PROTOCOL_HEADER:
+            self._write(BAD_HEADER)
+            return
+
+        version = self._read_bytes(1)
+
+        if self.adapter.framing and version == PROTOCOL_VERSION_FRAMED:
+            self._write(HELLO)
+            return
+
+        if version != PROTOCOL_VERSION:
+            self._write(WRONG_VERSION)
+            return
+
+        if self.adapter.roll_fault('hang'):
+            self.wedged = True
+            return
+
+        self._write(HELLO)
+        inst = self._read_bytes(1)
+
+        if inst == READ_433:
+            self._write(AWAITING_DATA)
+            message_num = self._read_short()
+            radio_timeout = self._read_short()
+            received = 0
+            while message_num == 0 or received < message_num:
+                received += 1
+                waited = polls = 0
+                stopped = False
+                while not self.adapter.radio:
+                    if self._read_interrupted():
+                        stopped = True
+                        break
+                    if radio_timeout > 0 and waited >= radio_timeout:
+                        self._write(RADIO_TIMEOUT)
+                        return
+                    self._delay(RADIO_POLL_RATE)
+                    if radio_timeout > 0:
+                        waited += RADIO_POLL_RATE
+                    polls += 1
+                    if polls % (100 // RADIO_POLL_RATE) == 0:
+                        self._write(HEARTBEAT)
+                if stopped:
+                    break
+                protocol, pulse_length, bit_length, value = \
+                    self.adapter.radio.popleft()
+                self._write(INCOMING_DATA)
+                self._write_short(protocol)
+                self._write_short(pulse_length)
+                message_length = bit_length // 8 + \
+                    (1 if bit_length % 8 else 0)
+                self._write_short(message_length)
+                for _ in range(message_length):
+                    self._write(bytes(bytearray([value & 0xFF])))
+                    value >>= 8
+
+        elif inst == WRITE_433:
+            self._write(AWAITING_DATA)
+            self.transmit()
+
+        elif inst == WRITE_433_BATCH:
+            self._write(AWAITING_DATA)
+            message_num = _int16(self._read_short())
+            for _ in range(message_num):
+                self._write(AWAITING_DATA)
+                self.transmit()
+
+        else:
+            self._write(UNKNOWN_OP_CODE)
+
+        self._write(GOODBYE)
+
+
+class SimulatedAdapter(Adapter):
+
+    def __init__(self, baud=9600, timeout=1.0, boot_time=1.7,
+                 reset_hold=1.0, reset_wait=2.0, drop_rate=0.0,
+                 corrupt_rate=0.0, hang_rate=0.0, airtime=True, seed=None,
+                 protocol_version=1):
+        """
+        Emulates the Arduino firmware in-process so that the driver and
+        server can be exercised without any hardware attached. All arguments
+        may be given as strings (i.e. from `--adapter-args`).
+
+        :param baud: serial baud rate used to delay each byte (0 disables)
+        :param timeout: host-side read timeout in seconds
+        :param boot_time: seconds after a reset before the firmware listens
+        :param reset_hold: seconds the reset line is held low
+        :param reset_wait: seconds waited after releasing the reset line
+        :param drop_rate: probability of dropping each byte on the line
+        :param corrupt_rate: probability of corrupting each byte on the line
+        :param hang_rate: probability of the firmware wedging after a
+                          handshake until it is reset
+        :param airtime: whether transmissions take their real airtime
+        :param seed: seed for the fault injection random number generator
+        :param protocol_version: newest protocol version the firmware speaks
+                                 (0 emulates firmware predating frames)
+        """
+        self._baud = _coerce(baud, int)
+        self._default_timeout = self._timeout = _coerce(timeout, float)
+        self._boot_time = _coerce(boot_time, float)
+        self._reset_hold = _coerce(reset_hold, float)
+        self._reset_wait = _coerce(reset_wait, float)
+        self._fault_rates = {
+            'drop': _coerce(drop_rate, float),
+            'corrupt': _coerce(corrupt_rate, float),
+            'hang': _coerce(hang_rate, float),
+        }
+        self._airtime = _coerce(airtime, bool)
+        self.framing = _coerce(protocol_version, int) >= 1
+        self._random = random.Random(
+            None if seed is None else _coerce(seed, int))
+
+        self.rx = None  # host -> device
+        self.tx = None  # device -> host
+        self.radio = deque()
+        self.transmissions = deque(maxlen=1000)
+        self.faults = dict.fromkeys(self._fault_rates, 0)
+        self._firmware = None
+
+    def _assert_ready(self):
+        if not self._firmware:
+            raise IOError("Simulated device not yet initialized")
+
+    def _boot(self, boot_time):
+        if self._firmware:
+            self._halt()
+        # Bytes arriving while the bootloader and setup() run are lost.
+        self.rx = SerialLine(self._baud, capacity=RX_BUFFER_SIZE,
+                             deaf_for=boot_time)
+        self.tx = SerialLine(self._baud)
+        self._firmware = SimulatedFirmware(self, boot_time)
+        self._firmware.start()
+
+    def _halt(self):
+        self._firmware.halted.set()
+        self.rx.interrupt()
+        self._firmware.join()
+
+    def roll_fault(self, kind):
+        rate = self._fault_rates[kind]
+        if rate and self._random.random() < rate:
+            self.faults[kind] += 1
+            return True
+        return False
+
+    def _garble(self, data):
+        out = bytearray()
+        for byte in bytearray(data):
+            if self.roll_fault('drop'):
+                continue
+            if self.roll_fault('corrupt'):
+                byte ^= 1 << self._random.randrange(8)
+            out.append(byte)
+        return bytes(out)
+
+    def tx_from_device(self, data):
+        self.tx.put(self._garble(data))
+
+    def transmit(self, protocol, pulse_length, repetitions, message,
+                 bit_length):
+        """
+        Called by the firmware to "broadcast" a message over the radio.
+        """
+        if self._airtime:
+            time.sleep(airtime(pulse_length, bit_length, repetitions,
+                               protocol))
+        self.transmissions.append(
+            (time.time(), protocol, pulse_length, repetitions, message,
+             bit_length))
+
+    def inject_signal(self, message, pulse_length=350, protocol=1,
+                      bit_length=None):
+        """
+        Makes the simulated receiver pick up a 433MHz transmission.
+
+        :param message: hex-encoded message, as reported by `read_signals`
+        :param pulse_length: pulse length in microseconds
+        :param protocol: rc-switch protocol number
+        :param bit_length: number of bits (defaults to the hex length)
+        """
+        raw = bytearray.fromhex(message)
+        value = 0
+        for byte in reversed(raw):
+            value = (value << 8) | byte
+        if bit_length is None:
+            bit_length = len(raw) * 8
+        self.radio.append((protocol, pulse_length, bit_length,
+                           value & 0xFFFFFFFF))
+
+    def initialize(self):
+        if not self._firmware:
+            self._boot(0)
+
+    def reset(self, wait=True):
+        self._assert_ready()
+        self._halt()
+        time.sleep(self._reset_hold)
+        self._boot(self._boot_time)
+        if wait:
+            time.sleep(self._reset_wait)
+        self.tx.clear()
+
+    def set_timeout(self, timeout):
+        self._timeout = self._default_timeout if timeout is None \
+            else timeout
+
+    def close(self):
+        if self._firmware:
+            self._halt()
+            self._firmware = None
+
+    def read(self, size=1):
+        self._assert_ready()
+        return self.tx.read(size, self._timeout)
+
+    def read_available(self, size=1):
+        self._assert_ready()
+        return self.tx.read(max(size, self.tx.available()), self._timeout)
+
+    def write(self, data):
+        self._assert_ready()
+        self.rx.put(self._garble(data))
+        return len(data)
+
+    def flush(self):
+        self._assert_ready()
+        time.sleep(self.rx.drain_time())
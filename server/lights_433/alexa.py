@@ -3,22 +3,180 @@
 
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+import json
+import logging
+import re
+from threading import Lock, Thread
+import time
+from urllib2 import Request, urlopen
+
 from flask_ask import Ask, statement, question
 from Levenshtein import jaro
 
+from .metrics import ALEXA_MATCH_TIME
+
 
 _MATCH_THRESHOLD = 0.8
+_FIRST_LETTER_BONUS = 0.1
 _CARD_TITLE = "Home Lighting"
+_FAILURE_TEXT = "I had problems communicating with your device!"
+
+# Separates the locations of an utterance naming several switches.
+_LOCATION_SEPARATOR = re.compile(r'\s*(?:,|&|\band\b)\s*', re.UNICODE)
+
+log = logging.getLogger(__name__)
+
+_SOUNDEX_CODES = dict(
+    (letter, unicode(code))
+    for code, letters in enumerate(
+        ['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r'])
+    for letter in letters)
 
 
 class ActionParseError(Exception):
     pass
 
 
+def normalize(name):
+    """
+    Lowercases a switch name or utterance and collapses any punctuation
+    (i.e. underscores in switch IDs) into single spaces.
+    """
+    words = re.split(r'[\W_]+', name.lower(), flags=re.UNICODE)
+    return ' '.join(word for word in words if word)
+
+
+def soundex(name):
+    """
+    American Soundex key of each word in a normalized name, so that names
+    Alexa misheard as similar sounding words still match.
+    """
+    keys = []
+    for word in name.split():
+        word = [c for c in word if c in _SOUNDEX_CODES]
+        if not word:
+            continue
+        key, last = word[0], _SOUNDEX_CODES[word[0]]
+        for c in word[1:]:
+            code = _SOUNDEX_CODES[c]
+            if code != '0' and code != last:
+                key += code
+            if c not in 'hw':
+                last = code
+        keys.append((key + '000')[:4])
+    return ' '.join(keys)
+
+
+class LocationIndex(object):
+
+    def __init__(self, switches, phonetic=True, cache_size=256):
+        """
+        Resolves spoken locations to switch IDs.
+
+        Switch IDs and their aliases are normalized and bucketed by first
+        letter up front, so an utterance is only scored against the names
+        sharing its first letter (which also earn a bonus, as Alexa's speech
+        processing is unreliable past the first sound). The remaining names
+        are scanned only if that bucket has no match. Resolved utterances are
+        cached, so repeated requests skip matching altogether.
+
+        :param switches: switch IDs to their configs (as loaded by
+                         `load_switch_conf`)
+        :type switches: dict
+        :param phonetic: whether to fall back to matching Soundex keys
+        :type phonetic: bool
+        :param cache_size: the number of resolved utterances to remember
+        :type cache_size: int
+        """
+        self.names = {}
+        self.buckets = {}
+        self.phonetic = {}
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        for switch_id, conf in sorted(switches.items()):
+            for name in [switch_id] + (conf.get('aliases') or []):
+                name = normalize(name)
+                if not name or name in self.names:
+                    continue
+                self.names[name] = switch_id
+                self.buckets.setdefault(name[0], []).append(name)
+                if phonetic:
+                    self.phonetic.setdefault(soundex(name), switch_id)
+
+    def _best(self, location, names, bonus):
+        best, best_score = None, _MATCH_THRESHOLD
+        for name in names:
+            score = jaro(location, name) + bonus
+            if score >= best_score:
+                best, best_score = name, score
+        return best
+
+    def _resolve(self, location):
+        if location in self.names:
+            return self.names[location]
+        name = self._best(location, self.buckets.get(location[0], ()),
+                          _FIRST_LETTER_BONUS)
+        if name is None and self.phonetic:
+            switch_id = self.phonetic.get(soundex(location))
+            if switch_id is not None:
+                return switch_id
+        if name is None:
+            name = self._best(location, (
+                name for letter, names in self.buckets.items()
+                if letter != location[0] for name in names), 0)
+        return self.names.get(name)
+
+    def match(self, location):
+        """
+        :param location: the location as heard by Alexa
+        :returns: the matching switch ID, or None
+        """
+        with self._lock:
+            if location in self._cache:
+                self._cache[location] = self._cache.pop(location)
+                return self._cache[location]
+        normalized = normalize(location)
+        switch_id = self._resolve(normalized) if normalized else None
+        with self._lock:
+            self._cache[location] = switch_id
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return switch_id
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
 class AlexaServer(object):
 
-    def __init__(self, lights_433_server):
+    def __init__(self, lights_433_server, background=False, notify=None,
+                 multi_target=False, notify_timeout=5):
+        """
+        :param lights_433_server: the server whose switches are controlled
+        :param background: whether to answer as soon as the switch commands
+                           are queued, rather than once they are sent, so
+                           that a slow or resetting device cannot make Alexa
+                           give up on the response
+        :type background: bool
+        :param notify: a URL to POST failures to as JSON, as they cannot be
+                       spoken when answering in the background
+        :param multi_target: whether to accept several locations in one
+                             utterance (i.e. "kitchen and hallway"), switched
+                             together in a single transmission
+        :type multi_target: bool
+        :param notify_timeout: seconds to wait for the notification URL to
+                               respond
+        :type notify_timeout: float
+        """
         self.server = lights_433_server
+        self.background = background
+        self.notify = notify
+        self.multi_target = multi_target
+        self.notify_timeout = notify_timeout
+        self.index = LocationIndex(self.server.config.switches)
         self.ask = Ask(self.server.app, '/switch_alexa')
         self.ask.intent('LightSwitch')(
             lambda location, operation:
@@ -28,27 +186,42 @@ class AlexaServer(object):
             lambda: self.get_welcome_response()
         )
 
-    def match_location(self, location):
+    def reload(self, config):
         """
-        We will mutate the score a bit to add +0.1 to the jaro distance
-        for starting with the same letter. Alexa's speech processing system
-        really sucks at this.
+        Rebuilds the location index (and so drops cached matches) after the
+        switch config changes.
+        """
+        self.index = LocationIndex(config.switches)
 
+    def match_location(self, location):
+        """
         location -- the location to match against
         """
-        if location:
-            matches = []
-            for switch_id, switch_func in self.server.switches.items():
-                similarity = jaro(location, switch_id)
-                if location[0].lower() == switch_id[0].lower():
-                    similarity += 0.1
-                matches += [(similarity, switch_id, switch_func)]
-            matches.sort(key=lambda x: x[0], reverse=True)
-            if matches[0][0] >= _MATCH_THRESHOLD:
-                return matches[0][1:]
+        start = time.time()
+        switch_id = self.index.match(location) if location else None
+        ALEXA_MATCH_TIME.observe(time.time() - start, (
+            'matched' if switch_id is not None else 'unmatched',))
+        if switch_id in self.server.switches:
+            return switch_id, self.server.switches[switch_id]
         raise ActionParseError("I didn't understand the location. "
                                "Could you please repeat?")
 
+    def match_locations(self, location):
+        """
+        Matches an utterance naming one or (with multi-target utterances)
+        several locations.
+
+        :returns: list of switch IDs
+        """
+        if self.multi_target:
+            parts = [part for part in _LOCATION_SEPARATOR.split(location)
+                     if part]
+            # Names that themselves contain "and" are kept whole.
+            if len(parts) > 1 and normalize(location) not in self.index.names:
+                switch_ids = [self.match_location(part)[0] for part in parts]
+                return list(OrderedDict.fromkeys(switch_ids))
+        return [self.match_location(location)[0]]
+
     def match_operation(self, operation):
         if operation.lower() in ('on', 'up', 'in'):
             return 'on'
@@ -60,23 +233,75 @@ class AlexaServer(object):
     def perform_switch(self, location, operation):
 
         try:
-            resolved_location = self.match_location(location or "")
-            resolved_operation = self.match_operation(operation or "")
+            switch_ids = self.match_locations(location or "")
+            op = self.match_operation(operation or "")
         except ActionParseError as ape:
             return question(str(ape)).simple_card(_CARD_TITLE, str(ape))
 
-        switch_id, switch_func = resolved_location
+        commands = [(switch_id, op) for switch_id in switch_ids]
         try:
-            r = switch_func(resolved_operation)
-            text = "%s %s!" % (
-                switch_id.replace('_', ' ').title(), resolved_operation)
-            status = int(r.status.split(' ')[0])
-            if status < 200 or status > 299:
-                raise Exception(status)
+            futures = self.server.submit(commands, owner='alexa')
+            if self.background:
+                self._watch(commands, futures)
+            else:
+                for future in futures:
+                    future.result()
+            names = [switch_id.replace('_', ' ').title()
+                     for switch_id in switch_ids]
+            if len(names) > 1:
+                names[-2:] = ['%s and %s' % tuple(names[-2:])]
+            text = "%s %s!" % (', '.join(names), op)
         except Exception:
-            text = "I had problems communicating with your device!"
+            log.exception("Failed to switch [%s] %s"
+                          % (', '.join(switch_ids), op))
+            text = _FAILURE_TEXT
         return statement(text).simple_card(_CARD_TITLE, text)
 
+    def _watch(self, commands, futures):
+        """
+        Reports the commands of an utterance once all have completed, if any
+        failed.
+        """
+        remaining, lock = [len(futures)], Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            failed = [(switch_id, op, future.exception())
+                      for (switch_id, op), future in zip(commands, futures)
+                      if future.exception() is not None]
+            if failed:
+                self._report(failed)
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def _report(self, failed):
+        for switch_id, op, error in failed:
+            log.error("Voice command to switch [%s] %s failed: %s"
+                      % (switch_id, op, error))
+        if self.notify is None:
+            return
+        event = dict(time=time.time(), text=_FAILURE_TEXT, failed=[
+            dict(switch=switch_id, op=op, error=unicode(error))
+            for switch_id, op, error in failed])
+
+        def post():
+            try:
+                request = Request(self.notify, json.dumps(event),
+                                  {'Content-Type': 'application/json'})
+                urlopen(request, timeout=self.notify_timeout).close()
+            except Exception:
+                log.exception("Failed to notify [%s] of a failed voice "
+                              "command" % self.notify)
+
+        # Off the thread completing the commands (i.e. a transmitter's).
+        notifier = Thread(target=post, name='lights433-alexa-notify')
+        notifier.daemon = True
+        notifier.start()
+
     def get_welcome_response(self):
         text = "Ask me to turn your lights on and off!"
         return statement(text).simple_card(_CARD_TITLE, text)
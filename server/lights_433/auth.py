@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import base64
+from collections import namedtuple
+from functools import wraps
+import getpass
+import hashlib
+import hmac
+import json
+import os
+import time
+
+import clip
+from flask import g, request
+from flask_basic_roles import BasicRoleAuth
+
+
+# Stored passwords are either plaintext, or hashed in the form
+#
+#   pbkdf2_sha256$<iterations>$<salt>$<hash>
+#
+# with the salt and hash base64 encoded (see lights433-passwd).
+_HASH_SCHEME = 'pbkdf2_sha256'
+_HASH_NAME = str('sha256')  # Python 2's hashlib only takes byte strings
+PBKDF2_ITERATIONS = 100000
+
+# Parsed tokens kept, beyond which expired ones are dropped.
+_MAX_TOKENS = 1024
+
+# The user a request is authenticated as, the switches it may use (None for
+# any the user may use), and whether it authenticated with a token.
+Principal = namedtuple('Principal', ['user', 'switches', 'token'])
+
+
+def hash_password(password, iterations=PBKDF2_ITERATIONS):
+    """
+    :param password: the password to hash
+    :returns: the hash, to store in place of the password
+    """
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac(_HASH_NAME, password, salt, iterations)
+    return '$'.join([_HASH_SCHEME, unicode(iterations),
+                     base64.b64encode(salt).decode('ascii'),
+                     base64.b64encode(digest).decode('ascii')])
+
+
+def check_password(password, stored):
+    """
+    :param password: the password given
+    :param stored: the user's stored password, hashed or not
+    :returns: True if they match (never if the stored hash is malformed)
+    """
+    if not stored.startswith(_HASH_SCHEME + '$'):
+        return hmac.compare_digest(password.encode('utf-8'),
+                                   stored.encode('utf-8'))
+    try:
+        _, iterations, salt, expected = stored.split('$')
+        salt, expected = base64.b64decode(salt), base64.b64decode(expected)
+        iterations = int(iterations)
+    except (TypeError, ValueError):
+        return False
+    digest = hashlib.pbkdf2_hmac(_HASH_NAME, password.encode('utf-8'),
+                                 salt, iterations)
+    return hmac.compare_digest(digest, expected)
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _unb64(text):
+    text = text.encode('ascii')
+    return base64.urlsafe_b64decode(text + b'=' * (-len(text) % 4))
+
+
+class Lights433Auth(BasicRoleAuth):
+
+    def __init__(self, secret, cache_ttl=300, token_ttl=900):
+        """
+        Authenticates requests by HTTP basic auth, against plaintext or
+        hashed passwords, or by bearer tokens issued to users, limited to
+        some of their switches.
+
+        Passwords are hashed to be slow to verify, so credentials that
+        verify are remembered for a while and requests repeating them are
+        authenticated without hashing again. Tokens are signed rather than
+        stored, so that any process holding the secret (i.e. every HTTP
+        worker) can verify them.
+
+        :param secret: the key tokens are signed with
+        :type secret: bytes
+        :param cache_ttl: seconds for which verified credentials are
+                          remembered
+        :type cache_ttl: float
+        :param token_ttl: the most seconds a token may be valid for
+        :type token_ttl: float
+        """
+        super(Lights433Auth, self).__init__()
+        self.secret = secret
+        self.cache_ttl = cache_ttl
+        self.token_ttl = token_ttl
+        # Passwords are remembered by a keyed digest, rather than kept.
+        self._cache_key = os.urandom(32)
+        self._verified = {}  # (user, stored password) to (digest, expiry)
+        self._tokens = {}  # token to (`Principal`, expiry)
+
+    def set_users(self, users):
+        """
+        Replaces the users (i.e. on reload), forgetting any credentials
+        verified against the old ones.
+
+        :param users: dict of user to stored password
+        """
+        self.users = users
+        self._verified = {}
+
+    def authenticate(self):
+        """
+        :returns: the `Principal` the current request authenticates as, or
+                  None if it does not
+        """
+        return self.check(request.headers.get('Authorization', ''))
+
+    def check(self, authorization):
+        """
+        Authenticates an Authorization header, outside of any request
+        context.
+
+        :returns: the `Principal` it authenticates as, or None if it does not
+        """
+        kind, _, credentials = authorization.partition(' ')
+        kind, credentials = kind.lower(), credentials.strip()
+        if kind == 'bearer':
+            return self.verify_token(credentials)
+        if kind != 'basic':
+            return None
+        try:
+            user, _, password = base64.b64decode(credentials) \
+                .decode('utf-8').partition(':')
+        except (TypeError, ValueError):
+            return None  # Malformed.
+        if user not in self.users:
+            return None
+        stored = self.users[user]
+        key = (user, stored)
+        digest = hmac.new(self._cache_key, password.encode('utf-8'),
+                          hashlib.sha256).digest()
+        now = time.time()
+        verified = self._verified.get(key)
+        if verified is None or verified[1] <= now or \
+                not hmac.compare_digest(verified[0], digest):
+            if not check_password(password, stored):
+                return None
+            self._verified[key] = (digest, now + self.cache_ttl)
+        return Principal(user, None, False)
+
+    def issue_token(self, user, switches=None, ttl=None):
+        """
+        :param user: the user to issue the token to
+        :param switches: the switches the token may use, of those the user
+                         may use (any of them if unspecified)
+        :type switches: list
+        :param ttl: seconds the token is valid for (at most, and by default,
+                    `token_ttl`)
+        :type ttl: float
+        :returns: (token, expiry time)
+        """
+        expires = int(time.time() + min(ttl or self.token_ttl,
+                                        self.token_ttl))
+        body = _b64(json.dumps([
+            user, expires,
+            sorted(switches) if switches is not None else None
+        ]).encode('utf-8'))
+        return body + '.' + self._sign(body), expires
+
+    def _sign(self, body):
+        return _b64(hmac.new(self.secret, body.encode('ascii'),
+                             hashlib.sha256).digest())
+
+    def verify_token(self, token):
+        """
+        :returns: the `Principal` the token was issued to, or None if it is
+                  invalid or expired (or its user no longer exists)
+        """
+        now = time.time()
+        verified = self._tokens.get(token)
+        if verified is None:
+            body, _, signature = token.partition('.')
+            try:
+                if not hmac.compare_digest(signature.encode('ascii'),
+                                           self._sign(body).encode('ascii')):
+                    return None
+                user, expires, switches = json.loads(
+                    _unb64(body).decode('utf-8'))
+            except (ValueError, TypeError):
+                return None  # Not a token at all.
+            verified = (Principal(user, frozenset(switches)
+                                  if switches is not None else None, True),
+                        expires)
+            if len(self._tokens) >= _MAX_TOKENS:
+                self._tokens = dict(
+                    (t, v) for t, v in self._tokens.items() if v[1] > now)
+                if len(self._tokens) >= _MAX_TOKENS:
+                    self._tokens = {}
+            self._tokens[token] = verified
+        principal, expires = verified
+        if expires <= now or principal.user not in self.users:
+            return None
+        return principal
+
+    def require(self):
+        """
+        Decorates a route to require authentication, setting `g.principal`.
+        Authorization is left to the route, per switch.
+        """
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                principal = self.authenticate()
+                if principal is None:
+                    return self.no_authentication()
+                g.principal = principal
+                return f(*args, **kwargs)
+            return decorated
+        return decorator
+
+
+app = clip.App()
+
+
+@app.main(description='Hashes a password for a user: line of the switch '
+                      'config')
+@clip.opt('--iterations', default=PBKDF2_ITERATIONS, type=int,
+          help='PBKDF2 iterations; more are slower to verify and to crack')
+def passwd(iterations):
+    password = getpass.getpass('Password: ')
+    if getpass.getpass('Repeat password: ') != password:
+        clip.exit("The passwords differ", err=True)
+    clip.echo(hash_password(password, iterations))
+
+
+def main():
+    try:
+        app.run()
+    except clip.ClipExit:
+        pass
+
+
+if __name__ == '__main__':
+    main()
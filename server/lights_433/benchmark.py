@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function, unicode_literals
+
+import base64
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from threading import Lock, Thread
+import time
+from urllib2 import HTTPError, Request, urlopen, URLError
+
+import clip
+
+from .adapter import get_adapter, parse_adapter_args
+from .driver import Signal, SignalDriver
+from .store import SignalStore
+
+app = clip.App()
+
+_BENCH_USER = 'bench'
+_BENCH_PASSWORD = 'bench'
+_BENCH_SIGNAL = '14d15c'
+_BENCH_PULSE_LENGTH = 189
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of a list of samples.
+
+    :param samples: the samples (need not be sorted)
+    :param pct: the percentile in [0, 100]
+    """
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    rank = int(round(pct / 100 * len(ordered) + 0.5)) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def report(name, latencies, elapsed, errors=0):
+    clip.echo("%s: %d ok, %d failed in %.2fs" %
+              (name, len(latencies), errors, elapsed))
+    clip.echo("  p50 %.1fms  p99 %.1fms  max %.1fms  %.1f commands/sec" % (
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000,
+        max(latencies or [float('nan')]) * 1000,
+        len(latencies) / elapsed if elapsed else 0))
+
+
+def run_clients(clients, requests, command):
+    """
+    Runs `command` from several concurrent client threads.
+
+    :param clients: the number of client threads
+    :param requests: the number of commands each client issues
+    :param command: callable taking (client index, request index); it should
+                    raise on failure
+
+    :returns: (list of latencies in seconds, elapsed seconds, error count)
+    """
+    latencies, errors = [], [0]
+    results_lock = Lock()
+
+    def client(i):
+        for j in range(requests):
+            start = time.time()
+            try:
+                command(i, j)
+            except Exception:
+                with results_lock:
+                    errors[0] += 1
+                continue
+            with results_lock:
+                latencies.append(time.time() - start)
+
+    threads = [Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, time.time() - start, errors[0]
+
+
+def _make_adapter(adapter, adapter_args):
+    return get_adapter(adapter)(**parse_adapter_args(adapter_args))
+
+
+def _write_switch_conf(path, switches, device_names=None):
+    with open(path, 'w') as f:
+        f.write('user:%s:%s\n' % (_BENCH_USER, _BENCH_PASSWORD))
+        for s in range(switches):
+            device = ':device=%s' % device_names[s % len(device_names)] \
+                if device_names else ''
+            f.write('switch:bench_%d:%s:%s:%d:%s%s\n' % (
+                s, _BENCH_SIGNAL, _BENCH_SIGNAL, _BENCH_PULSE_LENGTH,
+                _BENCH_USER, device))
+
+
+def _auth_headers():
+    credentials = base64.b64encode(
+        ('%s:%s' % (_BENCH_USER, _BENCH_PASSWORD)).encode('utf-8'))
+    return {'Authorization': b'Basic ' + credentials}
+
+
+def _free_port():
+    s = socket.socket()
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def _await_response(url, deadline):
+    """
+    Polls a URL until it is served (with any status).
+
+    :returns: the status, or None if the deadline passed
+    """
+    while time.time() < deadline:
+        try:
+            r = urlopen(Request(url, headers=_auth_headers()), timeout=1)
+            r.close()
+            return r.getcode()
+        except HTTPError as e:
+            return e.code
+        except (URLError, socket.error):
+            time.sleep(0.005)
+    return None
+
+
+@app.main(description='Latency and throughput benchmarks for lights-433, '
+                      'by default against a simulated device')
+def bench():
+    pass
+
+
+@bench.subcommand(description='Benchmark SignalDriver.send_signal')
+@clip.opt('--adapter', default='sim', type=str,
+          help='The adapter to benchmark against')
+@clip.opt('--adapter-args', default='', type=str,
+          help='Comma separated name-value args for the adapter')
+@clip.opt('--clients', default=4, type=int,
+          help='The number of concurrent clients')
+@clip.opt('--requests', default=25, type=int,
+          help='The number of commands sent by each client')
+@clip.opt('--repetitions', default=5, type=int,
+          help='The number of times each signal is broadcast')
+def send(adapter, adapter_args, clients, requests, repetitions):
+    driver = SignalDriver(_make_adapter(adapter, adapter_args))
+    driver_lock = Lock()
+
+    def command(i, j):
+        with driver_lock:
+            driver.send_signal(_BENCH_SIGNAL, _BENCH_PULSE_LENGTH,
+                               repetitions)
+
+    try:
+        report('send_signal', *run_clients(clients, requests, command))
+    finally:
+        driver.adapter.close()
+
+
+@bench.subcommand(description='Benchmark SignalDriver.read_signals against '
+                              'injected signals (simulated adapter only)')
+@clip.opt('--adapter-args', default='', type=str,
+          help='Comma separated name-value args for the simulated adapter')
+@clip.opt('--signals', default=100, type=int,
+          help='The number of signals to capture')
+@clip.opt('--interval', default=50, type=int,
+          help='Milliseconds between injected signals')
+def read(adapter_args, signals, interval):
+    adapter = _make_adapter('sim', adapter_args)
+    driver = SignalDriver(adapter)
+    injected = []
+
+    def inject():
+        for _ in range(signals):
+            injected.append(time.time())
+            adapter.inject_signal(_BENCH_SIGNAL, _BENCH_PULSE_LENGTH)
+            time.sleep(interval / 1000)
+
+    injector = Thread(target=inject)
+    latencies = []
+    start = time.time()
+    injector.start()
+    try:
+        for i, _ in enumerate(driver.read_signals(signals)):
+            latencies.append(time.time() - injected[i])
+        report('read_signals', latencies, time.time() - start)
+    finally:
+        injector.join()
+        adapter.close()
+
+
+@bench.subcommand(description='Benchmark the /switch/<id>/<op> HTTP routes')
+@clip.opt('--adapter', default='sim', type=str,
+          help='The adapter to benchmark against')
+@clip.opt('--adapter-args', default='', type=str,
+          help='Comma separated name-value args for the adapter')
+@clip.opt('--clients', default=4, type=int,
+          help='The number of concurrent clients')
+@clip.opt('--requests', default=25, type=int,
+          help='The number of requests sent by each client')
+@clip.opt('--switches', default=4, type=int,
+          help='The number of distinct switches to spread requests over')
+@clip.opt('--devices', default=1, type=int,
+          help='The number of devices to spread switches over')
+def http(adapter, adapter_args, clients, requests, switches, devices):
+    from .server import DEFAULT_DEVICE, Lights433Server
+
+    device_names = [DEFAULT_DEVICE] + ['bench_%d' % d
+                                       for d in range(1, devices)]
+    conf_dir = tempfile.mkdtemp()
+    switch_conf = os.path.join(conf_dir, 'switches.conf')
+    _write_switch_conf(switch_conf, switches, device_names)
+
+    try:
+        server = Lights433Server(
+            '127.0.0.1', 0, _make_adapter(adapter, adapter_args),
+            switch_conf, [(name, _make_adapter(adapter, adapter_args))
+                          for name in device_names[1:]])
+    finally:
+        shutil.rmtree(conf_dir)
+    headers = _auth_headers()
+    http_clients = [server.app.test_client() for _ in range(clients)]
+
+    def command(i, j):
+        url = '/switch/bench_%d/%s' % ((i + j) % switches,
+                                       ('on', 'off')[j % 2])
+        r = http_clients[i].get(url, headers=headers)
+        if r.status_code != 200:
+            raise Exception(r.status_code)
+
+    try:
+        report('GET /switch/<id>/<op>',
+               *run_clients(clients, requests, command))
+    finally:
+        server.pool.close()
+
+
+@bench.subcommand(description='Benchmark the time from starting the '
+                              'lights433 server to it serving requests')
+@clip.opt('--adapter', default='sim', type=str,
+          help='The adapter to benchmark against')
+@clip.opt('--adapter-args', default='', type=str,
+          help='Comma separated name-value args for the adapter')
+@clip.opt('--runs', default=5, type=int,
+          help='The number of times to start the server')
+@clip.opt('--server-args', default='', type=str,
+          help='Space separated additional arguments for lights433 (i.e. '
+               '"--no-alexa")')
+@clip.opt('--timeout', default=30, type=int,
+          help='Seconds to wait for each start')
+def startup(adapter, adapter_args, runs, server_args, timeout):
+    conf_dir = tempfile.mkdtemp()
+    switch_conf = os.path.join(conf_dir, 'switches.conf')
+    _write_switch_conf(switch_conf, 1)
+    served, switched, failed = [], [], 0
+    try:
+        for _ in range(runs):
+            port = _free_port()
+            base_url = 'http://127.0.0.1:%d' % port
+            start = time.time()
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'lights_433.main', adapter,
+                 '--adapter-args', adapter_args, '--port', str(port),
+                 '--switches', switch_conf] + server_args.split(),
+                stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+            try:
+                # The first request served at all, and then the first
+                # switched (which also waits on the device).
+                status = _await_response(base_url + '/status',
+                                         start + timeout)
+                if status is not None:
+                    served.append(time.time() - start)
+                    status = _await_response(
+                        base_url + '/switch/bench_0/on', start + timeout)
+                if status == 200:
+                    switched.append(time.time() - start)
+                else:
+                    failed += 1
+            finally:
+                process.kill()
+                process.wait()
+    finally:
+        shutil.rmtree(conf_dir)
+    for name, times, errors in (
+            ('start to first request served', served, runs - len(served)),
+            ('start to first switch command', switched, failed)):
+        clip.echo("%s: %d ok, %d failed" % (name, len(times), errors))
+        clip.echo("  p50 %.1fms  max %.1fms" % (
+            percentile(times, 50) * 1000,
+            max(times or [float('nan')]) * 1000))
+
+
+@bench.subcommand(description='Benchmark queries of a SignalStore')
+@clip.opt('--signals', default=1000000, type=int,
+          help='The number of signals to store, received over as many '
+               'seconds')
+@clip.opt('--codes', default=30, type=int,
+          help='The number of distinct codes to store')
+@clip.opt('--queries', default=100, type=int,
+          help='The number of times to run each query')
+@clip.opt('--path', required=False, default=None, type=str,
+          help='Where to keep the store (a temporary directory by default)')
+def store(signals, codes, queries, path):
+    store_dir = None
+    if path is None:
+        store_dir = tempfile.mkdtemp()
+        path = os.path.join(store_dir, 'signals')
+    try:
+        signal_store = SignalStore(path)
+        messages = ['%06x' % (0x100000 + i) for i in range(codes)]
+        end = time.time()
+        start = time.time()
+        for i in range(signals):
+            signal_store.append(
+                Signal(1, _BENCH_PULSE_LENGTH, messages[i % codes]),
+                end - signals + i)
+        clip.echo("stored %d signals in %.2fs (%.1fMB)" % (
+            signals, time.time() - start, os.path.getsize(path) / 2 ** 20))
+
+        week = end - 7 * 24 * 60 * 60
+        for name, query in (
+                ('count of one code over a week',
+                 lambda: signal_store.count(messages[0], week)),
+                ('counts of every code over a week',
+                 lambda: signal_store.counts(week)),
+                ('100 signals of one code in the last hour',
+                 lambda: signal_store.find(messages[0], end - 3600,
+                                           limit=100))):
+            latencies = []
+            start = time.time()
+            for _ in range(queries):
+                query_start = time.time()
+                query()
+                latencies.append(time.time() - query_start)
+            report(name, latencies, time.time() - start)
+        signal_store.close()
+    finally:
+        if store_dir is not None:
+            shutil.rmtree(store_dir)
+
+
+@bench.subcommand(description='Benchmark serving /signals/stream to many '
+                              'idle clients from the streams plugin '
+                              '(simulated adapter only)')
+@clip.opt('--adapter-args', default='', type=str,
+          help='Comma separated name-value args for the simulated adapter')
+@clip.opt('--clients', default=1000, type=int,
+          help='The number of streaming clients (mind ulimit -n)')
+@clip.opt('--signals', default=20, type=int,
+          help='The number of signals to inject')
+@clip.opt('--idle', default=5, type=int,
+          help='Seconds to measure CPU time over while the clients are idle')
+def streams(adapter_args, clients, signals, idle):
+    from .server import DEFAULT_DEVICE, Lights433Server
+
+    conf_dir = tempfile.mkdtemp()
+    switch_conf = os.path.join(conf_dir, 'switches.conf')
+    _write_switch_conf(switch_conf, 1)
+    adapter = _make_adapter('sim', adapter_args)
+    port = _free_port()
+    try:
+        server = Lights433Server(
+            '127.0.0.1', 0, adapter, switch_conf, sniff=DEFAULT_DEVICE,
+            plugins=dict(streams=dict(port=port)))
+    finally:
+        shutil.rmtree(conf_dir)
+
+    request = ('GET /signals/stream HTTP/1.1\r\nAuthorization: %s\r\n\r\n'
+               % _auth_headers()['Authorization'].decode('ascii'))
+    connections = []
+    for _ in range(clients):
+        connection = socket.create_connection(('127.0.0.1', port))
+        connection.sendall(request.encode('ascii'))
+        connections.append(connection)
+    for connection in connections:
+        connection.recv(4096)  # The response headers.
+
+    def cpu_time():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    start = cpu_time()
+    time.sleep(idle)
+    clip.echo("%d idle streams: %.1fms CPU/sec" % (
+        clients, (cpu_time() - start) / idle * 1000))
+
+    # Each client's latency to receive each signal, in full.
+    latencies = []
+    start = time.time()
+    try:
+        for _ in range(signals):
+            injected = time.time()
+            adapter.inject_signal(_BENCH_SIGNAL, _BENCH_PULSE_LENGTH)
+            for connection in connections:
+                received = b''
+                while not received.endswith(b'\n\n') or \
+                        b'data:' not in received:
+                    received += connection.recv(4096)
+                latencies.append(time.time() - injected)
+        report('signal delivered to every stream', latencies,
+               time.time() - start)
+    finally:
+        for connection in connections:
+            connection.close()
+        server.pool.close()
+
+
+def main():
+    try:
+        app.run()
+    except clip.ClipExit:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import logging
+import re
+
+
+log = logging.getLogger(__name__)
+
+SwitchConfig = namedtuple('SwitchConfig',
+                          ['users', 'switches', 'scenes', 'groups', 'events',
+                           'schedules', 'location'])
+
+# A schedule line as written, when it is due (see `_parse_timing`) and its
+# action, i.e. ('switch', switch_id, op) or ('scene', scene_id).
+Schedule = namedtuple('Schedule', ['spec', 'timing', 'action'])
+
+# When a schedule is due: `kind` is one of 'time' (`value` seconds after
+# midnight), 'sunrise' or 'sunset' (`value` seconds after it) or 'every'
+# (`value` seconds), moved by up to `jitter` seconds either way, only on
+# `days` (weekday numbers, Monday being 0) and, if `vacation`, only while in
+# vacation mode.
+Timing = namedtuple('Timing', ['kind', 'value', 'jitter', 'days', 'vacation'])
+
+_DURATION = re.compile(r'(\d+)([smhd])')
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+_DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# Optional trailing switch settings, their parsers and their defaults.
+SWITCH_OPTIONS = {
+    'device': unicode,
+    'aliases': lambda value: value.split('|'),
+    'repetitions': int,
+    'protocol': int,
+}
+SWITCH_DEFAULTS = {
+    'repetitions': 5,
+    'protocol': 1,
+}
+
+
+class UnknownConfigSettingError(Exception):
+    pass
+
+
+class UserAlreadyExistsError(Exception):
+    pass
+
+
+class SwitchAlreadyExistsError(Exception):
+    pass
+
+
+class SceneAlreadyExistsError(Exception):
+    pass
+
+
+class BadSceneError(Exception):
+    pass
+
+
+class GroupAlreadyExistsError(Exception):
+    pass
+
+
+class BadEventError(Exception):
+    pass
+
+
+class BadScheduleError(Exception):
+    pass
+
+
+def _parse_options(switch_id, options):
+    parsed = dict.fromkeys(SWITCH_OPTIONS)
+    parsed.update(SWITCH_DEFAULTS)
+    for option in options.split(','):
+        if not option:
+            continue
+        name, _, value = option.partition('=')
+        if name not in SWITCH_OPTIONS:
+            raise UnknownConfigSettingError(
+                "switch [%s] option [%s]" % (switch_id, name))
+        parsed[name] = SWITCH_OPTIONS[name](value)
+    return parsed
+
+
+def _parse_scene(scene_id, actions, switches):
+    scene = []
+    for action in actions.split(','):
+        switch_id, _, op = action.partition('=')
+        if switch_id not in switches:
+            raise BadSceneError("scene [%s] references unknown switch [%s]"
+                                % (scene_id, switch_id))
+        if op not in ('on', 'off'):
+            raise BadSceneError("scene [%s] has bad operation [%s] for "
+                                "switch [%s]" % (scene_id, op, switch_id))
+        scene.append((switch_id, op))
+    return scene
+
+
+def _parse_event(match, action, switches, scenes):
+    """
+    :returns: (match, action), where the match is one of ('switch',
+              switch_id, op) or ('code', hex code), and the action one of
+              ('webhook', url), ('switch', switch_id, op) or ('scene',
+              scene_id)
+    """
+    if '=' in match:
+        switch_id, _, op = match.partition('=')
+        if switch_id not in switches or op not in ('on', 'off'):
+            raise BadEventError("event matches unknown switch operation [%s]"
+                                % match)
+        match = ('switch', switch_id, op)
+    else:
+        try:
+            bytearray.fromhex(match)
+        except ValueError:
+            raise BadEventError("event matches bad code [%s]" % match)
+        match = ('code', match.lower())
+
+    kind, _, _ = action.partition(':')
+    if kind in ('http', 'https'):
+        return match, ('webhook', action)
+    return match, _parse_action('event', action, switches, scenes,
+                                BadEventError)
+
+
+def _parse_action(rule, action, switches, scenes, error):
+    """
+    :returns: ('switch', switch_id, op) or ('scene', scene_id)
+    """
+    kind, _, target = action.partition(':')
+    if kind == 'switch':
+        switch_id, _, op = target.partition('=')
+        if switch_id not in switches or op not in ('on', 'off'):
+            raise error("%s action has unknown switch operation [%s]"
+                        % (rule, target))
+        return ('switch', switch_id, op)
+    if kind == 'scene':
+        if target not in scenes:
+            raise error("%s action has unknown scene [%s]" % (rule, target))
+        return ('scene', target)
+    raise error("unknown %s action [%s]" % (rule, action))
+
+
+def _parse_duration(duration):
+    """
+    Parses durations such as "90s", "15m" or "1h30m".
+
+    :returns: seconds
+    """
+    parts = _DURATION.findall(duration)
+    if not parts or ''.join(n + unit for n, unit in parts) != duration:
+        raise BadScheduleError("bad duration [%s]" % duration)
+    return sum(int(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+
+def _parse_timing(when, location):
+    """
+    Parses when a schedule is due, in the form
+
+        [vacation] <time>[~<jitter>] [<day>,<day>,...]
+
+    where the time is one of
+
+        <HH>:<MM>                 -- daily, at a local time
+        sunrise[<+|-><duration>]  -- daily, relative to sunrise
+        sunset[<+|-><duration>]   -- daily, relative to sunset
+        every <duration>          -- repeatedly (i.e. "every 2h")
+
+    :returns: `Timing`
+    """
+    words = when.split()
+    vacation = bool(words) and words[0] == 'vacation'
+    if vacation:
+        words = words[1:]
+    if words and words[0] == 'every':
+        words = ['every ' + ' '.join(words[1:2])] + words[2:]
+    if not words or len(words) > 2:
+        raise BadScheduleError("bad schedule time [%s]" % when)
+
+    time_spec, _, jitter = words[0].partition('~')
+    jitter = _parse_duration(jitter) if jitter else 0
+    days = None
+    if len(words) == 2:
+        try:
+            days = frozenset(_DAYS.index(day)
+                             for day in words[1].lower().split(','))
+        except ValueError:
+            raise BadScheduleError("bad schedule days [%s]" % words[1])
+
+    if time_spec.startswith('every '):
+        kind, value = 'every', _parse_duration(time_spec[len('every '):])
+        if not value:
+            raise BadScheduleError("schedule interval must be positive")
+    elif time_spec.startswith(('sunrise', 'sunset')):
+        kind = 'sunrise' if time_spec.startswith('sunrise') else 'sunset'
+        offset = time_spec[len(kind):]
+        value = 0
+        if offset:
+            if offset[0] not in '+-':
+                raise BadScheduleError("bad %s offset [%s]" % (kind, offset))
+            value = _parse_duration(offset[1:]) * \
+                (-1 if offset[0] == '-' else 1)
+        if location is None:
+            raise BadScheduleError("schedules relative to %s need a location"
+                                   % kind)
+    else:
+        try:
+            hours, minutes = (int(part) for part in time_spec.split(':'))
+        except ValueError:
+            raise BadScheduleError("bad schedule time [%s]" % time_spec)
+        if not (0 <= hours < 24 and 0 <= minutes < 60):
+            raise BadScheduleError("bad schedule time [%s]" % time_spec)
+        kind, value = 'time', hours * 60 * 60 + minutes * 60
+    return Timing(kind, value, jitter, days, vacation)
+
+
+def load_switch_conf(switch_conf):
+    """
+    Loads users, switches, scenes and device groups from a config file of
+    lines in the forms:
+
+        user:<user_id>:<password>
+        switch:<switch_id>:<on_signal>:<off_signal>:<pulse_length>:<users>
+            [:<option>=<value>,...]
+        scene:<scene_id>:<switch_id>=<on|off>,<switch_id>=<on|off>,...
+        group:<group_id>:<device>,<device>,...
+        event:<switch_id>=<on|off>|<code>:<action>
+        schedule:switch:<switch_id>=<on|off>|scene:<scene_id>@<when>
+        location:<latitude>,<longitude>
+
+    Passwords may be plaintext, or hashed with lights433-passwd.
+
+    Events act on signals received while sniffing, where actions are one of:
+
+        http[s]://...         -- POSTs the event as JSON to a webhook
+        switch:<switch_id>=<on|off>
+        scene:<scene_id>
+
+    Schedules are performed by the server when due (see `_parse_timing`), for
+    instance:
+
+        schedule:switch:porch=on@sunset-15m
+        schedule:scene:all_off@23:30 mon,tue,wed,thu,fri
+        schedule:switch:hallway=on@vacation 19:00~45m
+
+    where the location, in decimal degrees, is needed for sunrise and
+    sunset.
+
+    Switch options:
+
+        device      -- the device, or group of devices in order of
+                       preference, able to reach the switch (default: any
+                       device)
+        aliases     -- |-separated alternative names for voice control
+        repetitions -- the number of times each signal is broadcast
+                       (default: 5)
+        protocol    -- the rc-switch protocol of the switch (default: 1)
+
+    :param switch_conf: path to the config file
+    :returns: `SwitchConfig`
+    """
+    users = {}
+    switches = {}
+    scenes = {}
+    groups = {}
+    events = []
+    schedules = []
+    location = None
+    with open(switch_conf, 'r') as f:
+        for line in f:
+            if line.startswith('switch:'):
+                _, switch_id, on_signal, off_signal, pulse_length, \
+                    allowed, options = (line.strip().split(':') + [''])[:7]
+                if switch_id in switches:
+                    raise SwitchAlreadyExistsError(switch_id)
+                switches[switch_id] = dict(on_signal=unicode(on_signal),
+                                           off_signal=unicode(off_signal),
+                                           pulse_length=int(pulse_length),
+                                           users=allowed.split(','))
+                switches[switch_id].update(
+                    _parse_options(switch_id, options))
+                log.info("Loaded switch [%s]..." % switch_id)
+
+            elif line.startswith('user:'):
+                _, user_id, password = line.strip().split(':')
+                if user_id in users:
+                    raise UserAlreadyExistsError(user_id)
+                users[user_id] = password
+
+            elif line.startswith('scene:'):
+                _, scene_id, actions = line.strip().split(':')
+                if scene_id in scenes:
+                    raise SceneAlreadyExistsError(scene_id)
+                # Switches may be defined after the scenes using them.
+                scenes[scene_id] = actions
+
+            elif line.startswith('group:'):
+                _, group_id, devices = line.strip().split(':')
+                if group_id in groups:
+                    raise GroupAlreadyExistsError(group_id)
+                groups[group_id] = devices.split(',')
+
+            elif line.startswith('event:'):
+                _, match, action = line.strip().split(':', 2)
+                # Events may reference switches and scenes defined after them.
+                events.append((match, action))
+
+            elif line.startswith('schedule:'):
+                action, _, when = line.strip()[len('schedule:'):] \
+                    .rpartition('@')
+                if not action:
+                    raise BadScheduleError("schedule [%s] has no time"
+                                           % line.strip())
+                schedules.append((action, when))
+
+            elif line.startswith('location:'):
+                if location is not None:
+                    raise BadScheduleError("location defined twice")
+                try:
+                    latitude, longitude = (
+                        float(degrees) for degrees
+                        in line.strip()[len('location:'):].split(','))
+                except ValueError:
+                    raise BadScheduleError("bad location [%s]" % line.strip())
+                location = (latitude, longitude)
+            else:
+                raise UnknownConfigSettingError(line.split(':')[0])
+
+    for scene_id, actions in scenes.items():
+        scenes[scene_id] = _parse_scene(scene_id, actions, switches)
+        log.info("Loaded scene [%s]..." % scene_id)
+
+    events = [_parse_event(match, action, switches, scenes)
+              for match, action in events]
+    # Parsed last, as the location may be defined after them.
+    schedules = [Schedule('%s@%s' % (action, when),
+                          _parse_timing(when, location),
+                          _parse_action('schedule', action, switches, scenes,
+                                        BadScheduleError))
+                 for action, when in schedules]
+
+    return SwitchConfig(users, switches, scenes, groups, events, schedules,
+                        location)
@@ -4,17 +4,43 @@
 from __future__ import unicode_literals
 
 import codecs
-from collections import namedtuple
+from collections import deque, namedtuple, OrderedDict
 import logging
 import signal
 import struct
+import time
+
+from .metrics import DEVICE_TIME, RECONNECTS, RETRANSMITS
+from .reader import BufferedReader
 
 _PROTOCOL_HEADER = b'CLS'
 _PROTOCOL_VERSION = b'0'
+_HANDSHAKE = _PROTOCOL_HEADER + _PROTOCOL_VERSION
+
+# Protocol v1 is negotiated with a "CLS1" handshake, after which instructions
+# are sent as self-contained frames that need no handshake of their own:
+#
+#   <FRAME_START><sequence><instruction/response><length><payload><crc-8>
+#
+# Several frames may be in flight at once; each is acknowledged with a frame
+# carrying its sequence number.
+_PROTOCOL_VERSION_FRAMED = b'1'
+_FRAME_START = b'~'
+_FRAME_FIELDS = struct.Struct('<BBB')  # sequence, instruction, length
+_FRAMED_WINDOW = 48  # bytes in flight (the device's receive buffer holds 64)
+_FRAMED_RETRIES = 3
+# The largest WRITE_433 payload (header and message) the firmware accepts,
+# as MAX_FRAME_PAYLOAD in the sketch, and the longest message it can send
+# (as MAX_MESSAGE; it sends messages as an unsigned long).
+MAX_FRAME_PAYLOAD = 16
+MAX_MESSAGE = 4
 
 # Instructions
 _READ_433 = b'1'
 _WRITE_433 = b'2'
+_WRITE_433_BATCH = b'3'
+_STOP_READ = b'4'
+_PING = b'?'  # answered with HELLO by firmware that is up and idle
 
 # Responses
 _AWAITING_DATA = b'B'
@@ -25,6 +51,7 @@ _GOODBYE = b'F'
 _BAD_HEADER = b'G'
 _WRONG_VERSION = b'H'
 _HEARTBEAT = b'I'
+_BAD_FRAME = b'J'
 _UNKNOWN_OP_CODE = b'Z'
 
 # For debugging purposes
@@ -36,13 +63,42 @@ _RESPONSE_DEFINITIONS = {
     _GOODBYE: "protocol goodbye (terminating communication)",
     _BAD_HEADER: "bad protocol header received",
     _WRONG_VERSION: "bad protocol version received",
+    _BAD_FRAME: "corrupt or malformed frame received",
     _UNKNOWN_OP_CODE: "unknown request received"
 }
 
+# Readiness probing after a reset: the longest to wait for the firmware, and
+# the shortest and longest to wait for each probe to be answered.
+_READY_TIMEOUT = 5.0  # seconds
+_PROBE_WAIT_MIN = 0.05  # seconds
+_PROBE_WAIT_MAX = 0.4  # seconds
+
+_SHORT = struct.Struct('<H')
+_SIGNAL_HEADER = struct.Struct('<HHH')  # protocol, delay, byte length
+_FRAME_HEADER = struct.Struct('<HHHH')  # protocol, delay, repetitions, length
+
+# rc-switch protocol timings as (sync pulses, pulses per bit).
+RC_SWITCH_PROTOCOLS = {
+    1: (32, 4),
+    2: (11, 3),
+    3: (101, 15),
+    4: (7, 4),
+    5: (20, 3),
+    6: (24, 3),
+}
+
 Signal = namedtuple('Signal', ['protocol', 'pulse_length', 'message'])
 
 LOG = logging.getLogger(__name__)
 
+# Drivers whose adapters are closed on termination.
+_DRIVERS = []
+
+
+def _close_drivers(signum, frame):
+    for driver in _DRIVERS:
+        driver._signal_close(signum, frame)
+
 
 class DeviceCommError(Exception):
     pass
@@ -63,6 +119,28 @@ class BadResponseError(DeviceCommError):
         super(BadResponseError, self).__init__(message)
 
 
+class ResponseTimeout(DeviceCommError):
+    """
+    Raised when the serial device stops responding partway through a
+    multi-byte response.
+    """
+    pass
+
+
+class FrameTooLargeError(Exception):
+    """
+    Raised when a signal is too long for the firmware to accept.
+    """
+    pass
+
+
+class DeviceNotReadyError(DeviceCommError):
+    """
+    Raised when the serial device does not come up after a reset.
+    """
+    pass
+
+
 class RadioTimeout(DeviceCommError):
     """
     Raised in the event of a radio timeout when waiting for an incoming signal.
@@ -70,29 +148,164 @@ class RadioTimeout(DeviceCommError):
     pass
 
 
+def _crc8_table(polynomial=0x07):
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc << 1) ^ polynomial if crc & 0x80 else crc << 1
+        table.append(crc & 0xFF)
+    return table
+
+
+_CRC8_TABLE = _crc8_table()
+
+
+def crc8(data, crc=0):
+    """
+    Computes the CRC-8 (polynomial 0x07) checksum used by protocol v1 frames.
+
+    :param data: the data to checksum
+    :type data: bytes or bytearray
+
+    :returns: int
+    """
+    for byte in bytearray(data):
+        crc = _CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def compile_frame(message, pulse_length, repetitions=1, protocol=1):
+    """
+    Compiles the WRITE_433 message definition payload of a signal ahead of
+    time so that it can be broadcast repeatedly with
+    `SignalDriver.send_frame`.
+
+    :param message: the message to send
+    :type message: str or unicode
+    :param pulse_length: pulse length of the message in microseconds
+    :type pulse_length: int
+    :param repetitions: number of times to broadcast the signal (default 1)
+    :type repetitions: int
+    :param protocol: the protocol version to use (default 1)
+    :type protocol: int
+
+    :returns: bytes; raises `FrameTooLargeError` if the message is longer
+              than the firmware can send
+    """
+    if isinstance(message, unicode):
+        message = codecs.decode(message, 'hex')
+    if len(message) > MAX_MESSAGE:
+        raise FrameTooLargeError(
+            "%d byte message exceeds the %d bytes the firmware can send"
+            % (len(message), MAX_MESSAGE))
+    return _FRAME_HEADER.pack(protocol, pulse_length, repetitions,
+                              len(message)) + message
+
+
+def airtime(pulse_length, bit_length, repetitions=1, protocol=1):
+    """
+    Estimates how long broadcasting a signal occupies the radio.
+
+    :param pulse_length: pulse length of the message in microseconds
+    :param bit_length: the number of bits in the message
+    :param repetitions: number of times the signal is broadcast
+    :param protocol: the rc-switch protocol
+    :returns: seconds (float)
+    """
+    sync, per_bit = RC_SWITCH_PROTOCOLS.get(protocol, (0, 0))
+    return (sync + per_bit * bit_length) * pulse_length * repetitions / 1e6
+
+
+def frame_airtime(frame):
+    """
+    Estimates how long broadcasting a frame compiled by `compile_frame`
+    occupies the radio.
+
+    :returns: seconds (float)
+    """
+    protocol, pulse_length, repetitions, length = \
+        _FRAME_HEADER.unpack_from(frame)
+    return airtime(pulse_length, length * 8, repetitions, protocol)
+
+
 class SignalDriver(object):
 
-    def __init__(self, adapter):
+    def __init__(self, adapter, protocol_version=None, name='default'):
         """
         Connects to an external device via an adapter and creates a new signal
         driver instance.
 
         :param adapter: the `Adapter` instance to connect through.
         :type adapter: `Adapter`
+        :param protocol_version: protocol version to use for transmissions
+                                 (negotiated with the device if unspecified)
+        :type protocol_version: int
+        :param name: the name of the device, for metrics
         """
         self.adapter = adapter
+        self.name = name
         self.adapter.initialize()
+        self._reader = BufferedReader(adapter)
+        self._forced_version = protocol_version
+        self.protocol_version = protocol_version
+        self._sequence = 0
 
         # Ensure the adapter is cleaned up properly on termination.
-        signal.signal(signal.SIGINT, self._signal_close)
-        signal.signal(signal.SIGTERM, self._signal_close)
+        _DRIVERS.append(self)
+        signal.signal(signal.SIGINT, _close_drivers)
+        signal.signal(signal.SIGTERM, _close_drivers)
 
     def reconnect(self):
         """
         Resets the underlying adapter to reset the external device and
         connection.
         """
-        self.adapter.reset()
+        RECONNECTS.inc((self.name,))
+        self.adapter.reset(wait=False)
+        self._reader.clear()
+        self.protocol_version = self._forced_version
+        self.wait_ready()
+
+    def wait_ready(self, timeout=_READY_TIMEOUT):
+        """
+        Probes the device until its firmware answers, waiting longer for each
+        successive probe, so that a reset takes only as long as the device
+        actually needs to boot.
+
+        Any response shows the firmware is running; firmware predating PING
+        answers BAD_HEADER once it has gathered enough probe bytes.
+
+        :param timeout: seconds to wait for the device
+        :returns: seconds waited; raises `DeviceNotReadyError` on timeout
+        """
+        start = time.time()
+        wait = _PROBE_WAIT_MIN
+        try:
+            while True:
+                self.adapter.set_timeout(wait)
+                self.adapter.write(_PING)
+                self.adapter.flush()
+                resp = self._reader.read()
+                if resp:
+                    break
+                if time.time() - start >= timeout:
+                    raise DeviceNotReadyError(
+                        "no response %.1fs after reset" % timeout)
+                wait = min(wait * 2, _PROBE_WAIT_MAX)
+
+            # Discard any answers to earlier probes that are still arriving
+            # (or, from older firmware, complaints about leftover probe bytes
+            # once its read times out).
+            self.adapter.set_timeout(
+                _PROBE_WAIT_MIN if resp == _HELLO else 1.5)
+            while self._reader.read():
+                pass
+        finally:
+            self.adapter.set_timeout(None)
+        self._reader.clear()
+        LOG.info("Device ready %.2fs after reset" % (time.time() - start))
+        return time.time() - start
 
     def _signal_close(self, signum, frame):
         self.adapter.close()
@@ -110,18 +323,23 @@ class SignalDriver(object):
         :returns: none; raises error on assertion failure
         """
         if not actual:
-            actual = self.adapter.read()
+            actual = self._reader.read()
         if actual != expected:
             raise BadResponseError(actual, expected)
 
-    def _read_2byte_int(self):
+    def _read_struct(self, fmt):
         """
-        Reads a two-byte integer from the serial interface
-        (i.e. short on most desktop systems)
+        Reads a fixed-size structure from the serial interface.
+
+        :param fmt: the structure to read
+        :type fmt: `struct.Struct`
 
-        :returns: int
+        :returns: tuple; raises error if the device stops responding
         """
-        return struct.unpack('<H', self.adapter.read(2))
+        values = self._reader.unpack(fmt)
+        if values is None:
+            raise ResponseTimeout("timed out awaiting %d bytes" % fmt.size)
+        return values
 
     def _write_as_2bytes(self, x):
         """
@@ -133,17 +351,192 @@ class SignalDriver(object):
         """
         if isinstance(x, str):
             x = ord(x)
-        self.adapter.write(struct.pack("<H", x))
+        self.adapter.write(_SHORT.pack(x))
 
     def _perform_handshake(self):
         """
         Performs the handshake with the serial device to initializes
         accepting incoming commands.
         """
-        self.adapter.write(_PROTOCOL_HEADER)
-        self.adapter.write(_PROTOCOL_VERSION)
+        with DEVICE_TIME.timer((self.name, 'handshake')):
+            self.adapter.write(_PROTOCOL_HEADER)
+            self.adapter.write(_PROTOCOL_VERSION)
+            self.adapter.flush()
+            self._assert_response(_HELLO)
+
+    def probe(self):
+        """
+        Checks that the device is responsive with a handshake carrying no
+        instruction, which firmware of every version answers and which
+        leaves it idle again.
+
+        :returns: none; raises error if the device does not respond
+        """
+        with DEVICE_TIME.timer((self.name, 'probe')):
+            self.adapter.write(_HANDSHAKE + _PING)
+            self.adapter.flush()
+            self._assert_response(_HELLO)
+            self._assert_response(_UNKNOWN_OP_CODE)
+            self._assert_response(_GOODBYE)
+
+    def _negotiate(self):
+        """
+        Asks the device for protocol v1, falling back to v0 if its firmware
+        answers WRONG_VERSION.
+        """
+        with DEVICE_TIME.timer((self.name, 'handshake')):
+            self.adapter.write(_PROTOCOL_HEADER + _PROTOCOL_VERSION_FRAMED)
+            self.adapter.flush()
+            resp = self._reader.read()
+        if resp == _HELLO:
+            self.protocol_version = 1
+        elif resp == _WRONG_VERSION:
+            LOG.info("Device does not support protocol v1; falling back to v0")
+            self.protocol_version = 0
+        else:
+            raise BadResponseError(resp, _HELLO)
+
+    def _framed(self):
+        if self.protocol_version is None:
+            self._negotiate()
+        return self.protocol_version == 1
+
+    def _write_framed(self, sequence, instruction, payload):
+        fields = _FRAME_FIELDS.pack(sequence, ord(instruction), len(payload))
+        self.adapter.write(_FRAME_START + fields + payload +
+                           bytes(bytearray([crc8(fields + payload)])))
+
+    def _read_framed(self):
+        """
+        Reads the next intact response frame, skipping stray bytes and
+        discarding corrupt frames.
+
+        :returns: (sequence, response), or None if the device timed out
+        """
+        while True:
+            resp = self._reader.read()
+            if not resp:
+                return None
+            if resp != _FRAME_START:
+                continue
+            fields = self._reader.unpack(_FRAME_FIELDS)
+            if fields is None:
+                return None
+            sequence, response, length = fields
+            payload = self._reader.read(length)
+            checksum = self._reader.read()
+            if not checksum:
+                return None
+            if crc8(_FRAME_FIELDS.pack(*fields) + payload) != ord(checksum):
+                LOG.warning("Discarding corrupt response frame")
+                continue
+            return sequence, bytes(bytearray([response]))
+
+    def _send_framed(self, frames):
+        """
+        Pipelines WRITE_433 frames to the device, keeping as many in flight
+        as its receive buffer can hold, and matches acknowledgements to them
+        by sequence number. Frames the device reports as corrupt, or that go
+        unacknowledged, are retransmitted.
+
+        :param frames: the signals as compiled by `compile_frame`
+        :type frames: list of bytes
+        """
+        queue = deque((frame, 0) for frame in frames)
+        in_flight = OrderedDict()  # sequence -> (frame, attempts)
+        while queue or in_flight:
+            in_flight_bytes = sum(len(frame) + 5
+                                  for frame, _ in in_flight.values())
+            write_start = time.time()
+            while queue and (not in_flight or in_flight_bytes +
+                             len(queue[0][0]) + 5 <= _FRAMED_WINDOW):
+                frame, attempts = queue.popleft()
+                if attempts > _FRAMED_RETRIES:
+                    raise ResponseTimeout("frame not acknowledged after %d "
+                                          "attempts" % attempts)
+                self._sequence = (self._sequence + 1) & 0xFF
+                self._write_framed(self._sequence, _WRITE_433, frame)
+                in_flight[self._sequence] = (frame, attempts + 1)
+                in_flight_bytes += len(frame) + 5
+            self.adapter.flush()
+            DEVICE_TIME.observe(time.time() - write_start,
+                                (self.name, 'write'))
+
+            with DEVICE_TIME.timer((self.name, 'ack')):
+                ack = self._read_framed()
+            if ack is None:
+                # Everything still in flight was lost.
+                LOG.warning("Retransmitting %d unacknowledged frame(s)"
+                            % len(in_flight))
+                RETRANSMITS.inc((self.name, 'timeout'), len(in_flight))
+                queue.extendleft(reversed(list(in_flight.values())))
+                in_flight.clear()
+                continue
+            sequence, response = ack
+            if sequence not in in_flight:
+                continue  # Late acknowledgement of a retransmitted frame.
+            frame, attempts = in_flight.pop(sequence)
+            if response == _BAD_FRAME:
+                LOG.warning("Device received a corrupt frame; retransmitting")
+                RETRANSMITS.inc((self.name, 'bad_frame'))
+                queue.appendleft((frame, attempts))
+            elif response != _GOODBYE:
+                raise BadResponseError(response, _GOODBYE)
+
+    def send_frame(self, frame):
+        """
+        Instructs the serial device to broadcast a precompiled signal, writing
+        the handshake (or v1 frame header), instruction and payload in a
+        single buffered call.
+
+        :param frame: the signal as compiled by `compile_frame`
+        :type frame: bytes
+        """
+        if self._framed():
+            self._send_framed([frame])
+            return
+        with DEVICE_TIME.timer((self.name, 'write')):
+            self.adapter.write(_HANDSHAKE + _WRITE_433 + frame)
+            self.adapter.flush()
+        with DEVICE_TIME.timer((self.name, 'handshake')):
+            self._assert_response(_HELLO)
+        with DEVICE_TIME.timer((self.name, 'ack')):
+            self._assert_response(_AWAITING_DATA)
+            self._assert_response(_GOODBYE)
+
+    def send_frames(self, frames):
+        """
+        Instructs the serial device to broadcast several precompiled signals,
+        one after another, within a single session.
+
+        With protocol v1 the frames are pipelined instead. Otherwise this falls
+        back to one session per signal if the device's firmware does not
+        support batches.
+
+        :param frames: the signals as compiled by `compile_frame`
+        :type frames: list of bytes
+        """
+        if self._framed():
+            self._send_framed(frames)
+            return
+        self.adapter.write(_HANDSHAKE + _WRITE_433_BATCH)
         self.adapter.flush()
         self._assert_response(_HELLO)
+        resp = self._reader.read()
+        if resp == _UNKNOWN_OP_CODE:
+            self._assert_response(_GOODBYE)
+            LOG.warning("Device does not support batches; sending %d signals "
+                        "individually" % len(frames))
+            for frame in frames:
+                self.send_frame(frame)
+            return
+        self._assert_response(_AWAITING_DATA, actual=resp)
+
+        self._write_as_2bytes(len(frames))
+        for frame in frames:
+            self._assert_response(_AWAITING_DATA)
+            self.adapter.write(frame)
+        self._assert_response(_GOODBYE)
 
     def send_signal(self, message, pulse_length, repetitions=1, protocol=1):
         """
@@ -159,29 +552,34 @@ class SignalDriver(object):
         :param protocol: the protocol version to use (default 1)
         :type protocol: int
         """
-        self._perform_handshake()
-        self.adapter.write(_WRITE_433)
-        self.adapter.flush()
-        self._assert_response(_AWAITING_DATA)
+        self.send_frame(
+            compile_frame(message, pulse_length, repetitions, protocol))
 
-        # Send the message definition payload.
-        self._write_as_2bytes(protocol)
-        self._write_as_2bytes(pulse_length)
-        self._write_as_2bytes(repetitions)
-        if isinstance(message, unicode):
-            message = codecs.decode(message, 'hex')
-        self._write_as_2bytes(len(message))
-        self.adapter.write(message)
-        self._assert_response(_GOODBYE)
+    def send_signals(self, signals):
+        """
+        Instructs the serial device to broadcast several 433MHz signals, one
+        after another, within a single session.
+
+        :param signals: the `send_signal` arguments of each signal, i.e.
+                        (message, pulse_length[, repetitions[, protocol]])
+        :type signals: list of tuple
+        """
+        self.send_frames([compile_frame(*signal_args)
+                          for signal_args in signals])
 
     def read_signals(self, message_num, radio_timeout=10000):
         """
         Reads a specified number of captured 433MHz broadcasts within a certain
         timeout.
 
-        :param message_num: the number of messages to capture
+        The capture is started before this returns, and ends early (without
+        error) if `stop_reading` is called from another thread.
+
+        :param message_num: the number of messages to capture (0 to capture
+                            until stopped)
         :type message_num: int
         :param radio_timeout: the number of milliseconds to wait before timeout
+                              (0 to wait indefinitely)
         :type radio_timeout: int
 
         :returns: generator of Signal
@@ -194,20 +592,33 @@ class SignalDriver(object):
         # Send desired spec.
         self._write_as_2bytes(message_num)
         self._write_as_2bytes(radio_timeout)
-
-        # Begin reading message data.
-        for _ in range(message_num):
-            while True:
-                resp = self.adapter.read()
-                if resp == _HEARTBEAT:
-                    continue
-                if resp == _RADIO_TIMEOUT:
-                    raise RadioTimeout(radio_timeout)
-                self._assert_response(_INCOMING_DATA, actual=resp)
-                break
-            protocol = self._read_2byte_int()[0]
-            delay = self._read_2byte_int()[0]
-            size = self._read_2byte_int()[0]
-            message = self.adapter.read(size)
+        self.adapter.flush()
+        return self._read_captures(message_num, radio_timeout)
+
+    def _read_captures(self, message_num, radio_timeout):
+        received = 0
+        while not message_num or received < message_num:
+            self._reader.skip(_HEARTBEAT)
+            resp = self._reader.read()
+            if resp == _GOODBYE:
+                return  # Stopped early
+            if resp == _RADIO_TIMEOUT:
+                raise RadioTimeout(radio_timeout)
+            self._assert_response(_INCOMING_DATA, actual=resp)
+            protocol, delay, size = self._read_struct(_SIGNAL_HEADER)
+            message = self._reader.read(size)
+            if len(message) < size:
+                raise ResponseTimeout("timed out awaiting %d byte signal, "
+                                      "got %d" % (size, len(message)))
+            received += 1
             yield Signal(protocol, delay, codecs.encode(message, 'hex'))
         self._assert_response(_GOODBYE)
+
+    def stop_reading(self):
+        """
+        Ends a capture started by `read_signals`, so that the device can be
+        used for something else. Safe to call from a thread other than the
+        one reading.
+        """
+        self.adapter.write(_STOP_READ)
+        self.adapter.flush()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import logging
+from Queue import Full, Queue
+from threading import Lock, Thread
+import time
+from urllib2 import Request, urlopen
+
+
+log = logging.getLogger(__name__)
+
+
+class EventBridge(object):
+
+    def __init__(self, config, submit, window=0.5, workers=2, max_queue=64,
+                 webhook_timeout=5):
+        """
+        Turns received signals into button press events and dispatches them
+        to the actions configured for them.
+
+        Remotes repeat a code for as long as a button is held, so a code only
+        raises an event when it has not been received within the debounce
+        window; the first frame of a press is acted on immediately, and the
+        repeats are dropped. Codes are mapped back to the switch operations
+        they belong to. Actions run on a small pool of worker threads behind
+        a bounded queue, so that slow webhooks never hold up receiving and a
+        burst of presses cannot flood them.
+
+        :param config: the switch config
+        :type config: `SwitchConfig`
+        :param submit: callable queueing a list of (switch_id, op) commands
+                       for transmission, returning a future for each
+        :param window: seconds within which repeats of a code are dropped
+        :type window: float
+        :param workers: the number of threads performing actions
+        :type workers: int
+        :param max_queue: the number of actions allowed to wait before new
+                          ones are dropped
+        :type max_queue: int
+        :param webhook_timeout: seconds to wait for webhooks to respond
+        :type webhook_timeout: float
+        """
+        self.submit = submit
+        self.window = window
+        self.webhook_timeout = webhook_timeout
+        self._last_seen = {}
+        self._lock = Lock()
+        self._queue = Queue(max_queue)
+        self.reload(config)
+        for i in range(workers):
+            worker = Thread(target=self._run, name='lights433-events-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def reload(self, config):
+        """
+        Rebuilds the code -> switch operation and event -> action indices.
+        """
+        codes = {}
+        for switch_id, conf in config.switches.items():
+            for op in ('on', 'off'):
+                codes[conf['%s_signal' % op].lower()] = (switch_id, op)
+        rules = {}
+        for match, action in config.events:
+            rules.setdefault(match, []).append(action)
+        self._index = (codes, rules, config.scenes)
+
+    def _debounce(self, code, now):
+        with self._lock:
+            last = self._last_seen.get(code)
+            self._last_seen[code] = now
+            if len(self._last_seen) > 1024:
+                # Forget codes (i.e. noise) not seen in a while.
+                self._last_seen = dict(
+                    (c, t) for c, t in self._last_seen.items()
+                    if now - t < self.window)
+        return last is not None and now - last < self.window
+
+    def on_signal(self, signal):
+        """
+        Raises an event for a received signal, unless it repeats one already
+        raised.
+
+        :param signal: the received signal
+        :type signal: `Signal`
+        """
+        now = time.time()
+        code = signal.message.lower()
+        if self._debounce(code, now):
+            return
+        codes, rules, scenes = self._index
+        switch_id, op = codes.get(code, (None, None))
+        event = dict(time=now, code=code, protocol=signal.protocol,
+                     pulse_length=signal.pulse_length, switch=switch_id,
+                     op=op)
+        actions = rules.get(('code', code), []) + \
+            rules.get(('switch', switch_id, op), [])
+        for action in actions:
+            try:
+                self._queue.put_nowait((action, event, scenes))
+            except Full:
+                log.warning("Too many pending event actions; dropping [%s] "
+                            "for code [%s]" % (action[0], code))
+
+    def _perform(self, action, event, scenes):
+        kind = action[0]
+        if kind == 'webhook':
+            request = Request(action[1], json.dumps(event),
+                              {'Content-Type': 'application/json'})
+            urlopen(request, timeout=self.webhook_timeout).close()
+            return
+        if kind == 'switch':
+            commands = [action[1:]]
+        else:
+            commands = scenes[action[1]]
+        for future in self.submit(commands):
+            future.result()
+
+    def _run(self):
+        while True:
+            action, event, scenes = self._queue.get()
+            try:
+                self._perform(action, event, scenes)
+            except Exception:
+                log.exception("Event action [%s] failed for code [%s]"
+                              % (action[0], event['code']))
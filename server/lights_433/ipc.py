@@ -0,0 +1,644 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import codecs
+import errno
+import json
+import logging
+import math
+import os
+import signal
+import socket
+from SocketServer import (BaseRequestHandler, ThreadingMixIn,
+                          UnixStreamServer)
+import struct
+from threading import Event, Lock, Thread
+import time
+
+from .driver import DeviceCommError, Signal
+from .metrics import render as render_metrics
+from .server import ALREADY_SENT, UnknownSwitchError
+from .sniffer import Capture
+from .transmitter import (DeviceUnavailableError, INTERACTIVE,
+                          QueueFullError, TransmitFuture)
+
+
+log = logging.getLogger(__name__)
+
+# Messages between HTTP workers and the device owner, in either direction:
+#
+#   <type><request ID><payload length><payload>
+#
+# Requests are numbered by the worker, and the owner's replies carry the
+# number of the request they answer, so that a worker's threads can share a
+# single connection and be answered out of order.
+_HEADER = struct.Struct('<BHI')  # type, request ID, payload length
+
+# Requests
+_SUBMIT = 1
+_STATES = 2
+_STATUS = 3
+_METRICS = 4
+_SIGNALS = 5
+_INFO = 6
+_SCHEDULES = 7
+
+# Replies
+_QUEUED = 0x81  # the commands of a SUBMIT were queued
+_DONE = 0x82  # the commands of a SUBMIT were sent (or failed)
+_ERROR = 0x83
+_RESULT = 0x84  # JSON result of any other request
+
+# Sent by the owner unprompted (with request ID 0), on connecting and after
+# each reload, with the version of its config: a JSON list of an ID of the
+# owner process and the number of times it has reloaded. Workers reload
+# their own config whenever it changes.
+_RELOADED = 0x85
+
+# SUBMIT payloads are binary, as they are sent for every switch command:
+#
+#   <priority><flags><owner length><command count><owner>
+#   (<op><switch ID length><switch ID>)...
+#
+# answered with QUEUED (one byte per command, set if it was skipped) and
+# then DONE (per command, the length of its encoded error, and the error;
+# empty if it was sent).
+_SUBMIT_FIELDS = struct.Struct('<BBBH')
+_COMMAND_FIELDS = struct.Struct('<BB')  # op, switch ID length
+_OUTCOME_LENGTH = struct.Struct('<H')
+_FORCE = 0x01
+_OPS = ('off', 'on')
+
+# Errors
+_QUEUE_FULL = 1
+_UNAVAILABLE = 2  # followed by the seconds to retry after
+_COMM_ERROR = 3
+_FAILED = 4
+_UNKNOWN_SWITCH = 5  # followed by the switch ID
+_RETRY_AFTER = struct.Struct('<H')
+
+# Seconds to wait for the owner to answer a request (or, for SUBMIT, to
+# queue its commands), and between checks for requests it has not answered.
+_CALL_TIMEOUT = 10
+_EXPIRY_INTERVAL = 1
+
+
+class OwnerUnavailableError(DeviceCommError):
+    """
+    Raised when the device owner process cannot be reached.
+    """
+    pass
+
+
+def _unpack_text(fields, payload, offset):
+    value, length = fields.unpack_from(payload, offset)
+    offset += fields.size
+    return value, payload[offset:offset + length].decode('utf-8'), \
+        offset + length
+
+
+def _encode_error(error):
+    if isinstance(error, QueueFullError):
+        return bytes(bytearray([_QUEUE_FULL])) + unicode(error).encode('utf-8')
+    if isinstance(error, DeviceUnavailableError):
+        return bytes(bytearray([_UNAVAILABLE])) + \
+            _RETRY_AFTER.pack(int(math.ceil(error.retry_after))) + \
+            error.device.encode('utf-8')
+    if isinstance(error, UnknownSwitchError):
+        return bytes(bytearray([_UNKNOWN_SWITCH])) + \
+            unicode(error).encode('utf-8')
+    kind = _COMM_ERROR if isinstance(error, DeviceCommError) else _FAILED
+    return bytes(bytearray([kind])) + unicode(error).encode('utf-8')
+
+
+def _decode_error(payload):
+    kind, detail = ord(payload[0:1]), payload[1:]
+    if kind == _QUEUE_FULL:
+        return QueueFullError(detail.decode('utf-8'))
+    if kind == _UNAVAILABLE:
+        retry_after, = _RETRY_AFTER.unpack_from(detail)
+        return DeviceUnavailableError(
+            detail[_RETRY_AFTER.size:].decode('utf-8'), retry_after)
+    if kind == _COMM_ERROR:
+        return DeviceCommError(detail.decode('utf-8'))
+    if kind == _UNKNOWN_SWITCH:
+        return UnknownSwitchError(detail.decode('utf-8'))
+    return OwnerUnavailableError("the device owner failed: %s"
+                                 % detail.decode('utf-8'))
+
+
+class OwnerClient(object):
+
+    def __init__(self, path):
+        """
+        Forwards switch commands and queries to the device owner process over
+        its Unix socket.
+
+        Each process opens a single connection, shared by all its threads,
+        on first use (and again after a fork or once the owner restarts).
+        Replies are read by a dedicated thread, which hands them to the
+        threads waiting on them and times out requests left unanswered.
+
+        :param path: the path of the owner's socket
+        """
+        self.path = path
+        self._lock = Lock()
+        self._sock = None
+        self._pid = None
+        self._next_id = 0
+        self._handlers = {}
+        # The owner's config version, and a callable to pass new ones to.
+        self.config_version = None
+        self.on_reload = None
+
+    def _connect(self):
+        # Called with the lock held.
+        if self._sock is not None and self._pid == os.getpid():
+            return self._sock
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error as e:
+            sock.close()
+            raise OwnerUnavailableError("cannot reach the device owner at "
+                                        "[%s]: %s" % (self.path, e))
+        sock.settimeout(_EXPIRY_INTERVAL)
+        self._sock, self._pid, self._handlers = sock, os.getpid(), {}
+        reader = Thread(target=self._read, args=(sock,),
+                        name='lights433-owner-client')
+        reader.daemon = True
+        reader.start()
+        return sock
+
+    def _read(self, sock):
+        buffered, checked = b'', time.time()
+        try:
+            while True:
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    data = None
+                else:
+                    if not data:
+                        break
+                    buffered += data
+                while len(buffered) >= _HEADER.size:
+                    kind, request_id, length = _HEADER.unpack_from(buffered)
+                    end = _HEADER.size + length
+                    if len(buffered) < end:
+                        break
+                    self._dispatch(request_id, kind,
+                                   buffered[_HEADER.size:end])
+                    buffered = buffered[end:]
+                if time.time() - checked >= _EXPIRY_INTERVAL:
+                    checked = time.time()
+                    self._expire(checked)
+        except socket.error:
+            pass
+        with self._lock:
+            if self._sock is not sock:
+                return
+            self._sock, handlers = None, self._handlers.values()
+        sock.close()
+        log.warning("Lost the connection to the device owner")
+        error = OwnerUnavailableError("lost the connection to the device "
+                                      "owner")
+        for handler, _ in handlers:
+            handler(_ERROR, error)
+        if self.on_reload is not None:
+            # Reconnected to straight away rather than on the next request,
+            # so that the config of a restarted owner is picked up.
+            reconnect = Thread(target=self._reconnect,
+                               name='lights433-owner-reconnect')
+            reconnect.daemon = True
+            reconnect.start()
+
+    def _reconnect(self):
+        while True:
+            time.sleep(_EXPIRY_INTERVAL)
+            with self._lock:
+                try:
+                    self._connect()
+                    return
+                except OwnerUnavailableError:
+                    pass
+
+    def _dispatch(self, request_id, kind, payload):
+        if kind == _RELOADED:
+            self.config_version = json.loads(payload.decode('utf-8'))
+            if self.on_reload is not None:
+                self.on_reload(self.config_version)
+            return
+        with self._lock:
+            handler, _ = self._handlers.get(request_id, (None, None))
+            if handler is not None:
+                # Answered, so no longer subject to the timeout.
+                self._handlers[request_id] = (handler, None)
+        if handler is not None and handler(kind, payload):
+            with self._lock:
+                self._handlers.pop(request_id, None)
+
+    def _expire(self, now):
+        with self._lock:
+            expired = [request_id
+                       for request_id, (_, deadline) in self._handlers.items()
+                       if deadline is not None and deadline <= now]
+            handlers = [self._handlers.pop(request_id)[0]
+                        for request_id in expired]
+        error = OwnerUnavailableError("the device owner did not answer "
+                                      "within %ds" % _CALL_TIMEOUT)
+        for handler in handlers:
+            handler(_ERROR, error)
+
+    def _request(self, kind, payload, handler, timeout=_CALL_TIMEOUT):
+        """
+        Sends a request, with `handler(reply type, payload)` called from the
+        reader thread with each reply until it returns True. Should the
+        connection be lost, or the request go unanswered for `timeout`
+        seconds, it is called with ERROR and the exception instead.
+        """
+        with self._lock:
+            sock = self._connect()
+            # Numbered from 1, as 0 is left for messages from the owner.
+            request_id = self._next_id = self._next_id % 0xFFFF + 1
+            self._handlers[request_id] = (handler, time.time() + timeout)
+            try:
+                sock.sendall(_HEADER.pack(kind, request_id, len(payload)) +
+                             payload)
+            except socket.error as e:
+                del self._handlers[request_id]
+                raise OwnerUnavailableError(
+                    "failed to reach the device owner: %s" % e)
+
+    def call(self, kind, request=None, timeout=_CALL_TIMEOUT):
+        """
+        Sends a request and waits for its JSON result.
+        """
+        reply = []
+        done = Event()
+
+        def handle(kind, payload):
+            reply.append((kind, payload))
+            done.set()
+            return True
+
+        self._request(kind, json.dumps(request).encode('utf-8'), handle,
+                      timeout)
+        # The reader thread enforces the timeout; waiting without one is
+        # far more responsive under Python 2.
+        done.wait()
+        kind, payload = reply[0]
+        if kind == _ERROR:
+            raise payload if isinstance(payload, Exception) \
+                else _decode_error(payload)
+        return json.loads(payload.decode('utf-8'))
+
+    def submit(self, commands, priority=INTERACTIVE, owner=None,
+               force=False):
+        """
+        Queues switch commands with the owner.
+
+        :param commands: (switch_id, op) pairs
+        :returns: (list of `TransmitFuture`, list of whether each command
+                  was skipped)
+        """
+        owner = (owner or '').encode('utf-8')
+        payload = [_SUBMIT_FIELDS.pack(priority, _FORCE if force else 0,
+                                       len(owner), len(commands)), owner]
+        for switch_id, op in commands:
+            switch_id = switch_id.encode('utf-8')
+            payload.append(_COMMAND_FIELDS.pack(_OPS.index(op),
+                                                len(switch_id)))
+            payload.append(switch_id)
+
+        futures = [TransmitFuture() for _ in commands]
+        queued, skipped, errors = Event(), [], []
+
+        def handle(kind, payload):
+            if kind == _QUEUED:
+                skipped.extend(bool(flag) for flag in bytearray(payload))
+                queued.set()
+                return False
+            if kind == _DONE:
+                offset = 0
+                for future in futures:
+                    length, = _OUTCOME_LENGTH.unpack_from(payload, offset)
+                    offset += _OUTCOME_LENGTH.size + length
+                    future.set_result(_decode_error(
+                        payload[offset - length:offset]) if length else None)
+                return True
+            error = payload if isinstance(payload, Exception) \
+                else _decode_error(payload)
+            errors.append(error)
+            queued.set()
+            for future in futures:
+                future.set_result(error)
+            return True
+
+        self._request(_SUBMIT, b''.join(payload), handle)
+        queued.wait()
+        if errors:
+            raise errors[0]
+        return futures, skipped
+
+    def info(self):
+        """
+        :returns: dict of the owner's setup (i.e. whether it is receiving)
+        """
+        return self.call(_INFO)
+
+    def status(self):
+        """
+        :returns: the health of each of the owner's devices
+        """
+        return self.call(_STATUS)
+
+    def metrics(self):
+        """
+        :returns: the owner's metrics in the Prometheus text format
+        """
+        return self.call(_METRICS)
+
+
+class RemoteStates(object):
+    """
+    The owner's `SwitchStates`, as far as HTTP workers need them.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, switch_id):
+        return self.client.call(_STATES, [switch_id])[switch_id]
+
+    def retain(self, switch_ids):
+        pass  # The owner forgets states on its own reloads.
+
+
+class RemoteSignals(object):
+    """
+    The owner's `SignalRing`, as far as HTTP workers need it.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def _since(self, sequence, timeout=0):
+        result = self.client.call(_SIGNALS,
+                                  dict(since=sequence, timeout=timeout),
+                                  timeout + _CALL_TIMEOUT)
+        captures = [Capture(sequence, time, Signal(*signal))
+                    for sequence, time, signal in result['captures']]
+        return result['sequence'], captures
+
+    @property
+    def sequence(self):
+        return self._since(None)[0]
+
+    def since(self, sequence):
+        return self._since(sequence)[1]
+
+    def wait(self, sequence, timeout=None):
+        # Waits are bounded so that the owner's threads are not held by
+        # workers that have gone away.
+        return self._since(sequence, min(timeout or 60, 60))[1]
+
+
+class RemoteScheduler(object):
+    """
+    The owner's `Scheduler`, as far as HTTP workers need it.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def status(self):
+        return self.client.call(_SCHEDULES, dict(vacation=None))
+
+    def set_vacation(self, enabled):
+        self.client.call(_SCHEDULES, dict(vacation=enabled))
+
+    def reload(self, config):
+        pass  # The owner reloads its schedules on its own reloads.
+
+
+class _Connection(BaseRequestHandler):
+
+    def setup(self):
+        self._write_lock = Lock()
+        self.server.owner.connected(self)
+
+    def finish(self):
+        self.server.owner.disconnected(self)
+
+    def reply(self, kind, request_id, payload):
+        with self._write_lock:
+            try:
+                self.request.sendall(
+                    _HEADER.pack(kind, request_id, len(payload)) + payload)
+            except socket.error:
+                log.debug("Failed to reply to a worker that has gone away")
+
+    def handle(self):
+        stream = self.request.makefile('rb')
+        while True:
+            header = stream.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            kind, request_id, length = _HEADER.unpack(header)
+            payload = stream.read(length)
+            try:
+                self.server.owner.handle(kind, payload,
+                                         lambda kind, payload, request_id=(
+                                             request_id): self.reply(
+                                                 kind, request_id, payload))
+            except Exception as e:
+                log.exception("Failed to handle a worker request")
+                self.reply(_ERROR, request_id, _encode_error(e))
+
+
+class _OwnerServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class DeviceOwner(object):
+
+    def __init__(self, server, path):
+        """
+        Serves a server's devices to HTTP worker processes (see
+        `Lights433Worker`) over a Unix socket, so that any number of them can
+        handle requests while a single process talks to the devices.
+
+        :param server: the server owning the devices
+        :type server: `Lights433Server`
+        :param path: the path of the socket to listen on; it is only made
+                     accessible to the owner's user, as workers are handed
+                     the secret tokens are signed with
+        """
+        self.server = server
+        self.path = path
+        # Tells the configs of this process apart from a previous one's.
+        self._instance = codecs.encode(os.urandom(8), 'hex').decode('ascii')
+        self._version = 0
+        self._connections = set()
+        self._connections_lock = Lock()
+        server.reload_listeners.append(self._reloaded)
+
+    def _config_version(self):
+        return json.dumps([self._instance, self._version]).encode('utf-8')
+
+    def connected(self, connection):
+        # Versions are sent with the lock held, so that a worker cannot be
+        # sent them out of order.
+        with self._connections_lock:
+            self._connections.add(connection)
+            connection.reply(_RELOADED, 0, self._config_version())
+
+    def disconnected(self, connection):
+        with self._connections_lock:
+            self._connections.discard(connection)
+
+    def _reloaded(self, config):
+        with self._connections_lock:
+            self._version += 1
+            log.info("Telling %d workers to reload" % len(self._connections))
+            for connection in self._connections:
+                connection.reply(_RELOADED, 0, self._config_version())
+
+    def handle(self, kind, payload, reply):
+        """
+        Handles a request from a worker, calling `reply(type, payload)` with
+        each reply.
+        """
+        if kind == _SUBMIT:
+            self._submit(payload, reply)
+            return
+        if kind == _SIGNALS:
+            # Waits for signals, so must not hold up the connection.
+            request = json.loads(payload.decode('utf-8'))
+            waiter = Thread(target=self._signals, args=(request, reply),
+                            name='lights433-owner-signals')
+            waiter.daemon = True
+            waiter.start()
+            return
+        request = json.loads(payload.decode('utf-8'))
+        if kind == _STATES:
+            result = dict((switch_id, self.server.states.get(switch_id))
+                          for switch_id in request)
+        elif kind == _STATUS:
+            result = self.server.pool.status()
+        elif kind == _METRICS:
+            result = render_metrics()
+        elif kind == _INFO:
+            # Workers sign and verify tokens with the owner's secret, so
+            # that tokens are valid whichever worker serves them.
+            auth = dict(self.server.auth_options)
+            auth['secret'] = codecs.encode(auth['secret'], 'hex')
+            result = dict(config=json.loads(self._config_version()),
+                          receiving=self.server.signals is not None,
+                          store=self.server.store and self.server.store.path,
+                          scheduling=self.server.scheduler is not None,
+                          auth=auth)
+        elif kind == _SCHEDULES:
+            scheduler = self.server.scheduler
+            if request['vacation'] is not None:
+                scheduler.set_vacation(request['vacation'])
+            result = scheduler.status()
+        else:
+            raise ValueError("unknown request type %d" % kind)
+        reply(_RESULT, json.dumps(result).encode('utf-8'))
+
+    def _submit(self, payload, reply):
+        priority, flags, owner_length, count = \
+            _SUBMIT_FIELDS.unpack_from(payload)
+        offset = _SUBMIT_FIELDS.size
+        owner = payload[offset:offset + owner_length].decode('utf-8') or None
+        offset += owner_length
+        commands = []
+        for _ in range(count):
+            op, switch_id, offset = _unpack_text(_COMMAND_FIELDS, payload,
+                                                 offset)
+            commands.append((switch_id, _OPS[op]))
+
+        try:
+            futures = self.server.submit(commands, priority=priority,
+                                         owner=owner,
+                                         force=bool(flags & _FORCE))
+        except (UnknownSwitchError, DeviceCommError, DeviceUnavailableError,
+                QueueFullError) as e:
+            reply(_ERROR, _encode_error(e))
+            return
+        reply(_QUEUED, bytes(bytearray(
+            [future is ALREADY_SENT for future in futures])))
+
+        remaining, lock = [len(futures)], Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            outcomes = []
+            for future in futures:
+                error = future.exception()
+                encoded = b'' if error is None else _encode_error(error)
+                outcomes.append(_OUTCOME_LENGTH.pack(len(encoded)) + encoded)
+            reply(_DONE, b''.join(outcomes))
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def _signals(self, request, reply):
+        signals = self.server.signals
+        if signals is None:
+            reply(_ERROR, _encode_error(
+                DeviceCommError("no device is receiving signals")))
+            return
+        if request['since'] is None:
+            captures = []
+        elif request['timeout']:
+            captures = signals.wait(request['since'], request['timeout'])
+        else:
+            captures = signals.since(request['since'])
+        reply(_RESULT, json.dumps(dict(
+            sequence=signals.sequence,
+            captures=[(capture.sequence, capture.time,
+                       list(capture.signal)) for capture in captures]
+        )).encode('utf-8'))
+
+    def serve_forever(self):
+        """
+        Listens on the socket until interrupted or terminated, then closes
+        the devices.
+        """
+        try:
+            os.unlink(self.path)  # Left behind by a previous run
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        # Created only accessible to this user, rather than chmod-ed after,
+        # so that there is no moment at which others may connect.
+        umask = os.umask(0o177)
+        try:
+            listener = _OwnerServer(self.path, _Connection)
+        finally:
+            os.umask(umask)
+        listener.owner = self
+
+        def stop(signum, frame):
+            raise SystemExit(0)
+
+        # In place of the drivers' handlers, which close the devices but
+        # leave the process running.
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        log.info("Serving devices on [%s]" % self.path)
+        try:
+            listener.serve_forever()
+        finally:
+            listener.server_close()
+            os.unlink(self.path)
+            self.server.states.flush()
+            self.server.pool.close()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function, unicode_literals
+
+from collections import namedtuple
+
+import clip
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for learning; see the "learn" extra.
+    np = None
+
+from .adapter import get_adapter, parse_adapter_args
+from .config import SWITCH_DEFAULTS
+from .driver import RadioTimeout, SignalDriver
+
+app = clip.App()
+
+LearnedCode = namedtuple('LearnedCode', ['protocol', 'message', 'count',
+                                         'pulse_lengths'])
+
+
+class NoSignalLearnedError(Exception):
+    pass
+
+
+def cluster_codes(signals, tolerance=0.1, min_share=0.1):
+    """
+    Groups repeated captures of remote control codes, discarding noise.
+
+    Captures are grouped by code. Within each code, pulse lengths are split
+    into clusters wherever consecutive (sorted) lengths differ by more than
+    `tolerance`, and only the largest cluster is kept, so that outliers from
+    misreads do not skew the estimated pulse length.
+
+    :param signals: the captured signals
+    :type signals: list of `Signal`
+    :param tolerance: the relative gap between pulse lengths that separates
+                      clusters
+    :type tolerance: float
+    :param min_share: the smallest share of all captures a code needs to not
+                      be discarded as noise
+    :type min_share: float
+    :returns: list of `LearnedCode`, most frequently captured first
+    """
+    if np is None:
+        raise ImportError("learning requires numpy "
+                          "(pip install lights-433[learn])")
+    if not signals:
+        return []
+    codes = np.array(['%d:%s' % (s.protocol, s.message) for s in signals])
+    pulses = np.array([s.pulse_length for s in signals], dtype=np.float64)
+    keys, code_ids, counts = np.unique(codes, return_inverse=True,
+                                       return_counts=True)
+
+    # Sort by code and then pulse length; a new cluster starts wherever
+    # either changes significantly.
+    order = np.lexsort((pulses, code_ids))
+    code_ids, pulses = code_ids[order], pulses[order]
+    breaks = np.empty(len(pulses), dtype=bool)
+    breaks[0] = True
+    breaks[1:] = (np.diff(code_ids) != 0) | \
+        (np.diff(pulses) > tolerance * pulses[:-1])
+    cluster_ids = np.cumsum(breaks) - 1
+    cluster_sizes = np.bincount(cluster_ids)
+    cluster_code_ids = code_ids[breaks]
+
+    learned = []
+    for code_id in np.argsort(-counts, kind='mergesort'):
+        if counts[code_id] < max(2, min_share * len(signals)):
+            break
+        clusters = np.flatnonzero(cluster_code_ids == code_id)
+        largest = clusters[np.argmax(cluster_sizes[clusters])]
+        protocol, message = keys[code_id].split(':', 1)
+        learned.append(LearnedCode(int(protocol), message,
+                                   int(counts[code_id]),
+                                   pulses[cluster_ids == largest]))
+    return learned
+
+
+def estimate_pulse_length(codes):
+    """
+    Estimates the pulse length of a remote from the captures of all its
+    codes, as the mean of the captures within one standard deviation of the
+    median.
+
+    :param codes: the learned codes of the remote
+    :type codes: list of `LearnedCode`
+    :returns: int
+    """
+    pulses = np.concatenate([code.pulse_lengths for code in codes])
+    median = np.median(pulses)
+    inliers = pulses[np.abs(pulses - median) <= max(np.std(pulses), 1)]
+    return int(round(inliers.mean()))
+
+
+def learn_code(driver, captures, timeout):
+    """
+    Captures a button being pressed repeatedly and learns its code.
+
+    :returns: `LearnedCode`
+    """
+    signals = []
+    try:
+        for signal in driver.read_signals(captures, timeout):
+            signals.append(signal)
+    except RadioTimeout:
+        pass  # Learn from whatever was captured.
+    codes = cluster_codes(signals)
+    if not codes:
+        raise NoSignalLearnedError("no code was captured consistently out "
+                                   "of %d captures" % len(signals))
+    for noise in codes[1:]:
+        clip.echo("Ignoring [%s] captured %d times alongside [%s]"
+                  % (noise.message, noise.count, codes[0].message), err=True)
+    return codes[0]
+
+
+@app.main(description='Learns the codes of a remote controlled switch and '
+                      'prints them as a switches.conf line')
+@clip.arg('adapter', required=True, type=str,
+          help='The adapter to use for interfacing with the controller')
+@clip.opt('--adapter-args', required=False, default='', type=str,
+          help='Comma separated name-value args for the adapter '
+               '(e.g. x=1,y=2,...')
+@clip.opt('--switch-id', default='new_switch', type=str,
+          help='The ID to give the switch')
+@clip.opt('--users', default='', type=str,
+          help='Comma separated users permitted to use the switch')
+@clip.opt('--captures', default=20, type=int,
+          help='The number of captures to take of each button')
+@clip.opt('--timeout', default=10000, type=int,
+          help='Milliseconds to wait for each capture')
+def learn(adapter, adapter_args, switch_id, users, captures, timeout):
+    driver = SignalDriver(
+        get_adapter(adapter)(**parse_adapter_args(adapter_args)))
+    try:
+        codes = []
+        for op in ('on', 'off'):
+            clip.echo("Press and hold the [%s] button..." % op.upper())
+            codes.append(learn_code(driver, captures, timeout))
+            clip.echo("Learned [%s] from %d captures" % (
+                codes[-1].message, codes[-1].count))
+    except NoSignalLearnedError as e:
+        clip.exit("Failed to learn the switch: %s" % e, err=True)
+    finally:
+        driver.adapter.close()
+
+    on, off = codes
+    if on.protocol != off.protocol:
+        clip.echo("The [on] and [off] codes were captured with rc-switch "
+                  "protocols %d and %d; using %d"
+                  % (on.protocol, off.protocol, on.protocol), err=True)
+    options = ''
+    if on.protocol != SWITCH_DEFAULTS['protocol']:
+        options = ':protocol=%d' % on.protocol
+    clip.echo('switch:%s:%s:%s:%d:%s%s' % (
+        switch_id, on.message, off.message, estimate_pulse_length(codes),
+        users, options))
+
+
+def main():
+    try:
+        app.run()
+    except clip.ClipExit:
+        pass
+
+
+if __name__ == '__main__':
+    main()
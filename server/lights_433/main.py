@@ -3,16 +3,16 @@
 
 from __future__ import unicode_literals
 
+from collections import OrderedDict
 import logging
 import os
+import signal
 import sys
+from threading import Thread
 
 import clip
 
-from raven import Client
-from raven.contrib.flask import Sentry
-
-from .adapter import get_adapter
+from .adapter import get_adapter, parse_adapter_args, parse_device_specs
 from .server import Lights433Server
 
 app = clip.App()
@@ -35,15 +35,70 @@ for l in (__name__, 'sentry.errors'):
 @clip.opt('--adapter-args', required=False, default='', type=str,
           help='Comma separated name-value args for the adapter '
                '(e.g. x=1,y=2,...')
+@clip.opt('--devices', required=False, default='', type=str,
+          help='Semicolon separated additional devices, each of the form '
+               'name=adapter[:x=1,y=2,...]')
 @clip.opt('--host', default='127.0.0.1', type=str,
           help='The interface to listen and permit connections on')
 @clip.opt('--port', default=8080, type=int,
           help='The port to run the server on')
 @clip.opt('--switches', default=DEFAULT_SWITCH_CONF, type=str,
           help='Path to the config file for users and signals')
+@clip.opt('--watch', default=0, type=int,
+          help='Seconds between checks of the switch config for changes to '
+               'reload (0 to only reload on SIGHUP)')
+@clip.opt('--sniff', required=False, default=None, type=str,
+          help='A device to keep receiving signals on between '
+               'transmissions, served at /signals and /signals/stream')
+@clip.opt('--stream-port', required=False, default=None, type=int,
+          help='A port to also serve /signals/stream and long polls of '
+               '/signals?wait=<seconds> on, from a single thread for any '
+               'number of clients (requires --sniff)')
+@clip.opt('--signal-store', required=False, default=None, type=str,
+          help='A file to keep every signal received by --sniff in, '
+               'served at /signals/history and /signals/counts')
+@clip.opt('--keepalive', default=30, type=int,
+          help='Seconds a device may be idle before it is probed, and reset '
+               'if unresponsive (0 to never probe)')
+@clip.opt('--state-file', required=False, default=None, type=str,
+          help='A file to persist the last state sent to each switch to')
+@clip.opt('--state-ttl', default=0, type=int,
+          help='Seconds after sending a switch a state during which '
+               'commands for the same state are skipped (0 to never skip)')
+@clip.flag('--no-alexa',
+           help='Do not serve the Alexa skill at /switch_alexa')
+@clip.flag('--alexa-background',
+           help='Answer Alexa once switch commands are queued rather than '
+                'sent')
+@clip.opt('--alexa-notify', required=False, default=None, type=str,
+          help='A URL to POST failed Alexa commands to as JSON')
+@clip.flag('--alexa-multi-target',
+           help='Accept several locations in one Alexa command (i.e. '
+                '"kitchen and hallway")')
+@clip.opt('--auth-cache-ttl', default=300, type=int,
+          help='Seconds for which verified credentials are remembered, '
+               'rather than hashed and verified again')
+@clip.opt('--token-ttl', default=900, type=int,
+          help='The most seconds a token issued at /token may be valid for')
+@clip.opt('--token-secret', required=False, default=None, type=str,
+          help='Path to a file containing the key to sign tokens with, so '
+               'that they remain valid across restarts')
+@clip.flag('--vacation',
+           help='Start in vacation mode, performing the schedules marked '
+                'for it')
+@clip.opt('--owner-socket', required=False, default=None, type=str,
+          help='Serve the devices to WSGI workers (lights_433.worker) on '
+               'this Unix socket instead of serving HTTP')
+@clip.opt('--plugins', default='', type=str,
+          help='Comma separated names of additional plugins to load, as '
+               'registered under the lights_433.plugins entry point')
 @clip.opt('--sentry', required=False, default=None, type=str,
           help='Path to the config file containing the Sentry capture URL')
-def lights433(host, port, adapter, adapter_args, switches, sentry):
+def lights433(host, port, adapter, adapter_args, devices, switches, watch,
+              sniff, stream_port, signal_store, keepalive, state_file,
+              state_ttl, no_alexa, alexa_background, alexa_notify,
+              alexa_multi_target, auth_cache_ttl, token_ttl, token_secret,
+              vacation, owner_socket, plugins, sentry):
 
     sentry_client, sentry_url = None, None
     if sentry or os.path.exists(DEFAULT_SENTRY_CONF):
@@ -54,26 +109,63 @@ def lights433(host, port, adapter, adapter_args, switches, sentry):
             log.error("No sentry URL specified in [%s]" % sentry)
             sys.exit(1)
         else:
+            # Only imported when configured, as it is slow to import.
+            from raven import Client
             sentry_client = Client(sentry_url)
             log.info("Sentry client configured!")
 
+    plugins = OrderedDict((name, {}) for name in plugins.split(',') if name)
+    if not no_alexa:
+        plugins['alexa'] = dict(background=alexa_background,
+                                notify=alexa_notify,
+                                multi_target=alexa_multi_target)
+    if stream_port:
+        if not sniff:
+            log.error("--stream-port requires --sniff")
+            sys.exit(1)
+        plugins['streams'] = dict(host=host, port=stream_port)
+    if sentry_client and not owner_socket:
+        plugins['sentry'] = dict(dsn=sentry_url)
+
+    if token_secret:
+        with open(token_secret, 'rb') as f:
+            token_secret = f.read().strip()
+        if not token_secret:
+            log.error("No token secret in [%s]" % f.name)
+            sys.exit(1)
+
     try:
         log.info("Loading switch configurations from [%s]" % switches)
 
-        adapter_kwargs = dict(
-            pair.split('=') for pair in adapter_args.split(',')
-        )
-
+        adapter_kwargs = parse_adapter_args(adapter_args)
         adapter = get_adapter(adapter)(**adapter_kwargs)
-        server = Lights433Server(host, port, adapter, switches)
+        devices = [(name, get_adapter(device_adapter)(**device_kwargs))
+                   for name, device_adapter, device_kwargs
+                   in parse_device_specs(devices)]
+        server = Lights433Server(host, port, adapter, switches, devices,
+                                 sniff, keepalive=keepalive or None,
+                                 state_file=state_file,
+                                 state_ttl=state_ttl or None,
+                                 signal_store=signal_store,
+                                 auth_cache_ttl=auth_cache_ttl,
+                                 token_ttl=token_ttl,
+                                 token_secret=token_secret or None,
+                                 vacation=vacation, plugins=plugins)
     except:
         if sentry_client:
             sentry_client.captureException()
         raise
 
-    if sentry_client:
-        Sentry(dsn=sentry_url).init_app(server.app)
-    server.run()
+    # Reload off the main thread, which is busy serving requests.
+    signal.signal(signal.SIGHUP,
+                  lambda signum, frame: Thread(target=server.reload).start())
+    if watch > 0:
+        server.watch(watch)
+    if owner_socket:
+        from .ipc import DeviceOwner
+        DeviceOwner(server, owner_socket).serve_forever()
+    else:
+        server.run()
 
 
 def main():
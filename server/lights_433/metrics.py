@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+import time
+
+# Seconds; fine-grained at the low end, where serial round trips fall.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_METRICS = []
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        :param name: the metric name
+        :param documentation: the help text
+        :param labels: the label names, whose values are passed (as a tuple,
+                       in the same order) whenever the metric is updated
+        :type labels: tuple
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+        _METRICS.append(self)
+
+    def _samples(self, labels, value):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.extend(self._samples(labels, value))
+        return lines
+
+
+class Counter(_Metric):
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self, labels, value):
+        return ['%s%s %s' % (self.name,
+                             _format_labels(self.labels, labels),
+                             _format_value(value))]
+
+
+class Histogram(_Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: the upper bounds of the buckets, in ascending order
+                        (+Inf is implied)
+        :type buckets: tuple
+        """
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # Per-bucket counts, then the +Inf bucket, then the sum.
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1)
+                counts.append(0.0)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def timer(self, labels=()):
+        """
+        Observes the time spent in a `with` block.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, labels)
+
+    def _samples(self, labels, counts):
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append('%s_bucket%s %d' % (
+                self.name,
+                _format_labels(self.labels, labels,
+                               'le="%s"' % _format_value(float(bound))),
+                cumulative))
+        label_text = _format_labels(self.labels, labels)
+        samples.append('%s_sum%s %s' % (
+            self.name, label_text, _format_value(counts[-1])))
+        samples.append('%s_count%s %d' % (self.name, label_text, cumulative))
+        return samples
+
+
+def render():
+    """
+    Renders every metric in the Prometheus text exposition format.
+
+    :returns: unicode
+    """
+    lines = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Transmission
+
+QUEUE_WAIT = Histogram(
+    'lights433_queue_wait_seconds',
+    'Time commands wait for a device session to start.', ['device'])
+SESSION_TIME = Histogram(
+    'lights433_session_seconds',
+    'Time spent sending a batch of signals in one device session.',
+    ['device', 'outcome'])
+SIGNALS_SENT = Counter(
+    'lights433_signals_total',
+    'Signals sent to devices.', ['device', 'outcome'])
+COMMAND_TIME = Histogram(
+    'lights433_command_seconds',
+    'Time from a switch command being queued to it being sent.',
+    ['switch', 'outcome'])
+
+# Device communication
+
+DEVICE_TIME = Histogram(
+    'lights433_device_seconds',
+    'Time spent in each phase of talking to a device: the handshake, '
+    'writing payloads, awaiting acknowledgement (including airtime), and '
+    'probing it while idle.',
+    ['device', 'phase'])
+RETRANSMITS = Counter(
+    'lights433_retransmits_total',
+    'Protocol v1 frames retransmitted.', ['device', 'reason'])
+RECONNECTS = Counter(
+    'lights433_reconnects_total',
+    'Device resets after communication failures.', ['device'])
+PROBES = Counter(
+    'lights433_probes_total',
+    'Health probes of idle devices.', ['device', 'outcome'])
+
+# Alexa
+
+ALEXA_MATCH_TIME = Histogram(
+    'lights433_alexa_match_seconds',
+    'Time spent matching spoken locations to switches.', ['outcome'])
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+# Entry point groups through which packages can provide adapters (classes
+# implementing `Adapter`) and server plugins (callables taking the server and
+# any options as keyword arguments, called once the app is set up; objects
+# they return with a `reload(config)` method are passed each reloaded
+# switch config).
+ADAPTERS = 'lights_433.adapters'
+PLUGINS = 'lights_433.plugins'
+
+# The plugins shipped with lights-433 (also registered as entry points),
+# resolved without scanning the installed packages.
+_BUILTINS = {
+    ADAPTERS: {
+        'record': 'lights_433.adapter.recording:RecordingAdapter',
+        'replay': 'lights_433.adapter.recording:ReplayAdapter',
+        'rpi': 'lights_433.adapter.rpi:RPiAdapter',
+        'sim': 'lights_433.adapter.sim:SimulatedAdapter',
+    },
+    PLUGINS: {
+        'alexa': 'lights_433.alexa:AlexaServer',
+        'sentry': 'lights_433.sentry:SentryPlugin',
+        'streams': 'lights_433.streams:StreamServer',
+    },
+}
+
+
+class NoSuchPluginError(Exception):
+    pass
+
+
+def load(group, name):
+    """
+    Imports a plugin, and only that plugin, by name.
+
+    :param group: the entry point group (`ADAPTERS` or `PLUGINS`)
+    :param name: the name the plugin is registered under
+    :returns: the plugin's class or callable
+    """
+    target = _BUILTINS[group].get(name)
+    if target is not None:
+        module, _, attr = target.partition(':')
+        return getattr(import_module(module), attr)
+    # Slow to import, and so left until a third-party plugin is asked for.
+    import pkg_resources
+    for entry_point in pkg_resources.iter_entry_points(group, name):
+        return entry_point.load()
+    raise NoSuchPluginError("%s [%s]" % (group, name))
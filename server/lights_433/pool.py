@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from functools import partial
+import logging
+import time
+
+from .driver import SignalDriver
+from .transmitter import (DeviceUnavailableError, INTERACTIVE,
+                          QueueFullError, TransmitFuture, Transmitter)
+
+
+log = logging.getLogger(__name__)
+
+
+class UnknownDeviceError(Exception):
+    pass
+
+
+class TransmitterPool(object):
+
+    def __init__(self, adapters, retry_after=30, keepalive=None):
+        """
+        Manages one transmitter (and so one worker thread and one serial
+        session at a time) per device, so that different devices transmit in
+        parallel.
+
+        Commands name every device able to reach their switch, in order of
+        preference. Each is sent through the first of those that has not
+        recently failed, and fails over to the next if it cannot be sent.
+
+        :param adapters: (name, `Adapter`) pairs, in order of preference
+        :type adapters: list of tuple
+        :param retry_after: seconds a failed device is passed over for
+        :type retry_after: int
+        :param keepalive: seconds a device may be idle before it is probed
+                          (never if unspecified)
+        :type keepalive: float
+        """
+        self.transmitters = OrderedDict(
+            (name, Transmitter(SignalDriver(adapter, name=name),
+                               keepalive=keepalive))
+            for name, adapter in adapters)
+        self.retry_after = retry_after
+        self._failed_at = {}
+
+    def devices(self):
+        return list(self.transmitters.keys())
+
+    def _candidates(self, devices):
+        up = [device for device in devices
+              if not self.transmitters[device].retry_after()]
+        if not up:
+            device = min(devices,
+                         key=lambda d: self.transmitters[d].retry_after())
+            raise DeviceUnavailableError(
+                device, self.transmitters[device].retry_after())
+        now = time.time()
+        healthy = [device for device in up
+                   if now - self._failed_at.get(device, 0) >= self.retry_after]
+        return healthy + [device for device in up if device not in healthy]
+
+    def submit_many(self, commands, priority=INTERACTIVE, owner=None):
+        """
+        Queues signals on the devices able to reach them. Signals for the same
+        device are sent in the same device session where possible. Devices
+        known to be down are skipped, and `DeviceUnavailableError` is raised
+        if every device able to reach a signal is. Should a device picked be
+        down or have no room for its signals, its error is raised before
+        anything is queued.
+
+        :param commands: (key, frame, device names) triples
+        :type commands: list of tuple
+        :param priority: the scheduling class (see `Transmitter`)
+        :param owner: who the signals are sent for (i.e. the user)
+        :returns: list of `TransmitFuture`, one per command
+        """
+        by_device = OrderedDict()
+        futures = []
+        for key, frame, devices in commands:
+            for device in devices:
+                if device not in self.transmitters:
+                    raise UnknownDeviceError(device)
+            candidates = self._candidates(devices)
+            future = TransmitFuture()
+            futures.append(future)
+            by_device.setdefault(candidates[0], []).append(
+                (key, frame, candidates[1:], future))
+        for device, jobs in by_device.items():
+            self.transmitters[device].check_available(
+                key for key, _, _, _ in jobs)
+        for device, jobs in by_device.items():
+            try:
+                self._submit(device, jobs, priority, owner)
+            except (DeviceUnavailableError, QueueFullError) as e:
+                # The device went down or filled up since it was checked;
+                # the signals queued on others are left to be sent.
+                for job in jobs:
+                    self._fail_over(device, job, priority, owner, e)
+        return futures
+
+    def _submit(self, device, jobs, priority, owner):
+        device_futures = self.transmitters[device].submit_many(
+            [(key, frame) for key, frame, _, _ in jobs], priority, owner)
+        for device_future, job in zip(device_futures, jobs):
+            device_future.add_done_callback(
+                partial(self._on_done, device, job, priority, owner))
+
+    def _on_done(self, device, job, priority, owner, device_future):
+        future = job[-1]
+        error = device_future.exception()
+        if error is None:
+            self._failed_at.pop(device, None)
+            future.set_result()
+            return
+        self._failed_at[device] = time.time()
+        self._fail_over(device, job, priority, owner, error)
+
+    def _fail_over(self, device, job, priority, owner, error):
+        key, frame, fallbacks, future = job
+        while fallbacks:
+            log.warning("Failed to send [%s] through device [%s]; failing "
+                        "over to [%s]" % (key, device, fallbacks[0]))
+            device, fallbacks = fallbacks[0], fallbacks[1:]
+            try:
+                self._submit(device, [(key, frame, fallbacks, future)],
+                             priority, owner)
+                return
+            except (DeviceUnavailableError, QueueFullError) as e:
+                error = e
+        future.set_result(error)
+
+    def listen(self, device, callback):
+        """
+        Keeps a device receiving whenever it has nothing to transmit.
+
+        :param device: the device name
+        :param callback: called with each `Signal` received
+        """
+        if device not in self.transmitters:
+            raise UnknownDeviceError(device)
+        self.transmitters[device].listen(callback)
+
+    def status(self):
+        """
+        :returns: dict of device name -> health (see `Transmitter.status`)
+        """
+        return OrderedDict((name, transmitter.status())
+                           for name, transmitter in self.transmitters.items())
+
+    def close(self):
+        for transmitter in self.transmitters.values():
+            transmitter.driver.adapter.close()
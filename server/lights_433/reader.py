@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+
+class BufferedReader(object):
+
+    def __init__(self, adapter, compact_at=4096):
+        """
+        Buffers reads from an adapter so that responses can be decoded from
+        memory instead of with a read call per byte.
+
+        Each refill drains everything the adapter has available into a single
+        reusable bytearray, from which fixed-size fields are unpacked in place.
+
+        :param adapter: the `Adapter` to read from
+        :type adapter: `Adapter`
+        :param compact_at: consumed bytes to accumulate before discarding
+                           them from the front of the buffer
+        :type compact_at: int
+        """
+        self.adapter = adapter
+        self._buffer = bytearray()
+        self._pos = 0
+        self._compact_at = compact_at
+
+    def buffered(self):
+        """
+        :returns: the number of bytes buffered but not yet consumed
+        """
+        return len(self._buffer) - self._pos
+
+    def fill(self, size):
+        """
+        Reads from the adapter until at least `size` bytes are buffered.
+
+        :returns: True if they are, False if the adapter timed out first
+        """
+        while self.buffered() < size:
+            if self._pos == len(self._buffer):
+                del self._buffer[:]
+                self._pos = 0
+            elif self._pos >= self._compact_at:
+                del self._buffer[:self._pos]
+                self._pos = 0
+            data = self.adapter.read_available(size - self.buffered())
+            if not data:
+                return False
+            self._buffer += data
+        return True
+
+    def read(self, size=1):
+        """
+        Consumes up to `size` bytes, fewer only if the adapter timed out.
+
+        :returns: bytes
+        """
+        self.fill(size)
+        end = min(self._pos + size, len(self._buffer))
+        data = bytes(self._buffer[self._pos:end])
+        self._pos = end
+        return data
+
+    def unpack(self, fmt):
+        """
+        Consumes and decodes a fixed-size structure without copying it out of
+        the buffer.
+
+        :param fmt: the structure to decode
+        :type fmt: `struct.Struct`
+        :returns: tuple of values, or None if the adapter timed out
+        """
+        if not self.fill(fmt.size):
+            return None
+        values = fmt.unpack_from(self._buffer, self._pos)
+        self._pos += fmt.size
+        return values
+
+    def skip(self, byte):
+        """
+        Consumes any run of the given single-byte response (i.e. heartbeats).
+
+        :param byte: the response to skip
+        :type byte: bytes
+        :returns: the number of bytes skipped
+        """
+        value = ord(byte)
+        skipped = 0
+        while self.fill(1) and self._buffer[self._pos] == value:
+            self._pos += 1
+            skipped += 1
+        return skipped
+
+    def clear(self):
+        """
+        Discards everything buffered (i.e. after the device is reset).
+        """
+        del self._buffer[:]
+        self._pos = 0
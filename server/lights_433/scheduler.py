@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division, unicode_literals
+
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from functools import partial
+import heapq
+import logging
+import math
+import os
+import random
+import select
+from threading import Lock, Thread
+import time
+
+from .transmitter import BULK
+
+
+log = logging.getLogger(__name__)
+
+# Days searched for the next occurrence of a daily schedule, i.e. past polar
+# nights with no sunset.
+_MAX_DAYS_AHEAD = 366
+
+# Julian dates of the UNIX epoch and of 2000-01-01 12:00 UTC, and the
+# ordinal of 2000-01-01.
+_JULIAN_EPOCH = 2440587.5
+_JULIAN_2000 = 2451545.0
+_ORDINAL_2000 = date(2000, 1, 1).toordinal()
+
+
+def sun_times(day, latitude, longitude):
+    """
+    Sunrise and sunset on a day, by the sunrise equation (accurate to a
+    minute or two).
+
+    :param day: the day
+    :type day: `date`
+    :param latitude: degrees north
+    :param longitude: degrees east
+    :returns: (sunrise, sunset) as UNIX times, or None if the sun does not
+              rise or set that day
+    """
+    n = day.toordinal() - _ORDINAL_2000 - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * n) % 360)
+    center = 1.9148 * math.sin(anomaly) + \
+        0.0200 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic = math.radians(
+        (math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = _JULIAN_2000 + n + 0.0053 * math.sin(anomaly) - \
+        0.0069 * math.sin(2 * ecliptic)
+    declination = math.asin(math.sin(ecliptic) *
+                            math.sin(math.radians(23.44)))
+    latitude = math.radians(latitude)
+    cos_hour_angle = (math.sin(math.radians(-0.833)) -
+                      math.sin(latitude) * math.sin(declination)) / \
+        (math.cos(latitude) * math.cos(declination))
+    if abs(cos_hour_angle) > 1:
+        return None
+    half_day = math.degrees(math.acos(cos_hour_angle)) / 360
+    return tuple((julian - _JULIAN_EPOCH) * 24 * 60 * 60
+                 for julian in (transit - half_day, transit + half_day))
+
+
+def _midnight(day, seconds=0):
+    """
+    :returns: the UNIX time of a number of seconds after a day's local
+              midnight (through mktime, so that DST changes are respected)
+    """
+    return time.mktime((datetime.combine(day, datetime.min.time()) +
+                        timedelta(seconds=seconds)).timetuple())
+
+
+def next_due(timing, after, location=None):
+    """
+    :param timing: when the schedule is due
+    :type timing: `Timing`
+    :param after: the UNIX time after which it is next due
+    :param location: (latitude, longitude), for sunrise and sunset
+    :returns: the UNIX time the schedule is next due, before any jitter (see
+              `jittered`), or None if never
+    """
+    if timing.kind == 'every':
+        # Aligned to the interval, so that restarts keep the same times.
+        due = (math.floor(after / timing.value) + 1) * timing.value
+        if timing.days is None:
+            return due
+        for _ in range(_MAX_DAYS_AHEAD + 1):
+            day = datetime.fromtimestamp(due).date()
+            if day.weekday() in timing.days:
+                return due
+            # Skipping to the first interval of the next day.
+            due = math.ceil(_midnight(day + timedelta(days=1)) /
+                            timing.value) * timing.value
+        return None
+
+    # Daily, starting from the day before, as an offset may take a day's
+    # occurrence past midnight.
+    day = datetime.fromtimestamp(after).date() - timedelta(days=1)
+    for _ in range(_MAX_DAYS_AHEAD + 1):
+        if timing.days is None or day.weekday() in timing.days:
+            if timing.kind == 'time':
+                due = _midnight(day, timing.value)
+            else:
+                times = sun_times(day, *location)
+                due = None if times is None else \
+                    times[0 if timing.kind == 'sunrise' else 1] + timing.value
+            if due is not None and due > after:
+                return due
+        day += timedelta(days=1)
+    return None
+
+
+def jittered(timing, due):
+    """
+    :param timing: when the schedule is due
+    :type timing: `Timing`
+    :param due: an occurrence of the schedule, as given by `next_due`
+    :returns: the UNIX time to perform that occurrence at, moved randomly by
+              up to the schedule's jitter
+    """
+    if not timing.jitter:
+        return due
+    return due + random.uniform(-timing.jitter, timing.jitter)
+
+
+class Scheduler(object):
+
+    def __init__(self, config, submit, vacation=False):
+        """
+        Performs the actions of the schedules in the switch config when they
+        are due.
+
+        Schedules wait in a heap ordered by when they are next due, from
+        which a single thread takes those that are due and sleeps until the
+        next, so that any number of them cost nothing between firings.
+        Actions that come due together are sent as one batch, at bulk
+        priority so that they never hold up interactive commands.
+
+        :param config: the switch config
+        :type config: `SwitchConfig`
+        :param submit: callable queueing a list of (switch_id, op) commands
+                       for transmission, returning a future for each (as
+                       `Lights433Server.submit`)
+        :param vacation: whether to start in vacation mode, performing the
+                         schedules only due while in it
+        :type vacation: bool
+        """
+        self.submit = submit
+        self.vacation = vacation
+        self._lock = Lock()
+        # Written to wake the thread when the heap changes, so that it can
+        # block in select() until the next schedule is due; waiting on a
+        # Condition with a timeout would poll.
+        self._wake_read, self._wake_write = os.pipe()
+        self._config = None
+        self._next = {}  # schedule index to the time it is next due
+        self._occurrences = {}  # and to that occurrence, before jitter
+        self.reload(config)
+        thread = Thread(target=self._run, name='lights433-scheduler')
+        thread.daemon = True
+        thread.start()
+
+    def reload(self, config):
+        """
+        Replaces the schedules with those of a new config. Schedules in both
+        keep when they are next due, so that reloading does not perform one
+        again that was jittered to before its time.
+        """
+        now = time.time()
+        with self._lock:
+            kept = {}
+            if self._config is not None and \
+                    self._config.location == config.location:
+                kept = dict(
+                    (schedule.spec, (self._occurrences[index],
+                                     self._next[index]))
+                    for index, schedule in enumerate(self._config.schedules)
+                    if index in self._occurrences)
+            heap, occurrences = [], {}
+            for index, schedule in enumerate(config.schedules):
+                if schedule.spec in kept:
+                    occurrence, due = kept[schedule.spec]
+                else:
+                    occurrence = next_due(schedule.timing, now,
+                                          config.location)
+                    if occurrence is None:
+                        continue
+                    due = jittered(schedule.timing, occurrence)
+                occurrences[index] = occurrence
+                heap.append((due, index))
+            heapq.heapify(heap)
+            self._config = config
+            self._heap = heap
+            self._next = dict((index, due) for due, index in heap)
+            self._occurrences = occurrences
+        self._wake()
+        log.info("Scheduled %d actions" % len(heap))
+
+    def set_vacation(self, enabled):
+        """
+        Enters or leaves vacation mode.
+        """
+        self.vacation = enabled
+        log.info("%s vacation mode" % ('Entered' if enabled else 'Left'))
+
+    def _wake(self):
+        os.write(self._wake_write, b'.')
+
+    def status(self):
+        """
+        :returns: dict of whether in vacation mode, and the list of
+                  schedules, each with its spec, the switches it acts on and
+                  when it is next due (None if never)
+        """
+        with self._lock:
+            config, next_times = self._config, dict(self._next)
+        schedules = []
+        for index, schedule in enumerate(config.schedules):
+            action = schedule.action
+            switches = [action[1]] if action[0] == 'switch' else \
+                [switch_id for switch_id, _ in config.scenes[action[1]]]
+            schedules.append(OrderedDict([
+                ('schedule', schedule.spec), ('switches', switches),
+                ('vacation', schedule.timing.vacation),
+                ('next', next_times.get(index))]))
+        return dict(vacation=self.vacation, schedules=schedules)
+
+    def _take_due(self, now):
+        """
+        Pops the schedules due by now, rescheduling them.
+
+        Each is rescheduled for its occurrence following the one just
+        performed, and only then jittered, so that a schedule jittered to
+        before its time is not performed again at its time.
+
+        :returns: (the config they belong to, list of their indices)
+        """
+        due = []
+        with self._lock:
+            config, heap = self._config, self._heap
+            while heap and heap[0][0] <= now:
+                _, index = heapq.heappop(heap)
+                due.append(index)
+                timing = config.schedules[index].timing
+                following = next_due(
+                    timing, max(now, self._occurrences[index]),
+                    config.location)
+                if following is None:
+                    del self._next[index]
+                    del self._occurrences[index]
+                else:
+                    self._occurrences[index] = following
+                    self._next[index] = jittered(timing, following)
+                    heapq.heappush(heap, (self._next[index], index))
+        return config, due
+
+    def _perform(self, config, due):
+        # Later schedules override earlier ones for the same switch.
+        commands = OrderedDict()
+        for index in due:
+            schedule = config.schedules[index]
+            if schedule.timing.vacation and not self.vacation:
+                continue
+            action = schedule.action
+            if action[0] == 'switch':
+                commands[action[1]] = action[2]
+            else:
+                for switch_id, op in config.scenes[action[1]]:
+                    commands[switch_id] = op
+            log.info("Performing schedule [%s]" % schedule.spec)
+        if not commands:
+            return
+        futures = self.submit(list(commands.items()), priority=BULK,
+                              owner='scheduler')
+        for (switch_id, op), future in zip(commands.items(), futures):
+            future.add_done_callback(partial(self._on_sent, switch_id, op))
+
+    def _on_sent(self, switch_id, op, future):
+        error = future.exception()
+        if error is not None:
+            log.error("Scheduled command [%s %s] failed: %s"
+                      % (switch_id, op, error))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                timeout = max(self._heap[0][0] - time.time(), 0) \
+                    if self._heap else None
+            readable, _, _ = select.select([self._wake_read], [], [], timeout)
+            if readable:
+                os.read(self._wake_read, 4096)
+            config, due = self._take_due(time.time())
+            if not due:
+                continue
+            try:
+                self._perform(config, due)
+            except Exception:
+                log.exception("Failed to perform scheduled actions")
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from raven.contrib.flask import Sentry
+
+
+class SentryPlugin(object):
+
+    def __init__(self, server, dsn):
+        """
+        Reports errors raised while serving requests to Sentry.
+
+        :param server: the server to report errors of
+        :param dsn: the Sentry capture URL
+        """
+        self.sentry = Sentry(dsn=dsn)
+        self.sentry.init_app(server.app)
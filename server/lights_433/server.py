@@ -3,104 +3,772 @@
 
 from __future__ import unicode_literals
 
+from collections import namedtuple, OrderedDict
 from functools import partial
+import json
 import logging
-from threading import Lock
+import os
+from threading import Lock, Thread
+import time
 
-from flask import Flask, jsonify, make_response
+from flask import Flask, g, jsonify, make_response, request, Response
 from flask_basic_roles import BasicRoleAuth
 
-from .alexa import AlexaServer
-from .driver import SignalDriver, DeviceCommError
+from .auth import Lights433Auth
+from .config import load_switch_conf
+from .driver import compile_frame, DeviceCommError
+from .pool import TransmitterPool, UnknownDeviceError
+from .metrics import COMMAND_TIME, render as render_metrics
+from .plugins import load, PLUGINS
+from .sniffer import capture_json, SignalRing
+from .state import SwitchStates
+from .transmitter import (BULK, DeviceUnavailableError, INTERACTIVE,
+                          QueueFullError, TransmitFuture)
 
 
 log = logging.getLogger(__name__)
 
+DEFAULT_DEVICE = 'default'
 
-class UnknownConfigSettingError(Exception):
-    pass
+# Seconds between comments sent to keep idle signal streams open.
+_STREAM_KEEPALIVE = 15
+
+# Stands in for commands skipped as their switches are already in the state.
+ALREADY_SENT = TransmitFuture()
+ALREADY_SENT.set_result()
 
 
-class UserAlreadyExistsError(Exception):
+class UnknownSwitchError(Exception):
+    """
+    Raised when commands are submitted for a switch not in the config (i.e.
+    one removed by a reload since the command was resolved).
+    """
     pass
 
 
-class SwitchAlreadyExistsError(Exception):
-    pass
+# The switches each user may use are kept in `permissions`, as a frozenset.
+SwitchTable = namedtuple('SwitchTable',
+                         ['config', 'frames', 'devices', 'switches',
+                          'permissions'])
+
+
+def switch_permissions(config):
+    """
+    :returns: dict of each user to the frozenset of switches they may use
+    """
+    permissions = dict((user_id, set()) for user_id in config.users)
+    for switch_id, conf in config.switches.items():
+        for user_id in conf['users']:
+            permissions.setdefault(user_id, set()).add(switch_id)
+    return dict((user_id, frozenset(switch_ids))
+                for user_id, switch_ids in permissions.items())
 
 
 class Lights433Server(object):
 
-    def __init__(self, host, port, adapter, switch_conf):
+    def __init__(self, host, port, adapter, switch_conf, devices=None,
+                 sniff=None, sniff_buffer=1024, keepalive=None,
+                 state_file=None, state_ttl=None, signal_store=None,
+                 auth_cache_ttl=300, token_ttl=900, token_secret=None,
+                 vacation=False, plugins=None):
+        """
+        :param adapter: the adapter of the default device
+        :type adapter: `Adapter`
+        :param switch_conf: path to the switch config file
+        :param devices: (name, `Adapter`) pairs of any additional devices
+        :type devices: list of tuple
+        :param sniff: the device to keep receiving signals on between
+                      transmissions, if any
+        :param sniff_buffer: the number of received signals to keep
+        :type sniff_buffer: int
+        :param keepalive: seconds a device may be idle before it is probed,
+                          and reset if unresponsive (never if unspecified)
+        :type keepalive: float
+        :param state_file: the file to persist the last state sent to each
+                           switch to, if any
+        :param state_ttl: seconds after sending a switch a state during which
+                          commands for the same state are skipped (never if
+                          unspecified)
+        :type state_ttl: float
+        :param signal_store: the file to keep every received signal in, if
+                             any (see `SignalStore`)
+        :param auth_cache_ttl: seconds for which verified credentials are
+                               remembered, rather than verified again
+        :type auth_cache_ttl: float
+        :param token_ttl: the most seconds a token issued at /token may be
+                          valid for
+        :type token_ttl: float
+        :param token_secret: the key to sign tokens with (a random one,
+                             invalidating tokens on restart, by default)
+        :type token_secret: bytes
+        :param vacation: whether to start in vacation mode, performing the
+                         schedules only due while in it
+        :type vacation: bool
+        :param plugins: the plugins to load (i.e. "alexa"; see `plugins`),
+                        each to its keyword arguments
+        :type plugins: dict
+        """
 
-        self.driver_lock = Lock()
         self.host = host
         self.port = port
-        self.switches = {}
-
-        self.driver = SignalDriver(adapter)
-        users = {}
-        switches = {}
-        with open(switch_conf, 'r') as f:
-            for line in f:
-                if line.startswith('switch:'):
-                    _, switch_id, on_signal, off_signal, pulse_length, \
-                        allowed = line.strip().split(':')
-                    if switch_id in switches:
-                        raise SwitchAlreadyExistsError(switch_id)
-                    switches[switch_id] = dict(on_signal=unicode(on_signal),
-                                               off_signal=unicode(off_signal),
-                                               pulse_length=int(pulse_length),
-                                               users=allowed.split(','))
-                    log.info("Loaded switch [%s]..." % switch_id)
-
-                elif line.startswith('user:'):
-                    _, user_id, password = line.strip().split(':')
-                    if user_id in users:
-                        raise UserAlreadyExistsError(user_id)
-                    users[user_id] = password
-                else:
-                    raise UnknownConfigSettingError(line.split(':')[0])
+        self.switch_conf = switch_conf
+        self.plugin_options = OrderedDict(plugins or {})
+        self.auth_options = dict(secret=token_secret or os.urandom(32),
+                                 cache_ttl=auth_cache_ttl,
+                                 token_ttl=token_ttl)
+
+        self.pool = TransmitterPool([(DEFAULT_DEVICE, adapter)] +
+                                    list(devices or []),
+                                    keepalive=keepalive)
+        self._reload_lock = Lock()
+        self._conf_mtime = self._mtime()
+        self.reload_listeners = []
+        self.table = self._load_table(
+            load_switch_conf(switch_conf), SwitchTable(None, {}, {}, {}, {}))
+        self.states = SwitchStates(state_file, state_ttl)
+        self.states.retain(self.config.switches)
+        # Switch IDs to the number of their commands being sent.
+        self._sending = {}
+        self._sending_lock = Lock()
+
+        self.signals, self.events, self.store = None, None, None
+        if sniff is not None:
+            # Only imported when receiving, to keep startup fast.
+            from .events import EventBridge
+            self.signals = SignalRing(sniff_buffer)
+            self.events = EventBridge(self.config, self.submit)
+            if signal_store is not None:
+                from .store import SignalStore
+                self.store = SignalStore(signal_store)
+            self.pool.listen(sniff, self._on_signal)
+        else:
+            if self.config.events:
+                log.warning("Events are configured, but no device is "
+                            "receiving signals to raise them")
+            if signal_store is not None:
+                log.warning("A signal store is configured, but no device is "
+                            "receiving signals to store")
+        self.vacation = vacation
+        self.scheduler = None
+        self._schedule(self.config)
+        self._setup_app()
+
+    def _schedule(self, config):
+        if self.scheduler is not None:
+            self.scheduler.reload(config)
+        elif config.schedules:
+            # Only imported when scheduling, to keep startup fast.
+            from .scheduler import Scheduler
+            self.scheduler = Scheduler(config, self.submit, self.vacation)
 
+    def _setup_app(self):
         self.app = Flask(__name__)
-        auth = BasicRoleAuth()
-        self._setup_users(users, auth)
-        self._setup_switches(switches, auth)
-        self.alexa = AlexaServer(self)
+        self.auth = Lights433Auth(**self.auth_options)
+        self._setup_users(self.config.users, self.auth)
+        self._setup_tokens(self.auth)
+        self._setup_switches(self.auth)
+        self._setup_scenes(self.auth)
+        self._setup_bulk(self.auth)
+        self._setup_signals(self.auth)
+        self._setup_metrics(self.auth)
+        self._setup_status(self.auth)
+        self._setup_schedules(self.auth)
+        self.plugins = OrderedDict(
+            (name, load(PLUGINS, name)(self, **options))
+            for name, options in self.plugin_options.items())
+
+    # The switch table is replaced as a whole on reload, so each request
+    # should take a single reference to it rather than using these.
+    @property
+    def config(self):
+        return self.table.config
+
+    @property
+    def frames(self):
+        return self.table.frames
+
+    @property
+    def devices(self):
+        return self.table.devices
+
+    @property
+    def switches(self):
+        return self.table.switches
+
+    def _load_table(self, config, old):
+        """
+        Builds the switch table for a config, reusing the compiled frames and
+        switch functions of any switch whose config is unchanged.
+
+        :param old: the switch table being replaced
+        :type old: `SwitchTable`
+        """
+        frames, switches = {}, {}
+        old_switches = old.config.switches if old.config else {}
+        for switch_id, conf in config.switches.items():
+            if old_switches.get(switch_id) == conf:
+                for op in ('on', 'off'):
+                    frames[switch_id, op] = old.frames[switch_id, op]
+                switches[switch_id] = old.switches[switch_id]
+            else:
+                frames.update(self._compile_frames({switch_id: conf}))
+                switches[switch_id] = self._switch_func(switch_id)
+        return SwitchTable(config, frames, self._resolve_devices(config),
+                           switches, switch_permissions(config))
+
+    def _mtime(self):
+        try:
+            return os.stat(self.switch_conf).st_mtime
+        except OSError:
+            return None
+
+    def reload(self):
+        """
+        Reloads the switch config, replacing the switches, scenes, users and
+        their permissions in a single step while requests are being served.
+        The current config is kept if the new one is invalid.
+
+        Once loaded, the new config is passed to each callable in
+        `reload_listeners` (i.e. the `DeviceOwner`, to have its workers
+        reload too).
+
+        :returns: True if the new config was loaded
+        """
+        with self._reload_lock:
+            self._conf_mtime = self._mtime()
+            old = self.table
+            try:
+                config = load_switch_conf(self.switch_conf)
+                table = self._load_table(config, old)
+                users = BasicRoleAuth()
+                self._setup_users(config.users, users)
+            except Exception:
+                log.exception("Failed to reload [%s]; keeping the current "
+                              "config" % self.switch_conf)
+                return False
+
+            old_ids, new_ids = set(old.config.switches), set(config.switches)
+            changed = set(switch_id for switch_id in old_ids & new_ids
+                          if old.config.switches[switch_id] !=
+                          config.switches[switch_id])
+            for action, switch_ids in (('Added', new_ids - old_ids),
+                                       ('Removed', old_ids - new_ids),
+                                       ('Changed', changed)):
+                if switch_ids:
+                    log.info("%s switches [%s]" % (
+                        action, ', '.join(sorted(switch_ids))))
+
+            # Users first: removed users can no longer authenticate, and
+            # added ones are denied by the old permissions until the new
+            # table is swapped in.
+            self.auth.set_users(users.users)
+            self.table = table
+            self.states.retain(config.switches)
+            for plugin in self.plugins.values():
+                if hasattr(plugin, 'reload'):
+                    plugin.reload(config)
+            if self.events is not None:
+                self.events.reload(config)
+            self._schedule(config)
+            log.info("Reloaded [%s]" % self.switch_conf)
+            for listener in self.reload_listeners:
+                listener(config)
+            return True
+
+    def watch(self, interval=5):
+        """
+        Reloads the switch config whenever its modification time changes,
+        from a background thread.
+
+        :param interval: seconds between checks
+        """
+        def poll():
+            while True:
+                time.sleep(interval)
+                if self._mtime() != self._conf_mtime:
+                    self.reload()
+
+        watcher = Thread(target=poll, name='lights433-conf-watcher')
+        watcher.daemon = True
+        watcher.start()
+
+    def _compile_frames(self, switches):
+        """
+        Precompiles the on/off payload of every switch so that requests only
+        have to hand bytes to the transmitter.
+
+        :returns: dict of (switch_id, op) -> frame
+        """
+        return dict(
+            ((switch_id, op), compile_frame(conf['%s_signal' % op],
+                                            conf['pulse_length'],
+                                            conf['repetitions'],
+                                            conf['protocol']))
+            for switch_id, conf in switches.items()
+            for op in ('on', 'off')
+        )
+
+    def _resolve_devices(self, config):
+        """
+        Resolves the devices able to reach each switch, in order of
+        preference.
+
+        :returns: dict of switch_id -> list of device names
+        """
+        devices = {}
+        for switch_id, conf in config.switches.items():
+            if conf['device'] is None:
+                devices[switch_id] = self.pool.devices()
+            else:
+                devices[switch_id] = config.groups.get(conf['device'],
+                                                       [conf['device']])
+            for device in devices[switch_id]:
+                if device not in self.pool.transmitters:
+                    raise UnknownDeviceError(
+                        "switch [%s] device [%s]" % (switch_id, device))
+        return devices
 
     def _setup_users(self, users, auth):
         for user_id, password in users.items():
             auth.add_user(user=user_id, password=password)
 
-    def _setup_switches(self, switches, auth):
-        def switch(op, switch_id, conf):
-            with self.driver_lock:
-                op = op.lower()
-                if op not in ('on', 'off'):
+    def _setup_tokens(self, auth):
+        @self.app.route('/token', methods=['POST'])
+        @auth.require()
+        def token():
+            """
+            Issues a bearer token for the user, valid for ?ttl= seconds (at
+            most, and by default, the server's token TTL) and only for the
+            comma separated ?switches= given (any the user may use by
+            default). Tokens cannot be used to issue further tokens.
+            """
+            if g.principal.token:
+                return auth.no_authorization()
+            switches = request.args.get('switches')
+            if switches is not None:
+                switches = [switch_id for switch_id in switches.split(',')
+                            if switch_id]
+                if not self._authorized(self.table, switches, g.principal):
+                    return auth.no_authorization()
+            try:
+                ttl = float(request.args['ttl']) \
+                    if 'ttl' in request.args else None
+            except ValueError:
+                return make_response(jsonify(error='bad ttl'), 400)
+            issued, expires = auth.issue_token(g.principal.user, switches,
+                                               ttl)
+            return jsonify(token=issued, expires=expires, switches=switches)
+
+    def _authorized(self, table, switch_ids, principal):
+        """
+        Checks that a user (and the token they authenticated with, if any)
+        may use every given switch.
+
+        :type principal: `Principal`
+        """
+        permitted = table.permissions.get(principal.user, ())
+        scope = principal.switches
+        return all(switch_id in permitted and
+                   (scope is None or switch_id in scope)
+                   for switch_id in switch_ids)
+
+    def _on_signal(self, signal):
+        self.signals.append(signal)
+        if self.store is not None:
+            self.store.append(signal)
+        self.events.on_signal(signal)
+
+    def submit(self, commands, table=None, priority=INTERACTIVE,
+               owner=None, force=False):
+        """
+        Queues switch commands for transmission in a single device session.
+        Commands for a state their switch was sent within the state TTL are
+        skipped, unless forced or another command for the switch is still
+        being sent.
+
+        :param commands: (switch_id, op) pairs
+        :param table: the switch table the commands were resolved against
+                      (the current one if unspecified)
+        :type table: `SwitchTable`
+        :param priority: the scheduling class (`INTERACTIVE` or `BULK`)
+        :param owner: who the commands are sent for (i.e. the user), so
+                      that owners take turns
+        :param force: send commands even if their switches are already in
+                      the state
+        :returns: list of `TransmitFuture`, one per command
+        """
+        table = table or self.table
+        for switch_id, _ in commands:
+            if switch_id not in table.config.switches:
+                raise UnknownSwitchError(switch_id)
+        with self._sending_lock:
+            # A pending command may leave the switch in another state (i.e.
+            # on, then a queued off, then on again), so nothing is skipped
+            # while one is.
+            skip = [not force and switch_id not in self._sending and
+                    self.states.current(switch_id, op)
+                    for switch_id, op in commands]
+            sending = [(switch_id, table.frames[switch_id, op],
+                        table.devices[switch_id])
+                       for (switch_id, op), skipped in zip(commands, skip)
+                       if not skipped]
+            for switch_id, _, _ in sending:
+                self._sending[switch_id] = self._sending.get(switch_id, 0) + 1
+        try:
+            sent = iter(self.pool.submit_many(sending, priority, owner))
+        except Exception:
+            for switch_id, _, _ in sending:
+                self._done_sending(switch_id)
+            raise
+        futures = []
+        for (switch_id, op), skipped in zip(commands, skip):
+            if skipped:
+                log.debug("Skipping [%s] %s; already sent" % (switch_id, op))
+                futures.append(ALREADY_SENT)
+                continue
+            future = TransmitFuture()
+            next(sent).add_done_callback(
+                partial(self._on_sent, switch_id, op, future))
+            futures.append(future)
+        return futures
+
+    def _done_sending(self, switch_id):
+        with self._sending_lock:
+            if self._sending[switch_id] > 1:
+                self._sending[switch_id] -= 1
+            else:
+                del self._sending[switch_id]
+
+    def _on_sent(self, switch_id, op, future, device_future):
+        error = device_future.exception()
+        COMMAND_TIME.observe(time.time() - device_future.created,
+                             (switch_id, 'ok' if error is None else 'error'))
+        if error is None:
+            # Before the command's future resolves, so that its state is
+            # current for whoever waits on it.
+            self.states.record(switch_id, op)
+        self._done_sending(switch_id)
+        future.set_result(error)
+
+    def _send(self, table, commands, message):
+        """
+        Queues switch commands for transmission, responding once they have
+        been sent (or right away with ?wait=false). Commands for switches
+        already in the state are skipped and listed, unless ?force=true.
+
+        :param table: the switch table the commands were resolved against
+        :type table: `SwitchTable`
+        :param commands: (switch_id, op) pairs
+        :param message: response message on success
+        """
+        priority = BULK if request.args.get('priority') == 'bulk' \
+            else INTERACTIVE
+        principal = g.get('principal')
+        owner = principal.user if principal is not None else None
+        force = request.args.get('force', '').lower() in ('1', 'true', 'yes')
+        try:
+            futures = self.submit(commands, table, priority, owner, force)
+            skipped = [switch_id for (switch_id, _), future
+                       in zip(commands, futures) if future is ALREADY_SENT]
+            if request.args.get('wait', '').lower() in ('0', 'false', 'no'):
+                return make_response(
+                    jsonify(message='queued: %s' % message,
+                            skipped=skipped), 202)
+            for future in futures:
+                future.result()
+        except UnknownSwitchError as e:
+            return make_response(
+                jsonify(error='no such switch "%s"' % e), 404)
+        except QueueFullError:
+            return make_response(
+                jsonify(error='too many pending commands'), 503)
+        except DeviceUnavailableError as e:
+            response = make_response(jsonify(error=unicode(e)), 503)
+            response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+            return response
+        except DeviceCommError as e:
+            return make_response(
+                jsonify(error='failed to communicate with the device: %s'
+                              % e), 503)
+        return make_response(jsonify(message=message, skipped=skipped), 200)
+
+    def _switch(self, switch_id, op, principal=None):
+        """
+        :param principal: the user to authorize (none for trusted callers)
+        :type principal: `Principal`
+        """
+        table = self.table
+        op = op.lower()
+        if switch_id not in table.config.switches or op not in ('on', 'off'):
+            return make_response(
+                jsonify(error='no such switch \"%s\" or '
+                              'method "%s"' % (switch_id, op)),
+                404)
+        if principal is not None and \
+                not self._authorized(table, [switch_id], principal):
+            return self.auth.no_authorization()
+        return self._send(table, [(switch_id, op)],
+                          '%s switched %s!' % (switch_id, op))
+
+    def _switch_func(self, switch_id):
+        switch_func = (lambda x: lambda op: self._switch(x, op))(switch_id)
+        switch_func.__name__ = str(switch_id)
+        return switch_func
+
+    def _setup_switches(self, auth):
+        @self.app.route('/switch/<switch_id>/<op>')
+        @auth.require()
+        def switch(switch_id, op):
+            return self._switch(switch_id, op, g.principal)
+
+        @self.app.route('/switch/<switch_id>')
+        @auth.require()
+        def switch_state(switch_id):
+            """
+            The state the switch was last sent, and when.
+            """
+            table = self.table
+            if switch_id not in table.config.switches:
+                return make_response(
+                    jsonify(error='no such switch \"%s\"' % switch_id), 404)
+            if not self._authorized(table, [switch_id], g.principal):
+                return auth.no_authorization()
+            return jsonify(switch=switch_id, **self.states.get(switch_id))
+
+        @self.app.route('/switches')
+        @auth.require()
+        def switch_states():
+            """
+            The states every switch the user may use was last sent, and when.
+            """
+            table = self.table
+            return jsonify(dict(
+                (switch_id, self.states.get(switch_id))
+                for switch_id in table.config.switches
+                if self._authorized(table, [switch_id], g.principal)))
+
+    def _setup_scenes(self, auth):
+        @self.app.route('/scene/<scene_id>')
+        @auth.require()
+        def scene(scene_id):
+            table = self.table
+            if scene_id not in table.config.scenes:
+                return make_response(
+                    jsonify(error='no such scene \"%s\"' % scene_id), 404)
+            commands = table.config.scenes[scene_id]
+            if not self._authorized(table,
+                                    (switch_id for switch_id, _ in commands),
+                                    g.principal):
+                return auth.no_authorization()
+            return self._send(table, commands,
+                              'scene %s activated!' % scene_id)
+
+    def _setup_bulk(self, auth):
+        @self.app.route('/switches', methods=['POST'])
+        @auth.require()
+        def bulk():
+            """
+            Switches several switches at once from a JSON object of
+            switch_id -> "on"/"off".
+            """
+            ops = request.get_json(silent=True)
+            if not isinstance(ops, dict) or not ops:
+                return make_response(
+                    jsonify(error='expected a JSON object of switch '
+                                  'operations'), 400)
+            table = self.table
+            commands = []
+            for switch_id, op in ops.items():
+                op = unicode(op).lower()
+                if switch_id not in table.config.switches or \
+                        op not in ('on', 'off'):
                     return make_response(
                         jsonify(error='no such switch \"%s\" or '
                                       'method "%s"' % (switch_id, op)),
                         404)
-                f = partial(self.driver.send_signal,
-                            conf['%s_signal' % op],
-                            conf['pulse_length'], 5)
-                try:
-                    f()
-                except DeviceCommError:
-                    self.driver.reconnect()  # Reboot the transmitter
-                    f()
+                commands.append((switch_id, op))
+            if not self._authorized(table,
+                                    (switch_id for switch_id, _ in commands),
+                                    g.principal):
+                return auth.no_authorization()
+            return self._send(table, commands,
+                              '%d switches switched!' % len(commands))
+
+    def _setup_signals(self, auth):
+        def not_receiving():
+            return make_response(
+                jsonify(error='no device is receiving signals'), 404)
+
+        @self.app.route('/signals')
+        @auth.require()
+        def signals():
+            """
+            Lists the buffered signals received after the ?since=<sequence>
+            given (all of them by default).
+            """
+            if self.signals is None:
+                return not_receiving()
+            try:
+                since = int(request.args.get('since', 0))
+            except ValueError:
+                return make_response(jsonify(error='bad sequence'), 400)
+            return jsonify(sequence=self.signals.sequence,
+                           signals=[capture_json(capture) for capture
+                                    in self.signals.since(since)])
+
+        @self.app.route('/signals/stream')
+        @auth.require()
+        def stream():
+            """
+            Streams signals as they are received as Server-Sent Events,
+            resuming after the Last-Event-ID (or ?since=<sequence>) given.
+            """
+            if self.signals is None:
+                return not_receiving()
+            try:
+                since = int(request.headers.get(
+                    'Last-Event-ID',
+                    request.args.get('since', self.signals.sequence)))
+            except ValueError:
+                return make_response(jsonify(error='bad sequence'), 400)
+
+            def events(sequence):
+                while True:
+                    captures = self.signals.wait(sequence, _STREAM_KEEPALIVE)
+                    if not captures:
+                        yield ': keepalive\n\n'
+                    for capture in captures:
+                        sequence = capture.sequence
+                        yield 'id: %d\ndata: %s\n\n' % (
+                            sequence, json.dumps(capture_json(capture)))
+
+            return Response(events(since), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+
+        def time_range():
+            return tuple(float(request.args[arg])
+                         if arg in request.args else None
+                         for arg in ('start', 'end'))
+
+        def not_storing():
+            return make_response(
+                jsonify(error='received signals are not stored'), 404)
+
+        @self.app.route('/signals/history')
+        @auth.require()
+        def history():
+            """
+            Lists the stored signals received between the ?start= and ?end=
+            times given (UNIX timestamps; all of them by default), oldest
+            first, optionally only those of a ?message= and at most ?limit=
+            of them (1000 by default).
+            """
+            if self.store is None:
+                return not_storing()
+            try:
+                start, end = time_range()
+                limit = int(request.args.get('limit', 1000))
+            except ValueError:
+                return make_response(jsonify(error='bad time or limit'), 400)
+            return jsonify(signals=[
+                dict(time=stored.time,
+                     protocol=stored.signal.protocol,
+                     pulse_length=stored.signal.pulse_length,
+                     message=stored.signal.message)
+                for stored in self.store.find(request.args.get('message'),
+                                              start, end, limit)])
+
+        @self.app.route('/signals/counts')
+        @auth.require()
+        def counts():
+            """
+            Counts how often each message (or only the ?message= given) was
+            received between the ?start= and ?end= times given (UNIX
+            timestamps; all time by default).
+            """
+            if self.store is None:
+                return not_storing()
+            try:
+                start, end = time_range()
+            except ValueError:
+                return make_response(jsonify(error='bad time'), 400)
+            message = request.args.get('message')
+            if message is not None:
+                return jsonify(counts={
+                    message: self.store.count(message, start, end)})
+            return jsonify(counts=self.store.counts(start, end))
+
+    def _setup_metrics(self, auth):
+        @self.app.route('/metrics')
+        @auth.require()
+        def metrics():
+            """
+            Timings and counters in the Prometheus text format.
+            """
+            return Response(render_metrics(),
+                            mimetype='text/plain; version=0.0.4')
+
+    def _setup_status(self, auth):
+        @self.app.route('/status')
+        @auth.require()
+        def status():
+            """
+            The health of each device, answered with 503 if any is down.
+            """
+            devices = self.pool.status()
+            down = [name for name, health in devices.items()
+                    if health['state'] == 'down']
+            return make_response(jsonify(devices=devices, down=down),
+                                 503 if down else 200)
+
+    def _setup_schedules(self, auth):
+        def not_scheduling():
+            return make_response(jsonify(error='no schedules configured'),
+                                 404)
+
+        @self.app.route('/schedules')
+        @auth.require()
+        def schedules():
+            """
+            Whether in vacation mode, and when each schedule acting on
+            switches the user may use is next due.
+            """
+            if self.scheduler is None:
+                return not_scheduling()
+            table = self.table
+            status = self.scheduler.status()
+            return jsonify(vacation=status['vacation'], schedules=[
+                schedule for schedule in status['schedules']
+                if self._authorized(table, schedule['switches'],
+                                    g.principal)])
+
+        @self.app.route('/vacation/<op>')
+        @auth.require()
+        def vacation(op):
+            """
+            Enters or leaves vacation mode, for users who may use every switch
+            acted on by vacation schedules.
+            """
+            if self.scheduler is None:
+                return not_scheduling()
+            op = op.lower()
+            if op not in ('on', 'off'):
                 return make_response(
-                    jsonify(message='%s switched %s!' % (switch_id, op)),
-                    200)
-
-        for switch_id, conf in switches.items():
-            switch_func = (lambda x, y:
-                           lambda op: switch(op, x, y))(switch_id, conf)
-            switch_func.__name__ = str(switch_id)
-            self.switches[switch_id] = switch_func
-            self.app.route('/switch/%s/<op>' % switch_id)(
-                auth.require(users=conf['users'])(switch_func)
-            )
+                    jsonify(error='no such method "%s"' % op), 404)
+            table = self.table
+            switch_ids = set(
+                switch_id
+                for schedule in self.scheduler.status()['schedules']
+                if schedule['vacation']
+                for switch_id in schedule['switches'])
+            if not self._authorized(table, switch_ids, g.principal):
+                return auth.no_authorization()
+            self.scheduler.set_vacation(op == 'on')
+            return jsonify(message='vacation mode %s!' % op)
 
     def run(self):
-        self.app.run(host=self.host, port=self.port)
+        # Threaded, as signal streams hold their connections open.
+        try:
+            self.app.run(host=self.host, port=self.port, threaded=True)
+        finally:
+            self.states.flush()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import deque, namedtuple
+from threading import Condition
+import time
+
+
+Capture = namedtuple('Capture', ['sequence', 'time', 'signal'])
+
+
+def capture_json(capture):
+    """
+    :returns: dict of a capture, as served over HTTP
+    """
+    return dict(sequence=capture.sequence, time=capture.time,
+                protocol=capture.signal.protocol,
+                pulse_length=capture.signal.pulse_length,
+                message=capture.signal.message)
+
+
+class SignalRing(object):
+
+    def __init__(self, capacity=1024):
+        """
+        A fixed-size buffer of the most recently received signals, numbered
+        in order of arrival so that readers can pick up where they left off.
+
+        :param capacity: the number of signals to keep
+        :type capacity: int
+        """
+        self._captures = deque(maxlen=capacity)
+        self._sequence = 0
+        self._cond = Condition()
+        self._subscribers = []
+
+    @property
+    def sequence(self):
+        """
+        :returns: the sequence number of the newest signal (0 if none)
+        """
+        return self._sequence
+
+    def append(self, signal):
+        """
+        :param signal: a received signal
+        :type signal: `Signal`
+        """
+        with self._cond:
+            self._sequence += 1
+            self._captures.append(Capture(self._sequence, time.time(),
+                                          signal))
+            self._cond.notify_all()
+        for subscriber in self._subscribers:
+            subscriber()
+
+    def subscribe(self, callback):
+        """
+        Has a callback called (without arguments, on the receiving thread)
+        whenever a signal is appended, i.e. to wake an event loop rather
+        than have it wait.
+        """
+        self._subscribers.append(callback)
+
+    def since(self, sequence):
+        """
+        :param sequence: the sequence number of the last signal seen
+        :returns: list of `Capture` of any newer signals still buffered
+        """
+        with self._cond:
+            return self._since(sequence)
+
+    def _since(self, sequence):
+        newer = self._sequence - sequence
+        if newer <= 0:
+            return []
+        return list(self._captures)[-newer:]
+
+    def wait(self, sequence, timeout=None):
+        """
+        Blocks until signals newer than `sequence` arrive.
+
+        :param sequence: the sequence number of the last signal seen
+        :param timeout: seconds to wait (forever if unspecified)
+        :returns: list of `Capture`, empty on timeout
+        """
+        with self._cond:
+            if self._sequence <= sequence:
+                self._cond.wait(timeout)
+            return self._since(sequence)
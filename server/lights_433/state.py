@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+from threading import Condition, Lock, Thread
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class SwitchStates(object):
+
+    def __init__(self, path=None, ttl=None, persist_delay=1):
+        """
+        The last state each switch was commanded into, with the time it was
+        sent, kept in memory and optionally persisted to disk.
+
+        The radio is one-way, so this is only what the switches were last
+        told, not necessarily what they are (i.e. after a switch is flipped by
+        hand or misses a signal). Redundant commands can therefore only be
+        skipped for a limited time after the state was last sent.
+
+        States are persisted on a background thread, shortly after they
+        change, so that recording one never waits on the disk and a burst
+        of changes (i.e. a scene) is written once.
+
+        :param path: the file to persist states to and restore them from
+        :param ttl: seconds after sending a state during which commands for
+                    the same state are skipped (never if unspecified)
+        :type ttl: float
+        :param persist_delay: seconds to wait for further changes before
+                              persisting them
+        :type persist_delay: float
+        """
+        self.path = path
+        self.ttl = ttl
+        self.persist_delay = persist_delay
+        self._states = {}
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._dirty = False
+        # Held while writing, so that flushes do not write the file at once.
+        self._write_lock = Lock()
+        if path is not None:
+            self._restore()
+            writer = Thread(target=self._persist_changes,
+                            name='lights433-states')
+            writer.daemon = True
+            writer.start()
+
+    def _restore(self):
+        try:
+            with open(self.path, 'r') as f:
+                states = json.load(f)
+        except IOError:
+            return  # Nothing persisted yet.
+        except ValueError:
+            log.warning("Ignoring corrupt switch states in [%s]" % self.path)
+            return
+        try:
+            restored = {}
+            for switch_id, state in states.items():
+                if state['state'] not in ('on', 'off'):
+                    raise ValueError(state['state'])
+                restored[switch_id] = (state['state'], float(state['time']))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            log.warning("Ignoring switch states of an unexpected shape in "
+                        "[%s]" % self.path)
+            return
+        self._states = restored
+        log.info("Restored the states of %d switches from [%s]"
+                 % (len(self._states), self.path))
+
+    def _persist(self, states):
+        # Written to a temporary file first so that a crash mid-write does
+        # not lose every state.
+        partial = self.path + '.tmp'
+        try:
+            with open(partial, 'w') as f:
+                json.dump(self._as_dict(states), f)
+            os.rename(partial, self.path)
+        except (IOError, OSError):
+            log.exception("Failed to persist switch states to [%s]"
+                          % self.path)
+
+    def _persist_changes(self):
+        while True:
+            with self._changed:
+                while not self._dirty:
+                    self._changed.wait()
+            time.sleep(self.persist_delay)
+            self.flush()
+
+    def _mark_changed(self):
+        # Called with the lock held.
+        if self.path is not None and not self._dirty:
+            self._dirty = True
+            self._changed.notify()
+
+    def flush(self):
+        """
+        Persists any changes right away (i.e. on shutdown), rather than
+        shortly after they were made.
+        """
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                states = dict(self._states)
+            self._persist(states)
+
+    @staticmethod
+    def _as_dict(states):
+        return dict((switch_id, dict(state=state, time=sent))
+                    for switch_id, (state, sent) in states.items())
+
+    def record(self, switch_id, op):
+        """
+        Records a switch having been sent a state.
+
+        :param op: the state ("on" or "off")
+        """
+        with self._lock:
+            self._states[switch_id] = (op, time.time())
+            self._mark_changed()
+
+    def get(self, switch_id):
+        """
+        :returns: dict of the switch's last state and the time it was sent
+                  (both None if it has not been sent any)
+        """
+        state, sent = self._states.get(switch_id, (None, None))
+        return dict(state=state, time=sent)
+
+    def current(self, switch_id, op):
+        """
+        :returns: True if the switch was sent the state recently enough for
+                  sending it again to be skipped
+        """
+        if self.ttl is None:
+            return False
+        state, sent = self._states.get(switch_id, (None, None))
+        return state == op and time.time() - sent < self.ttl
+
+    def retain(self, switch_ids):
+        """
+        Forgets the states of any switches but the given ones (i.e. those
+        removed from the config).
+        """
+        with self._lock:
+            removed = set(self._states) - set(switch_ids)
+            if not removed:
+                return
+            for switch_id in removed:
+                del self._states[switch_id]
+            self._mark_changed()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import Counter, namedtuple
+import codecs
+import logging
+import mmap
+import os
+import struct
+from threading import Lock
+import time
+
+from .driver import Signal
+
+
+log = logging.getLogger(__name__)
+
+# The store is a header followed by fixed-width records, one per signal, in
+# order of arrival:
+#
+#   <time><protocol><pulse length><code length><code>
+#
+# so that the records of any time range can be found by binary search, and a
+# code's records by searching the file for its bytes.
+_MAGIC = b'L433SIG1'
+_RECORD = struct.Struct('<dBHB20s')
+_HEADER = struct.Struct('<8sI20x')  # magic, block size; padded to a record
+_CODE = struct.Struct('<B20s')  # as stored in records, and so searched for
+_CODE_OFFSET = _RECORD.size - _CODE.size
+_MAX_CODE = 20
+
+# The index is a separate file summarizing each full block of records with
+# the number of times each code appears in it:
+#
+#   <block><code count>(<code><count>)...
+#
+# Blocks with more distinct codes than are worth indexing (i.e. when noise is
+# being picked up) are marked as unindexed and searched instead, keeping the
+# index (and the memory it takes) small.
+_INDEX_MAGIC = b'L433IDX1'
+_BLOCK = struct.Struct('<IH')
+_BLOCK_CODE = struct.Struct('<21sI')
+_UNINDEXED = 0xFFFF
+_MAX_BLOCK_CODES = 64
+
+StoredSignal = namedtuple('StoredSignal', ['time', 'signal'])
+
+
+class BadSignalStoreError(Exception):
+    pass
+
+
+def _code_key(message):
+    """
+    :param message: hex-encoded message, as reported by `read_signals`
+    :returns: the message's code as stored in records, or None if it is too
+              long to store
+    """
+    code = codecs.decode(message, 'hex')
+    if len(code) > _MAX_CODE:
+        return None
+    return _CODE.pack(len(code), code)
+
+
+def _message(key):
+    length, code = _CODE.unpack(key)
+    return codecs.encode(code[:length], 'hex')
+
+
+class SignalStore(object):
+
+    def __init__(self, path, block_size=4096, readonly=False):
+        """
+        A persistent store of received signals, appended to a file of
+        fixed-width records and read through a memory map of it, with an
+        index of how often each code appears in every block of records.
+
+        Counting a code over a time range looks up the index for the blocks
+        within it and only searches the records at its edges, so it takes
+        milliseconds however many signals are stored, while memory use is
+        bounded by the index (a few kilobytes per block).
+
+        Other processes (i.e. HTTP workers) may open the same store read-only
+        and pick up signals as they are appended.
+
+        :param path: the file to store signals in (the index is kept next to
+                     it, with an ".idx" suffix)
+        :param block_size: the number of records summarized by each index
+                           entry (of new stores; existing ones keep theirs)
+        :type block_size: int
+        :param readonly: whether to only read signals appended by another
+                         instance
+        :type readonly: bool
+        """
+        self.path = path
+        self.index_path = path + '.idx'
+        self.readonly = readonly
+        self._lock = Lock()
+        self._map = None
+        self._mapped = 0  # records
+        self._summaries = {}  # block to Counter of code keys, or None
+        self._index_offset = len(_INDEX_MAGIC)
+        self._last_time = 0
+
+        if readonly:
+            self._file = open(path, 'rb')
+            self.block_size = self._read_header()
+            self._refresh()
+            return
+
+        self._file = open(path, 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() == 0:
+            self._file.write(_HEADER.pack(_MAGIC, block_size))
+            self._file.flush()
+        self.block_size = self._read_header()
+        # Drop a record cut short by a crash.
+        size = os.fstat(self._file.fileno()).st_size
+        excess = (size - _HEADER.size) % _RECORD.size
+        if excess:
+            log.warning("Dropping a partial signal record from [%s]" % path)
+            self._file.truncate(size - excess)
+
+        self._index = open(self.index_path, 'a+b')
+        self._index.seek(0)
+        if self._index.read(len(_INDEX_MAGIC)) != _INDEX_MAGIC:
+            if os.fstat(self._index.fileno()).st_size:
+                log.warning("Rebuilding the index of [%s]" % path)
+            self._index.truncate(0)
+            self._index.write(_INDEX_MAGIC)
+            self._index.flush()
+        self._refresh()
+        # Drop an entry cut short by a crash, which would otherwise swallow
+        # the start of the entries appended after it.
+        if os.fstat(self._index.fileno()).st_size > self._index_offset:
+            log.warning("Dropping a partial index entry from [%s]"
+                        % self.index_path)
+            self._index.truncate(self._index_offset)
+
+        # Index any blocks filled since the index was last written (i.e. if
+        # it was deleted), and count the codes of the block being filled.
+        count = self._mapped
+        full = count // self.block_size
+        for block in range(full):
+            if block not in self._summaries:
+                self._write_summary(block, self._summarize(
+                    block * self.block_size, (block + 1) * self.block_size))
+        self._block_codes = self._summarize(full * self.block_size, count)
+        self._count = count
+        if count:
+            self._last_time = self._time(count - 1)
+
+    def _read_header(self):
+        self._file.seek(0)
+        header = self._file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise BadSignalStoreError("[%s] is not a signal store"
+                                      % self.path)
+        magic, block_size = _HEADER.unpack(header)
+        if magic != _MAGIC:
+            raise BadSignalStoreError("[%s] is not a signal store"
+                                      % self.path)
+        return block_size
+
+    def _refresh(self):
+        """
+        Maps any records appended since the file was last mapped, and loads
+        any new index entries.
+        """
+        size = os.fstat(self._file.fileno()).st_size
+        count = (size - _HEADER.size) // _RECORD.size
+        if count != self._mapped:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(),
+                                  _HEADER.size + count * _RECORD.size,
+                                  access=mmap.ACCESS_READ)
+            self._mapped = count
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                if f.read(len(_INDEX_MAGIC)) != _INDEX_MAGIC:
+                    return
+                f.seek(self._index_offset)
+                entries = f.read()
+        except IOError:
+            return  # Not written yet; records are searched instead.
+        offset = 0
+        while offset + _BLOCK.size <= len(entries):
+            block, codes = _BLOCK.unpack_from(entries, offset)
+            end = offset + _BLOCK.size + \
+                (0 if codes == _UNINDEXED else codes * _BLOCK_CODE.size)
+            if end > len(entries):
+                break  # Still being written.
+            summary = None
+            if codes != _UNINDEXED:
+                summary = Counter(dict(
+                    _BLOCK_CODE.unpack_from(entries, position) for position
+                    in range(offset + _BLOCK.size, end, _BLOCK_CODE.size)))
+            self._summaries[block] = summary
+            offset = end
+        self._index_offset += offset
+
+    def _write_summary(self, block, codes):
+        if len(codes) > _MAX_BLOCK_CODES:
+            entry = _BLOCK.pack(block, _UNINDEXED)
+        else:
+            entry = _BLOCK.pack(block, len(codes)) + b''.join(
+                _BLOCK_CODE.pack(key, count) for key, count in codes.items())
+        self._index.write(entry)
+        self._index.flush()
+
+    def _offset(self, record):
+        return _HEADER.size + record * _RECORD.size
+
+    def _time(self, record):
+        return struct.unpack_from('<d', self._map, self._offset(record))[0]
+
+    def _locate(self, when):
+        """
+        :returns: the number of the first record received at or after a
+                  time (the number of records if there are none)
+        """
+        low, high = 0, self._mapped
+        if when is None:
+            return high
+        while low < high:
+            middle = (low + high) // 2
+            if self._time(middle) < when:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _summarize(self, first, last):
+        codes = Counter()
+        for record in range(first, last):
+            offset = self._offset(record) + _CODE_OFFSET
+            codes[self._map[offset:offset + _CODE.size]] += 1
+        return codes
+
+    def _matches(self, key, first, last):
+        """
+        Finds the records of a code between two record numbers.
+
+        :returns: generator of record numbers
+        """
+        position = self._offset(first) + _CODE_OFFSET
+        end = self._offset(last)
+        while True:
+            found = self._map.find(key, position, end)
+            if found < 0:
+                return
+            record, misaligned = divmod(found - _HEADER.size - _CODE_OFFSET,
+                                        _RECORD.size)
+            if misaligned:
+                position = found + 1  # Matched across fields.
+            else:
+                yield record
+                position = found + _RECORD.size
+
+    def _ranges(self, start, end):
+        """
+        Splits the records received between two times into blocks that are
+        summarized by the index, and ranges of records that are not.
+
+        :returns: tuple of the list of summaries, and the list of (first,
+                  last) record number ranges
+        """
+        first = self._locate(start) if start is not None else 0
+        last = self._locate(end) if end is not None else self._mapped
+        summaries, ranges = [], []
+        record = first
+        while record < last:
+            block = record // self.block_size
+            block_end = min((block + 1) * self.block_size, last)
+            summary = self._summaries.get(block)
+            if record == block * self.block_size and \
+                    block_end == (block + 1) * self.block_size and \
+                    summary is not None:
+                summaries.append(summary)
+            elif ranges and ranges[-1][1] == record:
+                ranges[-1] = (ranges[-1][0], block_end)
+            else:
+                ranges.append((record, block_end))
+            record = block_end
+        return summaries, ranges
+
+    def append(self, signal, when=None):
+        """
+        Stores a received signal.
+
+        :param signal: the signal
+        :type signal: `Signal`
+        :param when: the time it was received (now if unspecified)
+        :type when: float
+        :returns: False if its message is too long to be stored
+        """
+        key = _code_key(signal.message)
+        if key is None:
+            log.warning("Not storing signal [%s], longer than %d bytes"
+                        % (signal.message, _MAX_CODE))
+            return False
+        with self._lock:
+            # Kept in order, so that time ranges can be found by binary
+            # search even if the clock is stepped back.
+            when = max(time.time() if when is None else when,
+                       self._last_time)
+            self._last_time = when
+            self._file.write(_RECORD.pack(when, signal.protocol,
+                                          signal.pulse_length,
+                                          *_CODE.unpack(key)))
+            self._file.flush()
+            self._block_codes[key] += 1
+            self._count += 1
+            if self._count % self.block_size == 0:
+                self._write_summary(self._count // self.block_size - 1,
+                                    self._block_codes)
+                self._block_codes = Counter()
+        return True
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return self._mapped
+
+    def count(self, message, start=None, end=None):
+        """
+        Counts how often a code was received.
+
+        :param message: hex-encoded message, as reported by `read_signals`
+        :param start: the time to count from (the first signal's if
+                      unspecified)
+        :param end: the time to count until, exclusive (now if unspecified)
+        :returns: int
+        """
+        key = _code_key(message)
+        if key is None:
+            return 0
+        with self._lock:
+            self._refresh()
+            summaries, ranges = self._ranges(start, end)
+            return sum(summary[key] for summary in summaries) + \
+                sum(sum(1 for _ in self._matches(key, first, last))
+                    for first, last in ranges)
+
+    def counts(self, start=None, end=None):
+        """
+        Counts how often each code was received.
+
+        :param start: the time to count from (the first signal's if
+                      unspecified)
+        :param end: the time to count until, exclusive (now if unspecified)
+        :returns: dict of hex-encoded message to count
+        """
+        with self._lock:
+            self._refresh()
+            summaries, ranges = self._ranges(start, end)
+            codes = Counter()
+            for summary in summaries:
+                codes.update(summary)
+            for first, last in ranges:
+                codes.update(self._summarize(first, last))
+        return dict((_message(key), count) for key, count in codes.items())
+
+    def find(self, message=None, start=None, end=None, limit=None):
+        """
+        Lists the signals received between two times, oldest first.
+
+        :param message: hex-encoded message to list the signals of (all
+                        signals if unspecified)
+        :param start: the time to list from (the first signal's if
+                      unspecified)
+        :param end: the time to list until, exclusive (now if unspecified)
+        :param limit: the most signals to list (all of them if unspecified)
+        :returns: list of `StoredSignal`
+        """
+        key = None
+        if message is not None:
+            key = _code_key(message)
+            if key is None:
+                return []
+        found = []
+        with self._lock:
+            self._refresh()
+            first = self._locate(start) if start is not None else 0
+            last = self._locate(end) if end is not None else self._mapped
+            records = range(first, last) if key is None else \
+                self._matches(key, first, last)
+            for record in records:
+                if limit is not None and len(found) >= limit:
+                    break
+                when, protocol, pulse_length, length, code = \
+                    _RECORD.unpack_from(self._map, self._offset(record))
+                found.append(StoredSignal(when, Signal(
+                    protocol, pulse_length,
+                    codecs.encode(code[:length], 'hex'))))
+        return found
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.close()
+            if not self.readonly:
+                self._index.close()
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import deque
+import errno
+import fcntl
+import heapq
+from itertools import count
+import json
+import logging
+import math
+import os
+from Queue import Queue
+import resource
+import select
+import socket
+from threading import Thread
+import time
+from urlparse import parse_qs, urlsplit
+
+from .sniffer import capture_json
+
+
+log = logging.getLogger(__name__)
+
+# Bytes of request headers accepted, and the longest a long poll may wait.
+_MAX_REQUEST = 8192
+_MAX_WAIT = 300
+
+# Seconds to stop accepting connections for once out of file descriptors,
+# and those left for the rest of the process (devices, logs, the HTTP
+# server) when capping the connections at the limit.
+_ACCEPT_BACKOFF = 1
+_RESERVED_FDS = 64
+
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    503: 'Service Unavailable',
+}
+
+_POLL_IN = select.POLLIN | select.POLLPRI
+_POLL_CLOSED = select.POLLHUP | select.POLLERR | select.POLLNVAL
+
+# Connection states
+_READING = 0  # the request
+_AUTHENTICATING = 1  # the request, off the loop (see `_verify`)
+_STREAMING = 2  # signals as Server-Sent Events
+_POLLING = 3  # for a signal newer than its ?since=, until its deadline
+_CLOSING = 4  # once the response is sent
+_CLOSED = 5
+
+
+def _event(capture):
+    return ('id: %d\ndata: %s\n\n' % (
+        capture.sequence, json.dumps(capture_json(capture)))).encode('utf-8')
+
+
+class _Connection(object):
+
+    __slots__ = ('sock', 'fd', 'state', 'received', 'request', 'pending',
+                 'since')
+
+    def __init__(self, sock):
+        self.sock = sock
+        # Kept, as a closed socket no longer has one.
+        self.fd = sock.fileno()
+        self.state = _READING
+        self.received = bytearray()
+        self.request = None  # (path, headers, query), once read
+        self.pending = bytearray()
+        self.since = None
+
+
+class StreamServer(object):
+
+    def __init__(self, server, port, host=None, keepalive=15,
+                 max_connections=10000, max_pending=65536):
+        """
+        Serves received signals to any number of clients from a single
+        thread, on a port of its own, as
+
+            GET /signals/stream  -- Server-Sent Events, as the server's
+            GET /signals?since=<sequence>&wait=<seconds>
+                                 -- a long poll, answered as soon as there
+                                    are signals newer than the sequence given
+                                    (or with none once the seconds are up)
+
+        The sockets are non-blocking and multiplexed with poll(), which
+        sleeps until a client sends something, a signal is received (the
+        receiver writes to a pipe to wake it) or the next keepalive or
+        long poll deadline, so idle clients cost a socket and a few hundred
+        bytes each, rather than a thread blocked in (and, on Python 2,
+        polling) `SignalRing.wait` as with the server's own routes. Long
+        polls are answered at their deadlines to the millisecond.
+        Credentials are verified by a thread of their own, as hashed
+        passwords take a while to verify.
+
+        Must run in the process receiving signals (the device owner, when
+        serving HTTP from workers).
+
+        :param server: the server whose received signals and users to serve
+        :type server: `Lights433Server`
+        :param port: the port to listen on
+        :type port: int
+        :param host: the interface to listen on (the server's by default)
+        :param keepalive: seconds between comments sent to keep idle streams
+                          open
+        :type keepalive: float
+        :param max_connections: connections beyond which new ones are turned
+                                away (at most what the process's file
+                                descriptor limit allows)
+        :type max_connections: int
+        :param max_pending: bytes that may await sending to a client before
+                            it is considered stuck and disconnected
+        :type max_pending: int
+        """
+        signals = server.signals
+        if signals is None or not hasattr(signals, 'subscribe'):
+            raise ValueError("signal streams must be served by the process "
+                             "receiving signals")
+        self.server = server
+        self.signals = signals
+        self.keepalive = float(keepalive)
+        self.max_connections = int(max_connections)
+        self.max_pending = int(max_pending)
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit != resource.RLIM_INFINITY and \
+                self.max_connections > soft_limit - _RESERVED_FDS:
+            self.max_connections = max(soft_limit - _RESERVED_FDS, 1)
+            log.warning("Limiting signal streams to %d connections, as the "
+                        "process may only open %d files"
+                        % (self.max_connections, soft_limit))
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host or server.host or '', int(port)))
+        self._listener.listen(1024)
+        self._listener.setblocking(0)
+        self._wake_read, self._wake_write = os.pipe()
+        for fd in (self._wake_read, self._wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self._poll = select.poll()
+        self._poll.register(self._listener.fileno(), _POLL_IN)
+        self._poll.register(self._wake_read, _POLL_IN)
+        # When to resume accepting connections, while out of file
+        # descriptors.
+        self._accept_resume = None
+        self._connections = {}  # file descriptor to `_Connection`
+        self._deadlines = []  # heap of (time, order, `_Connection`)
+        self._order = count()
+        # Connections to verify the credentials of, and those verified, with
+        # the `Principal` they authenticate as (or None).
+        self._verifying = Queue()
+        self._verified = deque()
+        # The newest signal sent to the streams.
+        self._sequence = signals.sequence
+        signals.subscribe(self._wake)
+
+        for target, name in ((self._run, 'lights433-streams'),
+                             (self._verify, 'lights433-streams-auth')):
+            thread = Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+        log.info("Serving signal streams on port %d" % int(port))
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, b'.')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            # The pipe is full, so the loop is already due to wake.
+
+    def _run(self):
+        next_keepalive = time.time() + self.keepalive
+        while True:
+            timeout = next_keepalive
+            if self._deadlines:
+                timeout = min(timeout, self._deadlines[0][0])
+            if self._accept_resume is not None:
+                timeout = min(timeout, self._accept_resume)
+            timeout = max(timeout - time.time(), 0)
+            for fd, events in self._poll.poll(
+                    int(math.ceil(timeout * 1000))):
+                if fd == self._wake_read:
+                    self._drain_wakes()
+                    self._authenticated()
+                    self._broadcast()
+                elif fd == self._listener.fileno():
+                    self._accept()
+                elif fd in self._connections:
+                    self._handle(self._serve, self._connections[fd], events)
+            now = time.time()
+            self._expire(now)
+            if self._accept_resume is not None and \
+                    now >= self._accept_resume:
+                self._accept_resume = None
+                self._poll.register(self._listener.fileno(), _POLL_IN)
+            if now >= next_keepalive:
+                for connection in self._streams():
+                    self._handle(self._send, connection, b': keepalive\n\n')
+                next_keepalive = now + self.keepalive
+
+    def _handle(self, handler, connection, *args):
+        """
+        Calls a handler of a connection, disconnecting the client should it
+        fail rather than failing the loop.
+        """
+        try:
+            handler(connection, *args)
+        except Exception:
+            log.exception("Failed to serve a signal stream client")
+            self._close(connection)
+
+    def _drain_wakes(self):
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _streams(self):
+        return [connection for connection in self._connections.values()
+                if connection.state == _STREAMING]
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] in (errno.ECONNABORTED, errno.EPROTO):
+                    continue  # Disconnected before it was accepted.
+                if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                                 errno.ENOMEM):
+                    # Left waiting until connections close, rather than
+                    # waking the loop to fail again right away.
+                    log.warning("Not accepting signal stream clients for "
+                                "%ds: %s" % (_ACCEPT_BACKOFF, e))
+                    self._poll.unregister(self._listener.fileno())
+                    self._accept_resume = time.time() + _ACCEPT_BACKOFF
+                    return
+                raise
+            sock.setblocking(0)
+            connection = _Connection(sock)
+            self._connections[connection.fd] = connection
+            self._poll.register(connection.fd, _POLL_IN)
+            if len(self._connections) > self.max_connections:
+                self._respond(connection, 503,
+                              dict(error='too many connections'))
+
+    def _open(self, connection):
+        return connection.state != _CLOSED and \
+            self._connections.get(connection.fd) is connection
+
+    def _close(self, connection):
+        if connection.state == _CLOSED:
+            return
+        connection.state = _CLOSED
+        if self._connections.get(connection.fd) is connection:
+            del self._connections[connection.fd]
+            self._poll.unregister(connection.fd)
+        connection.sock.close()
+
+    def _serve(self, connection, events):
+        if events & select.POLLOUT:
+            self._flush(connection)
+            if connection.state == _CLOSED:
+                return
+        if events & _POLL_IN:
+            try:
+                data = connection.sock.recv(4096)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                data = b''
+            if not data:
+                self._close(connection)
+                return
+            if connection.state == _READING:
+                connection.received += data
+                if b'\r\n\r\n' in connection.received:
+                    self._request(connection)
+                elif len(connection.received) > _MAX_REQUEST:
+                    self._respond(connection, 400,
+                                  dict(error='request too large'))
+        elif events & _POLL_CLOSED:
+            self._close(connection)
+
+    def _request(self, connection):
+        head = bytes(connection.received).split(b'\r\n\r\n', 1)[0] \
+            .decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = head[0].split(' ', 2)
+        except ValueError:
+            self._respond(connection, 400, dict(error='bad request'))
+            return
+        headers = dict((name.strip().lower(), value.strip())
+                       for name, _, value in (line.partition(':')
+                                              for line in head[1:]))
+        url = urlsplit(target)
+        query = dict((name, values[-1]) for name, values
+                     in parse_qs(url.query).items())
+
+        if url.path not in ('/signals', '/signals/stream'):
+            self._respond(connection, 404, dict(error='not found'))
+            return
+        if method != 'GET':
+            self._respond(connection, 405, dict(error='method not allowed'))
+            return
+        connection.state = _AUTHENTICATING
+        connection.request = (url.path, headers, query)
+        self._verifying.put((connection, headers.get('authorization', '')))
+
+    def _verify(self):
+        while True:
+            connection, authorization = self._verifying.get()
+            try:
+                principal = self.server.auth.check(authorization)
+            except Exception:
+                log.exception("Failed to verify a signal stream client")
+                principal = None
+            self._verified.append((connection, principal))
+            self._wake()
+
+    def _authenticated(self):
+        while self._verified:
+            connection, principal = self._verified.popleft()
+            # Unless disconnected meanwhile.
+            if connection.state == _AUTHENTICATING:
+                self._handle(self._start, connection, principal)
+
+    def _start(self, connection, principal):
+        if principal is None:
+            self._respond(connection, 401,
+                          dict(error='user identity could not be verified'),
+                          [('WWW-Authenticate',
+                            'Basic realm="Login Required"')])
+            return
+        path, headers, query = connection.request
+        try:
+            if path == '/signals/stream':
+                since = int(headers.get('last-event-id',
+                                        query.get('since', self._sequence)))
+            else:
+                since = int(query.get('since', 0))
+                wait = min(float(query.get('wait', 0)), _MAX_WAIT)
+        except ValueError:
+            self._respond(connection, 400, dict(error='bad sequence or wait'))
+            return
+
+        # Anything newer than the streams have been sent is left to the
+        # next broadcast.
+        captures = [capture for capture in self.signals.since(since)
+                    if capture.sequence <= self._sequence]
+        if path == '/signals/stream':
+            connection.state = _STREAMING
+            self._send(connection, b''.join(
+                [b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: text/event-stream\r\n'
+                 b'Cache-Control: no-cache\r\n'
+                 b'Connection: close\r\n\r\n'] +
+                [_event(capture) for capture in captures]))
+        elif captures or wait <= 0:
+            self._respond_signals(connection, captures)
+        else:
+            connection.state = _POLLING
+            connection.since = since
+            heapq.heappush(self._deadlines, (time.time() + wait,
+                                             next(self._order), connection))
+
+    def _respond_signals(self, connection, captures):
+        self._respond(connection, 200, dict(
+            sequence=self._sequence,
+            signals=[capture_json(capture) for capture in captures]))
+
+    def _respond(self, connection, status, body, headers=()):
+        body = json.dumps(body).encode('utf-8')
+        connection.state = _CLOSING
+        self._send(connection, b''.join([
+            ('HTTP/1.1 %d %s\r\n' % (status, _REASONS[status]))
+            .encode('ascii'),
+            b'Content-Type: application/json\r\n',
+            ('Content-Length: %d\r\n' % len(body)).encode('ascii'),
+            b'Connection: close\r\n'] + [
+            ('%s: %s\r\n' % header).encode('latin-1') for header in headers
+        ] + [b'\r\n', body]))
+
+    def _send(self, connection, data):
+        connection.pending += data
+        if len(connection.pending) > self.max_pending:
+            log.warning("Disconnecting a signal stream client that is not "
+                        "keeping up")
+            self._close(connection)
+            return
+        self._flush(connection)
+
+    def _flush(self, connection):
+        try:
+            sent = connection.sock.send(connection.pending)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                self._close(connection)
+                return
+        del connection.pending[:sent]
+        if connection.pending:
+            self._poll.modify(connection.fd, _POLL_IN | select.POLLOUT)
+        elif connection.state == _CLOSING:
+            self._close(connection)
+        else:
+            self._poll.modify(connection.fd, _POLL_IN)
+
+    def _broadcast(self):
+        captures = self.signals.since(self._sequence)
+        if not captures:
+            return
+        self._sequence = captures[-1].sequence
+        # Encoded once, however many clients are streaming.
+        events = b''.join(_event(capture) for capture in captures)
+        for connection in list(self._connections.values()):
+            if connection.state == _STREAMING:
+                self._handle(self._send, connection, events)
+            elif connection.state == _POLLING:
+                newer = [capture for capture in captures
+                         if capture.sequence > connection.since]
+                # Otherwise left waiting for one (i.e. polling ahead).
+                if newer:
+                    self._handle(self._respond_signals, connection, newer)
+
+    def _expire(self, now):
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, connection = heapq.heappop(self._deadlines)
+            if connection.state == _POLLING and self._open(connection):
+                self._handle(self._respond_signals, connection, [])
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import deque, OrderedDict
+from functools import partial
+import logging
+from threading import Condition, Event, Lock, Thread
+import time
+
+from .driver import DeviceCommError, frame_airtime
+from .metrics import PROBES, QUEUE_WAIT, SESSION_TIME, SIGNALS_SENT
+
+
+log = logging.getLogger(__name__)
+
+# Scheduling classes, most urgent first.
+INTERACTIVE = 0  # i.e. a person flipping a switch
+BULK = 1  # i.e. automation
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a transmission is submitted while the queue is at capacity.
+    """
+    pass
+
+
+class DeviceUnavailableError(Exception):
+    """
+    Raised when a transmission is submitted to a device known to be down.
+    """
+
+    def __init__(self, device, retry_after):
+        super(DeviceUnavailableError, self).__init__(
+            "device [%s] is down; retry in %ds" % (device, retry_after))
+        self.device = device
+        self.retry_after = retry_after
+
+
+class TransmitFuture(object):
+    """
+    Handle to the eventual outcome of a queued transmission.
+    """
+
+    def __init__(self):
+        self.created = time.time()
+        self._done = Event()
+        self._error = None
+        self._callbacks = []
+        self._lock = Lock()
+
+    def set_result(self, error=None):
+        with self._lock:
+            self._error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Calls `callback(future)` once the transmission completes (right away
+        if it already has).
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self):
+        """
+        :returns: the error the transmission failed with, if any
+        """
+        return self._error
+
+    def result(self, timeout=None):
+        """
+        Waits for the transmission to complete, re-raising any error it
+        failed with.
+
+        :param timeout: seconds to wait (forever if unspecified)
+        :returns: True if the transmission completed within the timeout
+        """
+        if not self._done.wait(timeout):
+            return False
+        if self._error is not None:
+            raise self._error
+        return True
+
+
+class Transmitter(object):
+
+    def __init__(self, driver, max_queue=32, max_batch=16,
+                 max_batch_airtime=0.25, cooldown=5, max_cooldown=60,
+                 keepalive=None):
+        """
+        Serializes transmissions to a driver on a dedicated worker thread.
+
+        Commands are queued by key (i.e. a switch ID). A command submitted
+        for a key that is still waiting to be sent replaces the waiting one in
+        place, so only the newest command for each key is ever transmitted.
+        Whatever has accumulated while the device was busy is sent together
+        in a single device session.
+
+        Sessions are scheduled by class: waiting interactive commands are
+        always sent before bulk ones. Within a class, owners (i.e. users)
+        take turns, least recently served first. Each session is cut off
+        once its estimated airtime reaches a budget, so that a large bulk job
+        is sent in chunks and delays an interactive command by at most one
+        chunk.
+
+        If a session fails even after the device is reset, the device is
+        taken to be down: everything waiting is failed, and new commands are
+        refused, for a cooldown. The next command after it is let through to
+        try the device again, and the cooldown doubles each time it fails.
+
+        With a keepalive, a device left idle is probed periodically and reset
+        if it has stopped responding, and a device that is down is probed as
+        soon as its cooldown ends, so that recovering it takes place between
+        commands rather than delaying the next one.
+
+        :param driver: the driver to transmit through
+        :type driver: `SignalDriver`
+        :param max_queue: the maximum number of distinct keys waiting
+        :type max_queue: int
+        :param max_batch: the maximum number of signals sent per session
+        :type max_batch: int
+        :param max_batch_airtime: seconds of estimated airtime after which a
+                                  session takes no more signals
+        :type max_batch_airtime: float
+        :param cooldown: seconds commands are refused after the device fails
+        :type cooldown: float
+        :param max_cooldown: the longest cooldown after repeated failures
+        :type max_cooldown: float
+        :param keepalive: seconds a device may be idle before it is probed
+                          (never if unspecified)
+        :type keepalive: float
+        """
+        self.driver = driver
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.max_batch_airtime = max_batch_airtime
+        self._pending = OrderedDict()
+        self._served = {}
+        self._turn = 0
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._next_cooldown = cooldown
+        self._down_until = None
+        self.keepalive = keepalive
+        self._last_contact = None
+        self._last_ok = None
+        self._last_error = None
+        self._on_signal = None
+        self._listening = False
+        self._cond = Condition()
+        self._worker = Thread(target=self._run, name='lights433-transmitter')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, key, frame, priority=INTERACTIVE, owner=None):
+        """
+        Queues a signal for transmission, coalescing it with any signal still
+        waiting under the same key.
+
+        :param key: coalescing key (i.e. the switch ID)
+        :param frame: the signal as compiled by `compile_frame`
+        :param priority: the scheduling class (`INTERACTIVE` or `BULK`)
+        :param owner: who the signal is sent for (i.e. the user)
+        :returns: `TransmitFuture` completed once the signal (or a newer one
+                  for the same key) has been sent
+        """
+        return self.submit_many([(key, frame)], priority, owner)[0]
+
+    def submit_many(self, commands, priority=INTERACTIVE, owner=None):
+        """
+        Queues several signals at once so that they are sent in the same
+        device session where possible, coalescing each with any signal still
+        waiting under the same key.
+
+        :param commands: (key, frame) pairs
+        :type commands: list of tuple
+        :param priority: the scheduling class (`INTERACTIVE` or `BULK`)
+        :param owner: who the signals are sent for (i.e. the user)
+        :returns: list of `TransmitFuture`, one per command
+        """
+        with self._cond:
+            self.check_available(key for key, _ in commands)
+            futures = []
+            for key, frame in commands:
+                job_priority = priority
+                if key in self._pending:
+                    _, waiting, queued_priority, _ = self._pending[key]
+                    job_priority = min(priority, queued_priority)
+                    log.debug("Coalescing queued transmission for [%s]"
+                              % key)
+                else:
+                    waiting = []
+                future = TransmitFuture()
+                waiting.append(future)
+                self._pending[key] = (frame, waiting, job_priority, owner)
+                futures.append(future)
+            stop, self._listening = self._listening, False
+            self._cond.notify()
+        if stop:
+            # Outside the lock, so that a wedged device cannot hold up other
+            # submissions or status checks.
+            self._stop_listening()
+        return futures
+
+    def check_available(self, keys):
+        """
+        Raises the error queueing signals under the keys would, without
+        queueing them: `DeviceUnavailableError` while the device is down, or
+        `QueueFullError` if they do not fit in the queue.
+        """
+        with self._cond:
+            retry_after = self.retry_after()
+            if retry_after:
+                raise DeviceUnavailableError(self.driver.name, retry_after)
+            new_keys = set(key for key in keys if key not in self._pending)
+            if len(self._pending) + len(new_keys) > self.max_queue:
+                raise QueueFullError(', '.join(sorted(new_keys)))
+
+    def retry_after(self):
+        """
+        :returns: seconds until the device may be tried again (0 unless it
+                  is down)
+        """
+        down_until = self._down_until
+        if down_until is None:
+            return 0
+        return max(down_until - time.time(), 0)
+
+    def _trip(self):
+        with self._cond:
+            self._down_until = time.time() + self._next_cooldown
+            log.error("Device [%s] is down; refusing commands for %ds"
+                      % (self.driver.name, self._next_cooldown))
+            self._next_cooldown = min(self._next_cooldown * 2,
+                                      self.max_cooldown)
+            failed = list(self._pending.values())
+            self._pending.clear()
+        error = DeviceUnavailableError(self.driver.name, self.retry_after())
+        for _, futures, _, _ in failed:
+            for future in futures:
+                future.set_result(error)
+
+    def _recovered(self):
+        with self._cond:
+            if self._down_until is None:
+                return
+            log.info("Device [%s] has recovered" % self.driver.name)
+            self._down_until = None
+            self._next_cooldown = self.cooldown
+
+    def _record(self, error=None):
+        now = time.time()
+        with self._cond:
+            self._last_contact = now
+            if error is None:
+                self._last_ok = now
+            else:
+                self._last_error = (now, unicode(error))
+
+    def status(self):
+        """
+        :returns: dict of the device's health: its state ("up", "down", or
+                  "unknown" before it has been reached), the times it last
+                  responded and last failed, the last error, seconds until
+                  it may be tried again, and the number of keys waiting
+        """
+        with self._cond:
+            if self._down_until is not None:
+                state = 'down'
+            elif self._last_ok is not None:
+                state = 'up'
+            else:
+                state = 'unknown'
+            last_error, error = self._last_error or (None, None)
+            return dict(state=state, last_ok=self._last_ok,
+                        last_error=last_error, error=error,
+                        retry_after=self.retry_after(),
+                        pending=len(self._pending),
+                        listening=self._listening)
+
+    def listen(self, callback):
+        """
+        Keeps the device receiving whenever there is nothing to transmit.
+        Receiving is paused for each transmission and resumed right after.
+
+        :param callback: called with each `Signal` received, from the worker
+                         thread
+        """
+        with self._cond:
+            self._on_signal = callback
+            self._cond.notify()
+
+    def _start_listening(self):
+        signals = self.driver.read_signals(0, 0)
+        with self._cond:
+            # Anything submitted while the capture was being started could
+            # not stop it, so it is stopped here instead.
+            stop = bool(self._pending)
+            self._listening = not stop
+        if stop:
+            self._stop_listening()
+        return signals
+
+    def _stop_listening(self):
+        # Called without the lock, once `_listening` has been cleared under
+        # it.
+        try:
+            self.driver.stop_reading()
+        except Exception:
+            log.exception("Failed to stop receiving")
+
+    def _listen(self):
+        stopped = False
+        try:
+            # Failing to start the capture is handled like it failing later
+            # on, as either means the device stopped responding.
+            for signal in self._start_listening():
+                self._on_signal(signal)
+            with self._cond:
+                stopped = not self._listening
+            if stopped:
+                self._record()
+        except Exception as e:
+            log.exception("Receiving failed")
+            self._record(e)
+            try:
+                self.driver.reconnect()  # Reboot the transmitter
+            except Exception:
+                log.exception("Failed to reset the device")
+                self._trip()
+        finally:
+            with self._cond:
+                self._listening = False
+        if not stopped:
+            # The capture failed or ended on its own (i.e. firmware without
+            # support for unbounded captures); back off rather than retrying
+            # in a tight loop, unless there is something to transmit.
+            with self._cond:
+                if not self._pending:
+                    self._cond.wait(1)
+
+    def _probe(self):
+        try:
+            self.driver.probe()
+        except Exception as e:
+            PROBES.inc((self.driver.name, 'error'))
+            self._record(e)
+            log.warning("Device [%s] did not respond to a probe (%s); "
+                        "resetting it" % (self.driver.name, e))
+            try:
+                self.driver.reconnect()  # Reboot the transmitter
+            except Exception:
+                log.exception("Failed to reset the device")
+                self._trip()
+                return
+        else:
+            PROBES.inc((self.driver.name, 'ok'))
+        self._record()
+        self._recovered()
+
+    def _idle_action(self):
+        # Called with the lock held while nothing is pending. Returns what to
+        # do with the idle device ('listen', 'probe' or None), and otherwise
+        # how long to wait before checking again (None for indefinitely).
+        retry_after = self.retry_after()
+        if retry_after:
+            # Don't try to use a device that is down.
+            return None, retry_after
+        if self._on_signal is not None:
+            return 'listen', None
+        if self.keepalive is None:
+            return None, None
+        if self._down_until is not None or self._last_contact is None:
+            return 'probe', None
+        due = self._last_contact + self.keepalive - time.time()
+        if due <= 0:
+            return 'probe', None
+        return None, due
+
+    def _next_batch(self):
+        # Called with the lock held.
+        priority = min(job[2] for job in self._pending.values())
+        queues = OrderedDict()
+        for key, (_, _, job_priority, owner) in self._pending.items():
+            if job_priority == priority:
+                queues.setdefault(owner, deque()).append(key)
+        owners = deque(sorted(queues,
+                              key=lambda owner: self._served.get(owner, 0)))
+        batch, budget = [], self.max_batch_airtime
+        while owners and len(batch) < self.max_batch:
+            owner = owners.popleft()
+            key = queues[owner][0]
+            cost = frame_airtime(self._pending[key][0])
+            if batch and cost > budget:
+                break
+            budget -= cost
+            queues[owner].popleft()
+            batch.append(self._pending.pop(key)[:2])
+            self._turn += 1
+            self._served[owner] = self._turn
+            if queues[owner]:
+                owners.append(owner)
+        return batch
+
+    def _transmit(self, frames):
+        if len(frames) == 1:
+            send = partial(self.driver.send_frame, frames[0])
+        else:
+            send = partial(self.driver.send_frames, frames)
+        try:
+            send()
+        except DeviceCommError:
+            self.driver.reconnect()  # Reboot the transmitter
+            send()
+
+    def _run(self):
+        while True:
+            batch = []
+            with self._cond:
+                while not self._pending:
+                    action, wait = self._idle_action()
+                    if action is not None:
+                        break
+                    self._cond.wait(wait)
+                if self._pending:
+                    batch = self._next_batch()
+            if not batch:
+                if action == 'listen':
+                    self._listen()
+                else:
+                    self._probe()
+                continue
+            device = (self.driver.name,)
+            start = time.time()
+            for _, futures in batch:
+                QUEUE_WAIT.observe(start - futures[0].created, device)
+            error = None
+            try:
+                self._transmit([frame for frame, _ in batch])
+            except Exception as e:
+                log.exception("Transmission failed")
+                error = e
+            labels = device + ('ok' if error is None else 'error',)
+            SESSION_TIME.observe(time.time() - start, labels)
+            SIGNALS_SENT.inc(labels, len(batch))
+            self._record(error)
+            if error is None:
+                self._recovered()
+            else:
+                self._trip()
+            for _, futures in batch:
+                for future in futures:
+                    future.set_result(error)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import codecs
+import logging
+import os
+from threading import Lock, Thread
+
+from flask import Response
+
+from .config import load_switch_conf
+from .ipc import OwnerClient, RemoteScheduler, RemoteSignals, RemoteStates
+from .server import (ALREADY_SENT, Lights433Server, switch_permissions,
+                     SwitchTable)
+from .transmitter import INTERACTIVE
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_OWNER_SOCKET = "/run/lights-433/owner.sock"
+DEFAULT_SWITCH_CONF = "/etc/lights-433/switches.conf"
+
+
+class Lights433Worker(Lights433Server):
+
+    def __init__(self, host, port, owner_socket, switch_conf, plugins=None):
+        """
+        Serves the HTTP API without talking to any devices itself, forwarding
+        switch commands (and queries of switch states, device health, metrics
+        and received signals) to a device owner process (see `DeviceOwner`).
+        Any number of workers may share one owner, i.e. as processes of a
+        multi-worker WSGI server.
+
+        The config is still loaded here to authenticate and authorize
+        requests, and should match the owner's. It is reloaded whenever the
+        owner reloads its own (or restarts).
+
+        :param owner_socket: the path of the device owner's socket
+        :param switch_conf: path to the switch config file
+        :param plugins: the plugins to load (i.e. "alexa"; see `plugins`),
+                        each to its keyword arguments
+        :type plugins: dict
+        """
+        # Deliberately not calling the superclass's constructor, which opens
+        # the devices.
+        self.host = host
+        self.port = port
+        self.switch_conf = switch_conf
+        self.plugin_options = OrderedDict(plugins or {})
+
+        self.client = OwnerClient(owner_socket)
+        self.pool = self.client
+        self.states = RemoteStates(self.client)
+        self.events = None
+        info = self.client.info()
+        self.auth_options = dict(info['auth'])
+        self.auth_options['secret'] = codecs.decode(
+            self.auth_options['secret'], 'hex')
+        self.signals = RemoteSignals(self.client) \
+            if info['receiving'] else None
+        self.scheduler = RemoteScheduler(self.client) \
+            if info['scheduling'] else None
+        # The owner's signal store, read directly.
+        self.store = None
+        if info.get('store'):
+            from .store import SignalStore
+            self.store = SignalStore(info['store'], readonly=True)
+
+        self._reload_lock = Lock()
+        self._conf_mtime = self._mtime()
+        self.reload_listeners = []
+        self._config_version = info['config']
+        self._version_lock = Lock()
+        self.table = self._load_table(load_switch_conf(switch_conf), None)
+        self._setup_app()
+        self.client.on_reload = self._owner_reloaded
+        # In case the owner reloaded since answering.
+        self._owner_reloaded(self.client.config_version)
+
+    def _owner_reloaded(self, version):
+        with self._version_lock:
+            if version is None or version == self._config_version:
+                return
+            self._config_version = version
+        # Off the client's reader thread, which must stay free to read
+        # replies.
+        Thread(target=self.reload, name='lights433-worker-reload').start()
+
+    def _schedule(self, config):
+        # Schedules are performed by the owner, and only served here.
+        if self.scheduler is None and config.schedules:
+            self.scheduler = RemoteScheduler(self.client)
+
+    def _load_table(self, config, old):
+        # Frames are compiled, and devices resolved, by the owner.
+        return SwitchTable(config, {}, {}, dict(
+            (switch_id, self._switch_func(switch_id))
+            for switch_id in config.switches), switch_permissions(config))
+
+    def submit(self, commands, table=None, priority=INTERACTIVE,
+               owner=None, force=False):
+        futures, skipped = self.client.submit(commands, priority, owner,
+                                              force)
+        return [ALREADY_SENT if was_skipped else future
+                for future, was_skipped in zip(futures, skipped)]
+
+    def _setup_metrics(self, auth):
+        @self.app.route('/metrics')
+        @auth.require()
+        def metrics():
+            """
+            The device owner's timings and counters in the Prometheus text
+            format.
+            """
+            return Response(self.client.metrics(),
+                            mimetype='text/plain; version=0.0.4')
+
+
+_application = None
+_application_lock = Lock()
+
+
+def application(environ, start_response):
+    """
+    WSGI entry point for workers, i.e.
+
+        lights433 <adapter> --owner-socket /run/lights-433/owner.sock
+        gunicorn -w 4 -k gthread lights_433.worker:application
+
+    configured through the environment variables LIGHTS433_OWNER_SOCKET,
+    LIGHTS433_SWITCHES and LIGHTS433_PLUGINS (comma separated plugin names;
+    "alexa" by default, and empty to serve no plugins). The worker is created
+    on the first request, after any fork.
+    """
+    global _application
+    if _application is None:
+        with _application_lock:
+            if _application is None:
+                _application = Lights433Worker(
+                    None, None,
+                    os.environ.get('LIGHTS433_OWNER_SOCKET',
+                                   DEFAULT_OWNER_SOCKET),
+                    os.environ.get('LIGHTS433_SWITCHES',
+                                   DEFAULT_SWITCH_CONF),
+                    OrderedDict(
+                        (name, {}) for name in os.environ.get(
+                            'LIGHTS433_PLUGINS', 'alexa').split(',')
+                        if name)).app
+    return _application(environ, start_response)
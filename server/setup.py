@@ -16,9 +16,27 @@ setup(
     install_requires=[line.strip()
                       for line in open("requirements.txt", "r",
                                        encoding="utf-8").readlines()],
+    extras_require={
+        "learn": ["numpy"],
+    },
     entry_points={
         "console_scripts": [
             "lights433 = lights_433.main:main",
+            "lights433-bench = lights_433.benchmark:main",
+            "lights433-learn = lights_433.learn:main",
+            "lights433-dump = lights_433.adapter.recording:main",
+            "lights433-passwd = lights_433.auth:main",
+        ],
+        "lights_433.adapters": [
+            "record = lights_433.adapter.recording:RecordingAdapter",
+            "replay = lights_433.adapter.recording:ReplayAdapter",
+            "rpi = lights_433.adapter.rpi:RPiAdapter",
+            "sim = lights_433.adapter.sim:SimulatedAdapter",
+        ],
+        "lights_433.plugins": [
+            "alexa = lights_433.alexa:AlexaServer",
+            "sentry = lights_433.sentry:SentryPlugin",
+            "streams = lights_433.streams:StreamServer",
         ],
     },
 )
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import unittest
+
+from lights_433.alexa import LocationIndex, normalize, soundex
+
+SWITCHES = dict(
+    kitchen={},
+    living_room=dict(aliases=['lounge', 'front room']),
+    porch={},
+    patio={},
+    hallway=dict(aliases=['hall']),
+    bedroom={},
+    bathroom={},
+)
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def test_collapses_punctuation(self):
+        self.assertEqual(normalize('Living_Room'), 'living room')
+        self.assertEqual(normalize("  the kids' room! "), 'the kids room')
+        self.assertEqual(normalize('___'), '')
+
+    def test_soundex(self):
+        self.assertEqual(soundex('robert'), 'r163')
+        self.assertEqual(soundex('rupert'), 'r163')
+        self.assertEqual(soundex('ashcraft'), 'a261')
+        self.assertEqual(soundex('living room'), 'l152 r500')
+
+
+class LocationIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = LocationIndex(SWITCHES)
+
+    def test_exact_matches(self):
+        for location, switch_id in (('kitchen', 'kitchen'),
+                                    ('Living Room', 'living_room'),
+                                    ('living_room', 'living_room'),
+                                    ('lounge', 'living_room'),
+                                    ('front room', 'living_room'),
+                                    ('hall', 'hallway')):
+            self.assertEqual(self.index.match(location), switch_id)
+
+    def test_misheard_matches(self):
+        for location, switch_id in (('kitchin', 'kitchen'),
+                                    ('kaychin', 'kitchen'),
+                                    ('porsh', 'porch'),
+                                    ('patty oh', 'patio'),
+                                    ('hole way', 'hallway')):
+            self.assertEqual(self.index.match(location), switch_id)
+
+    def test_phonetic_matches(self):
+        # Too far from "lounge" to match by spelling, but sounds the same.
+        self.assertEqual(self.index.match('lawnj'), 'living_room')
+        self.assertIsNone(
+            LocationIndex(SWITCHES, phonetic=False).match('lawnj'))
+
+    def test_ambiguous_matches(self):
+        # Bedroom and bathroom share a Soundex key, so are told apart by
+        # spelling.
+        self.assertEqual(soundex('bedroom'), soundex('bathroom'))
+        self.assertEqual(self.index.match('bedrum'), 'bedroom')
+        self.assertEqual(self.index.match('bothrum'), 'bathroom')
+        self.assertEqual(self.index.match('porsh'), 'porch')
+        self.assertEqual(self.index.match('pateo'), 'patio')
+
+    def test_shared_aliases_match_the_first_switch(self):
+        index = LocationIndex(dict(porch=dict(aliases=['outside']),
+                                   patio=dict(aliases=['outside'])))
+        self.assertEqual(index.match('outside'), 'patio')
+
+    def test_unknown_locations(self):
+        for location in ('garage', 'xylophone', '', '!!'):
+            self.assertIsNone(self.index.match(location))
+
+    def test_caches_matches(self):
+        self.index = LocationIndex(SWITCHES, cache_size=2)
+        for location in ('kitchin', 'porsh', 'garage'):
+            self.index.match(location)
+        self.assertEqual(list(self.index._cache.items()),
+                         [('porsh', 'porch'), ('garage', None)])
+        self.index.clear()
+        self.assertEqual(len(self.index._cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
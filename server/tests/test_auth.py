@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import base64
+import json
+import time
+import unittest
+
+from lights_433.auth import (_b64, check_password, hash_password,
+                             Lights433Auth, Principal)
+
+# Fast to hash, as the tests only care that hashes verify.
+ITERATIONS = 1000
+
+
+def basic(user, password):
+    return 'Basic ' + base64.b64encode(
+        ('%s:%s' % (user, password)).encode('utf-8')).decode('ascii')
+
+
+class PasswordTest(unittest.TestCase):
+
+    def test_hashes_verify(self):
+        stored = hash_password('sésame', ITERATIONS)
+        self.assertTrue(stored.startswith('pbkdf2_sha256$1000$'))
+        self.assertTrue(check_password('sésame', stored))
+        self.assertFalse(check_password('sesame', stored))
+
+    def test_hashes_are_salted(self):
+        self.assertNotEqual(hash_password('pw', ITERATIONS),
+                            hash_password('pw', ITERATIONS))
+
+    def test_plaintext_passwords_verify(self):
+        self.assertTrue(check_password('pw', 'pw'))
+        self.assertFalse(check_password('pw', 'p'))
+
+    def test_malformed_hashes_never_verify(self):
+        for stored in ('pbkdf2_sha256$', 'pbkdf2_sha256$x$c2FsdA==$aGFzaA==',
+                       'pbkdf2_sha256$1000$!$aGFzaA==',
+                       'pbkdf2_sha256$1000$c2FsdA==$aGFzaA==$'):
+            self.assertFalse(check_password('pw', stored))
+
+
+class AuthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.auth = Lights433Auth(b'secret')
+        self.auth.set_users(dict(alice='pw',
+                                 bob=hash_password('bobs', ITERATIONS)))
+
+    def test_checks_basic_credentials(self):
+        self.assertEqual(self.auth.check(basic('alice', 'pw')),
+                         Principal('alice', None, False))
+        self.assertEqual(self.auth.check(basic('bob', 'bobs')),
+                         Principal('bob', None, False))
+        self.assertIsNone(self.auth.check(basic('bob', 'pw')))
+        self.assertIsNone(self.auth.check(basic('carol', 'pw')))
+
+    def test_rejects_malformed_headers(self):
+        for authorization in ('', 'Basic', 'Basic !!!', 'Digest abc',
+                              'Basic ' + base64.b64encode(b'\xff:pw')
+                              .decode('ascii'), 'Bearer', 'Bearer a.b'):
+            self.assertIsNone(self.auth.check(authorization))
+
+    def test_remembers_verified_credentials(self):
+        self.auth.check(basic('bob', 'bobs'))
+        key = ('bob', self.auth.users['bob'])
+        digest, expiry = self.auth._verified[key]
+        self.assertGreater(expiry, time.time())
+        self.assertNotIn('bobs'.encode('utf-8'), digest)
+        # Remembered credentials do not vouch for other passwords.
+        self.assertIsNone(self.auth.check(basic('bob', 'wrong')))
+        self.assertIsNotNone(self.auth.check(basic('bob', 'bobs')))
+        self.assertEqual(self.auth._verified[key], (digest, expiry))
+
+    def test_forgets_credentials_on_reload(self):
+        self.auth.check(basic('bob', 'bobs'))
+        self.auth.set_users(dict(bob=hash_password('new', ITERATIONS)))
+        self.assertEqual(self.auth._verified, {})
+        self.assertIsNone(self.auth.check(basic('bob', 'bobs')))
+        self.assertIsNotNone(self.auth.check(basic('bob', 'new')))
+
+    def test_verifies_tokens(self):
+        token, expires = self.auth.issue_token('alice', ['porch', 'kitchen'])
+        self.assertAlmostEqual(expires, time.time() + 900, delta=2)
+        principal = Principal('alice', frozenset(['kitchen', 'porch']), True)
+        self.assertEqual(self.auth.verify_token(token), principal)
+        self.assertEqual(self.auth.check('Bearer ' + token), principal)
+        # Verified again once remembered.
+        self.assertEqual(self.auth.verify_token(token), principal)
+
+    def test_caps_token_lifetimes(self):
+        _, expires = self.auth.issue_token('alice', ttl=10 ** 6)
+        self.assertLessEqual(expires, time.time() + 900)
+        _, expires = self.auth.issue_token('alice', ttl=60)
+        self.assertLessEqual(expires, time.time() + 60)
+
+    def test_rejects_expired_tokens(self):
+        body = _b64(json.dumps(['alice', int(time.time()) - 1, None])
+                    .encode('utf-8'))
+        self.assertIsNone(
+            self.auth.verify_token(body + '.' + self.auth._sign(body)))
+
+    def test_rejects_tampered_tokens(self):
+        token, _ = self.auth.issue_token('alice', ['kitchen'])
+        body, _, signature = token.partition('.')
+        forged = _b64(json.dumps(['alice', int(time.time()) + 900, None])
+                      .encode('utf-8'))
+        self.assertIsNone(self.auth.verify_token(forged + '.' + signature))
+        self.assertIsNone(self.auth.verify_token(body + '.' + forged))
+        self.assertIsNone(self.auth.verify_token(body))
+        other = Lights433Auth(b'other')
+        other.set_users(self.auth.users)
+        self.assertIsNone(other.verify_token(token))
+
+    def test_rejects_tokens_of_removed_users(self):
+        token, _ = self.auth.issue_token('alice')
+        self.assertIsNotNone(self.auth.verify_token(token))
+        self.auth.set_users(dict(bob='pw'))
+        self.assertIsNone(self.auth.verify_token(token))
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lights_433.config import (BadEventError, BadSceneError,
+                               BadScheduleError, load_switch_conf, Timing,
+                               UnknownConfigSettingError)
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conf_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.conf_dir)
+
+    def load(self, *lines):
+        path = os.path.join(self.conf_dir, 'switches.conf')
+        with open(path, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        return load_switch_conf(path)
+
+
+class SwitchConfigTest(ConfigTest):
+
+    def test_switch_defaults(self):
+        config = self.load('user:alice:pw',
+                           'switch:kitchen:14d15c:14d154:189:alice')
+        self.assertEqual(config.users, {'alice': 'pw'})
+        self.assertEqual(config.switches['kitchen'], dict(
+            on_signal='14d15c', off_signal='14d154', pulse_length=189,
+            users=['alice'], device=None, aliases=None, repetitions=5,
+            protocol=1))
+
+    def test_switch_options(self):
+        switch = self.load(
+            'switch:kitchen:14d15c:14d154:189:alice,bob:device=attic,'
+            'aliases=cooker|stove,repetitions=8,protocol=2'
+        ).switches['kitchen']
+        self.assertEqual(switch['users'], ['alice', 'bob'])
+        self.assertEqual(switch['device'], 'attic')
+        self.assertEqual(switch['aliases'], ['cooker', 'stove'])
+        self.assertEqual(switch['repetitions'], 8)
+        self.assertEqual(switch['protocol'], 2)
+
+    def test_unknown_switch_option(self):
+        self.assertRaises(UnknownConfigSettingError, self.load,
+                          'switch:kitchen:14d15c:14d154:189:alice:color=red')
+
+    def test_scene_may_precede_its_switches(self):
+        config = self.load('scene:night:kitchen=off',
+                           'switch:kitchen:14d15c:14d154:189:alice')
+        self.assertEqual(config.scenes['night'], [('kitchen', 'off')])
+
+    def test_scene_with_unknown_switch(self):
+        self.assertRaises(BadSceneError, self.load,
+                          'switch:kitchen:14d15c:14d154:189:alice',
+                          'scene:night:hallway=off')
+
+
+class EventConfigTest(ConfigTest):
+
+    _SWITCH = 'switch:kitchen:14d15c:14d154:189:alice'
+
+    def test_events(self):
+        config = self.load(
+            self._SWITCH, 'scene:night:kitchen=off',
+            'event:kitchen=on:http://localhost:8000/hook',
+            'event:A1B2C3:switch:kitchen=off',
+            'event:a1b2c3:scene:night')
+        self.assertEqual(config.events, [
+            (('switch', 'kitchen', 'on'),
+             ('webhook', 'http://localhost:8000/hook')),
+            (('code', 'a1b2c3'), ('switch', 'kitchen', 'off')),
+            (('code', 'a1b2c3'), ('scene', 'night'))])
+
+    def test_bad_events(self):
+        for event in ('event:zz:scene:night',
+                      'event:hallway=on:scene:night',
+                      'event:a1b2c3:scene:day',
+                      'event:a1b2c3:switch:kitchen=dim',
+                      'event:a1b2c3:ftp://localhost'):
+            self.assertRaises(BadEventError, self.load, self._SWITCH,
+                              'scene:night:kitchen=off', event)
+
+
+class ScheduleConfigTest(ConfigTest):
+
+    _SWITCH = 'switch:porch:14d15c:14d154:189:alice'
+
+    def timing(self, when, *lines):
+        config = self.load(self._SWITCH, 'scene:night:porch=off',
+                           'schedule:switch:porch=on@' + when, *lines)
+        self.assertEqual(config.schedules[0].spec, 'switch:porch=on@' + when)
+        self.assertEqual(config.schedules[0].action, ('switch', 'porch', 'on'))
+        return config.schedules[0].timing
+
+    def test_schedule_timings(self):
+        self.assertEqual(self.timing('23:30'),
+                         Timing('time', 23 * 60 * 60 + 30 * 60, 0, None,
+                                False))
+        self.assertEqual(self.timing('vacation 19:00~45m mon,FRI'),
+                         Timing('time', 19 * 60 * 60, 45 * 60,
+                                frozenset([0, 4]), True))
+        self.assertEqual(self.timing('every 1h30m sat'),
+                         Timing('every', 90 * 60, 0, frozenset([5]), False))
+        self.assertEqual(self.timing('every 2h~5m'),
+                         Timing('every', 2 * 60 * 60, 5 * 60, None, False))
+
+    def test_sun_relative_schedules(self):
+        # The location may follow the schedules that need it.
+        self.assertEqual(self.timing('sunset-15m', 'location:52.37,4.90'),
+                         Timing('sunset', -15 * 60, 0, None, False))
+        self.assertEqual(self.timing('sunrise+1h~10m', 'location:52.37,4.9'),
+                         Timing('sunrise', 60 * 60, 10 * 60, None, False))
+        self.assertEqual(self.timing('sunrise', 'location:52.37,4.9'),
+                         Timing('sunrise', 0, 0, None, False))
+
+    def test_scene_schedules(self):
+        config = self.load(self._SWITCH, 'scene:night:porch=off',
+                           'schedule:scene:night@23:30')
+        self.assertEqual(config.schedules[0].action, ('scene', 'night'))
+
+    def test_bad_schedules(self):
+        for when in ('', '24:00', '12:60', 'noon', '12:00 someday',
+                     '12:00~soon', '12:00 mon tue', 'every', 'every 0s',
+                     'every 5', 'sunset', 'sunset*15m'):
+            self.assertRaises(BadScheduleError, self.load, self._SWITCH,
+                              'schedule:switch:porch=on@' + when)
+        self.assertRaises(BadScheduleError, self.load, self._SWITCH,
+                          'schedule:switch:hallway=on@12:00')
+        self.assertRaises(BadScheduleError, self.load, self._SWITCH,
+                          'schedule:switch:porch=on')
+
+    def test_bad_locations(self):
+        for lines in (['location:north'], ['location:1,2', 'location:1,2']):
+            self.assertRaises(BadScheduleError, self.load, self._SWITCH,
+                              *lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
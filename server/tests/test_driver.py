@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import struct
+import unittest
+
+from lights_433.adapter import Adapter
+from lights_433.adapter.sim import crc8, SimulatedAdapter
+from lights_433.driver import (compile_frame, FrameTooLargeError,
+                               MAX_MESSAGE, ResponseTimeout, Signal,
+                               SignalDriver)
+
+
+class ScriptedAdapter(Adapter):
+    """
+    Answers with a fixed script of device output, timing out once it is
+    exhausted.
+    """
+
+    def __init__(self, script):
+        self.script = bytearray(script)
+        self.written = bytearray()
+
+    def initialize(self):
+        pass
+
+    def read(self, size=1):
+        data = bytes(self.script[:size])
+        del self.script[:size]
+        return data
+
+    def write(self, data):
+        self.written += data
+
+    def flush(self):
+        pass
+
+
+class CompileFrameTest(unittest.TestCase):
+
+    def test_compiles_header_and_message(self):
+        self.assertEqual(compile_frame('14d15c', 189, 5, 2),
+                         struct.pack('<HHHH', 2, 189, 5, 3) + b'\x14\xd1\x5c')
+
+    def test_rejects_messages_the_firmware_cannot_send(self):
+        # Sent as an unsigned long, so 4 bytes at most.
+        self.assertEqual(MAX_MESSAGE, 4)
+        longest = 'ab' * MAX_MESSAGE
+        self.assertEqual(len(compile_frame(longest, 189)), 8 + MAX_MESSAGE)
+        for message in (longest + 'ab', 'ab' * 8):
+            self.assertRaises(FrameTooLargeError, compile_frame, message,
+                              189)
+
+
+class ReadSignalsTest(unittest.TestCase):
+
+    # HELLO, AWAITING_DATA, then INCOMING_DATA and a signal header
+    _CAPTURE = b'EBC' + struct.pack('<HHH', 1, 189, 3)
+
+    def test_reads_captured_signals(self):
+        driver = SignalDriver(ScriptedAdapter(
+            self._CAPTURE + b'\x14\xd1\x5c' + b'F'))
+        self.assertEqual(list(driver.read_signals(1)),
+                         [Signal(1, 189, b'14d15c')])
+
+    def test_short_signal_is_an_error(self):
+        driver = SignalDriver(ScriptedAdapter(self._CAPTURE + b'\x14'))
+        self.assertRaises(ResponseTimeout, list, driver.read_signals(1))
+
+
+class SimulatedFramingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = SimulatedAdapter(baud=0, airtime=False)
+        self.adapter.initialize()
+        self.adapter.write(b'CLS1')
+        self.assertEqual(self.adapter.read(1), b'E')
+
+    def tearDown(self):
+        self.adapter.close()
+
+    def frame(self, sequence, instruction, payload=b''):
+        fields = bytearray([sequence, ord(instruction), len(payload)])
+        return b'~' + bytes(fields) + payload + \
+            bytes(bytearray([crc8(fields + bytearray(payload))]))
+
+    def test_oversized_frames_are_skipped(self):
+        self.adapter.write(self.frame(1, b'2', b'\x00' * 20) +
+                           self.frame(2, b'x'))
+        # Rejected, and the next frame read from where it starts.
+        self.assertEqual(self.adapter.read(5)[:3], b'~\x01J')
+        self.assertEqual(self.adapter.read(5)[:3], b'~\x02Z')
+
+    def test_long_messages_are_rejected(self):
+        header = struct.pack('<HHHH', 1, 189, 1, 5)
+        self.adapter.write(self.frame(1, b'2', header + b'\x01' * 5))
+        self.assertEqual(self.adapter.read(5)[:3], b'~\x01J')
+        self.assertFalse(self.adapter.transmissions)
+
+
+if __name__ == '__main__':
+    unittest.main()
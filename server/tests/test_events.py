@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from threading import Event
+import time
+import unittest
+
+from lights_433.config import SwitchConfig
+from lights_433.driver import Signal
+from lights_433.events import EventBridge
+from lights_433.transmitter import TransmitFuture
+
+
+class EventBridgeTest(unittest.TestCase):
+
+    def setUp(self):
+        config = SwitchConfig(
+            users={}, groups={}, schedules=[], location=None,
+            switches=dict(kitchen=dict(on_signal='14D15C',
+                                       off_signal='14d154')),
+            scenes=dict(night=[('kitchen', 'off')]),
+            events=[(('switch', 'kitchen', 'on'), ('scene', 'night')),
+                    (('code', 'a1b2c3'), ('switch', 'kitchen', 'on'))])
+        self.submitted = []
+        self.performed = Event()
+        self.bridge = EventBridge(config, self.submit, window=0.5)
+
+    def submit(self, commands):
+        self.submitted.append(commands)
+        self.performed.set()
+        future = TransmitFuture()
+        future.set_result()
+        return [future]
+
+    def test_debounce_drops_repeats_within_the_window(self):
+        debounce = self.bridge._debounce
+        self.assertFalse(debounce('14d15c', 100.0))
+        self.assertTrue(debounce('14d15c', 100.2))
+        # Held down: each repeat extends the press.
+        self.assertTrue(debounce('14d15c', 100.6))
+        self.assertFalse(debounce('a1b2c3', 100.6))
+        self.assertFalse(debounce('14d15c', 101.2))
+
+    def test_codes_map_to_switch_operations(self):
+        self.bridge.on_signal(Signal(1, 189, '14d15c'))
+        self.assertTrue(self.performed.wait(5))
+        self.assertEqual(self.submitted, [[('kitchen', 'off')]])
+
+    def test_code_actions(self):
+        self.bridge.on_signal(Signal(1, 189, 'A1B2C3'))
+        self.assertTrue(self.performed.wait(5))
+        self.assertEqual(self.submitted, [[('kitchen', 'on')]])
+
+    def test_repeats_raise_one_event(self):
+        for _ in range(5):
+            self.bridge.on_signal(Signal(1, 189, 'a1b2c3'))
+        self.assertTrue(self.performed.wait(5))
+        time.sleep(0.1)  # For any further (wrongly raised) events.
+        self.assertEqual(len(self.submitted), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
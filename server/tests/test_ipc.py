@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import unittest
+
+from lights_433.driver import DeviceCommError
+from lights_433.ipc import _decode_error, _encode_error, OwnerUnavailableError
+from lights_433.server import UnknownSwitchError
+from lights_433.transmitter import DeviceUnavailableError, QueueFullError
+
+
+class ErrorEncodingTest(unittest.TestCase):
+
+    def round_trip(self, error):
+        decoded = _decode_error(_encode_error(error))
+        self.assertIs(type(decoded), type(error))
+        return decoded
+
+    def test_errors_survive_the_round_trip(self):
+        self.assertEqual(
+            unicode(self.round_trip(UnknownSwitchError('cuisine é'))),
+            'cuisine é')
+        self.assertEqual(unicode(self.round_trip(QueueFullError('kitchen'))),
+                         'kitchen')
+        self.assertEqual(unicode(self.round_trip(DeviceCommError('timeout'))),
+                         'timeout')
+        unavailable = self.round_trip(DeviceUnavailableError('usb0', 4.2))
+        self.assertEqual((unavailable.device, unavailable.retry_after),
+                         ('usb0', 5))
+
+    def test_other_errors_fail_the_owner(self):
+        decoded = _decode_error(_encode_error(KeyError('kitchen')))
+        self.assertIsInstance(decoded, OwnerUnavailableError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import random
+import unittest
+
+from lights_433.driver import Signal
+from lights_433.learn import cluster_codes, estimate_pulse_length
+
+
+def captures(message, pulse_length, count, jitter=10, protocol=1):
+    """
+    :returns: `count` captures of a code, with pulse lengths jittered as
+              when read by the receiver
+    """
+    return [Signal(protocol, pulse_length + random.randint(-jitter, jitter),
+                   message) for _ in range(count)]
+
+
+class ClusterCodesTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(433)
+
+    def test_groups_captures_by_code(self):
+        signals = captures('14d15c', 189, 12) + captures('14d154', 189, 8)
+        random.shuffle(signals)
+        codes = cluster_codes(signals)
+        self.assertEqual([(code.protocol, code.message, code.count)
+                          for code in codes],
+                         [(1, '14d15c', 12), (1, '14d154', 8)])
+        for code in codes:
+            self.assertTrue(all(179 <= pulse <= 199
+                                for pulse in code.pulse_lengths))
+
+    def test_tells_protocols_apart(self):
+        codes = cluster_codes(captures('14d15c', 350, 10) +
+                              captures('14d15c', 650, 10, protocol=2))
+        self.assertEqual(sorted((code.protocol, code.count)
+                                for code in codes), [(1, 10), (2, 10)])
+
+    def test_discards_noise(self):
+        signals = (captures('14d15c', 350, 18) + captures('ff', 120, 1) +
+                   captures('0001', 500, 1))
+        random.shuffle(signals)
+        codes = cluster_codes(signals)
+        self.assertEqual([code.message for code in codes], ['14d15c'])
+        # A code captured once is noise, however small the share needed.
+        codes = cluster_codes(signals, min_share=0.05)
+        self.assertEqual([code.message for code in codes], ['14d15c'])
+        self.assertEqual(cluster_codes(captures('14d15c', 350, 1)), [])
+
+    def test_drops_misread_pulse_lengths(self):
+        signals = (captures('14d15c', 350, 15) +
+                   captures('14d15c', 700, 3) + captures('14d15c', 175, 2))
+        random.shuffle(signals)
+        code, = cluster_codes(signals)
+        self.assertEqual(code.count, 20)
+        self.assertEqual(len(code.pulse_lengths), 15)
+        self.assertTrue(all(340 <= pulse <= 360
+                            for pulse in code.pulse_lengths))
+
+    def test_nothing_captured(self):
+        self.assertEqual(cluster_codes([]), [])
+
+    def test_estimates_pulse_lengths(self):
+        codes = cluster_codes(captures('14d15c', 350, 20, jitter=20) +
+                              captures('14d154', 350, 20, jitter=20) +
+                              captures('14d154', 1050, 2))
+        self.assertAlmostEqual(estimate_pulse_length(codes), 350, delta=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
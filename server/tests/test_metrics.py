@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import re
+import unittest
+
+from lights_433 import metrics
+from lights_433.metrics import Counter, Histogram
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+_UNESCAPE = {'\\\\': '\\', '\\"': '"', '\\n': '\n'}
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = []
+
+    def tearDown(self):
+        for metric in self.metrics:
+            metrics._METRICS.remove(metric)
+
+    def metric(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def parse(self, text):
+        """
+        Parses the Prometheus text exposition format, strictly enough to catch
+        malformed output.
+
+        :returns: tuple of (dict of metric names to their types, dict of
+                  (sample name, frozenset of label pairs) to values)
+        """
+        self.assertTrue(text.endswith('\n'))
+        types, samples = {}, {}
+        for line in text[:-1].split('\n'):
+            if line.startswith('# TYPE '):
+                name, kind = line[len('# TYPE '):].split(' ')
+                types[name] = kind
+                continue
+            if line.startswith('# HELP '):
+                continue
+            match = _SAMPLE.match(line)
+            self.assertIsNotNone(match, "malformed sample: %r" % line)
+            name, label_text, value = match.groups()
+            labels = []
+            if label_text:
+                position = 0
+                for label in _LABEL.finditer(label_text):
+                    self.assertEqual(label.start(), position,
+                                     "malformed labels: %r" % line)
+                    position = label.end()
+                    labels.append((label.group(1), re.sub(
+                        r'\\.', lambda m: _UNESCAPE[m.group(0)],
+                        label.group(2))))
+                self.assertEqual(position, len(label_text),
+                                 "malformed labels: %r" % line)
+            key = (name, frozenset(labels))
+            self.assertNotIn(key, samples)
+            samples[key] = float(value)
+        return types, samples
+
+    def render(self):
+        types, samples = self.parse(metrics.render())
+        for metric in self.metrics:
+            self.assertEqual(types[metric.name], metric.kind)
+        return samples
+
+    def test_renders_every_metric(self):
+        types, _ = self.parse(metrics.render())
+        self.assertEqual(types['lights433_signals_total'], 'counter')
+        self.assertEqual(types['lights433_device_seconds'], 'histogram')
+
+    def test_counters(self):
+        counter = self.metric(Counter('test_signals_total', 'Signals.',
+                                      ['device', 'outcome']))
+        counter.inc(('usb0', 'ok'))
+        counter.inc(('usb0', 'ok'), 2)
+        counter.inc(('usb1', 'failed'))
+        samples = self.render()
+        self.assertEqual(samples['test_signals_total', frozenset(
+            [('device', 'usb0'), ('outcome', 'ok')])], 3)
+        self.assertEqual(samples['test_signals_total', frozenset(
+            [('device', 'usb1'), ('outcome', 'failed')])], 1)
+
+    def test_histogram_buckets(self):
+        histogram = self.metric(Histogram('test_seconds', 'Time.',
+                                          ['device'], buckets=(0.1, 1, 5)))
+        for value in (0.05, 0.1, 0.5, 2, 7):
+            histogram.observe(value, ('usb0',))
+
+        def sample(suffix, *labels):
+            return samples['test_seconds' + suffix,
+                           frozenset((('device', 'usb0'),) + labels)]
+
+        samples = self.render()
+        # Cumulative, with each bound inclusive.
+        self.assertEqual([sample('_bucket', ('le', bound))
+                          for bound in ('0.1', '1.0', '5.0', '+Inf')],
+                         [2, 3, 4, 5])
+        self.assertEqual(sample('_count'), 5)
+        self.assertAlmostEqual(sample('_sum'), 9.65)
+        # The buckets, _sum and _count only.
+        self.assertEqual(
+            len([name for name, _ in samples if name.startswith('test_')]),
+            6)
+
+    def test_unlabelled_histograms(self):
+        histogram = self.metric(Histogram('test_seconds', 'Time.',
+                                          buckets=(1,)))
+        with histogram.timer():
+            pass
+        samples = self.render()
+        self.assertEqual(samples['test_seconds_bucket',
+                                 frozenset([('le', '1.0')])], 1)
+        self.assertEqual(samples['test_seconds_count', frozenset()], 1)
+        self.assertLess(samples['test_seconds_sum', frozenset()], 1)
+
+    def test_escapes_label_values(self):
+        counter = self.metric(Counter('test_total', 'Test.', ['switch']))
+        for switch in ('back\\slash', 'say "on"', 'two\nlines', 'café'):
+            counter.inc((switch,))
+        samples = self.render()
+        for switch in ('back\\slash', 'say "on"', 'two\nlines', 'café'):
+            self.assertEqual(
+                samples['test_total', frozenset([('switch', switch)])], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import time
+import unittest
+
+from lights_433.adapter.sim import SimulatedAdapter
+from lights_433.driver import compile_frame
+from lights_433.pool import TransmitterPool, UnknownDeviceError
+from lights_433.transmitter import DeviceUnavailableError, QueueFullError
+
+
+class UnpluggableAdapter(SimulatedAdapter):
+
+    def __init__(self):
+        super(UnpluggableAdapter, self).__init__(
+            baud=0, boot_time=0, reset_hold=0, reset_wait=0, airtime=False)
+        self.unplugged = False
+
+    def write(self, data):
+        if self.unplugged:
+            raise IOError("device unplugged")
+        return super(UnpluggableAdapter, self).write(data)
+
+
+class TransmitterPoolTest(unittest.TestCase):
+
+    _FRAME = compile_frame('14d15c', 189)
+
+    def setUp(self):
+        self.primary = UnpluggableAdapter()
+        self.backup = UnpluggableAdapter()
+        self.pool = TransmitterPool([('primary', self.primary),
+                                     ('backup', self.backup)],
+                                    retry_after=0.5)
+        for transmitter in self.pool.transmitters.values():
+            transmitter.cooldown = transmitter._next_cooldown = 0.5
+
+    def tearDown(self):
+        self.pool.close()
+
+    def send(self, devices=('primary', 'backup')):
+        future = self.pool.submit_many(
+            [('kitchen', self._FRAME, list(devices))])[0]
+        self.assertTrue(future.result(5))
+
+    def sent(self):
+        return len(self.primary.transmissions), len(self.backup.transmissions)
+
+    def test_sends_through_the_preferred_device(self):
+        self.send()
+        self.send(['backup', 'primary'])
+        self.assertEqual(self.sent(), (1, 1))
+
+    def test_fails_over_until_the_device_is_restored(self):
+        self.primary.unplugged = True
+        self.send()
+        self.assertEqual(self.sent(), (0, 1))
+        self.assertEqual(self.pool.status()['primary']['state'], 'down')
+        # Passed over while down.
+        self.send()
+        self.assertEqual(self.sent(), (0, 2))
+
+        self.primary.unplugged = False
+        time.sleep(0.6)
+        self.send()
+        self.assertEqual(self.sent(), (1, 2))
+        self.assertEqual(self.pool.status()['primary']['state'], 'up')
+
+    def test_fails_once_every_device_is_down(self):
+        self.primary.unplugged = self.backup.unplugged = True
+        future = self.pool.submit_many(
+            [('kitchen', self._FRAME, ['primary', 'backup'])])[0]
+        self.assertRaises((IOError, DeviceUnavailableError), future.result,
+                          5)
+        self.assertRaises(DeviceUnavailableError, self.send)
+
+    def test_queues_nothing_unless_every_device_has_room(self):
+        self.pool.transmitters['backup'].max_queue = 0
+        self.assertRaises(QueueFullError, self.pool.submit_many, [
+            ('kitchen', self._FRAME, ['primary']),
+            ('porch', self._FRAME, ['backup'])])
+        self.assertEqual(self.pool.status()['primary']['pending'], 0)
+        time.sleep(0.1)
+        self.assertEqual(self.sent(), (0, 0))
+
+    def test_rejects_unknown_devices(self):
+        self.assertRaises(UnknownDeviceError, self.send, ['attic'])
+
+
+if __name__ == '__main__':
+    unittest.main()
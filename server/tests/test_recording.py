@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from lights_433.adapter.recording import (BadRecordingError, INITIALIZE,
+                                          read_recording, READ,
+                                          RecordingAdapter, ReplayAdapter,
+                                          WRITE)
+from lights_433.driver import Signal, SignalDriver
+
+
+class RecordingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.recording_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.recording_dir, 'session.rec')
+
+    def tearDown(self):
+        shutil.rmtree(self.recording_dir)
+
+    def session(self, driver, adapter):
+        """
+        Talks to the device as a server would, returning the signals it
+        received.
+        """
+        driver.wait_ready()
+        driver.send_signal('123456', 200, 3)
+        driver.send_signals([('000111', 200, 1, 1), ('000222', 300, 1, 1)])
+        driver.probe()
+        if hasattr(adapter, 'inject_signal'):
+            adapter.inject_signal('abcdef', 350)
+        return list(driver.read_signals(1, 2000))
+
+    def record(self):
+        adapter = RecordingAdapter(self.path, 'sim', airtime='',
+                                   boot_time='0.05', reset_hold='0')
+        signals = self.session(SignalDriver(adapter), adapter)
+        adapter.close()
+        return signals
+
+    def test_records_the_session(self):
+        self.assertEqual(self.record(), [Signal(1, 350, 'abcdef')])
+        records = list(read_recording(self.path))
+        self.assertEqual(records[0].kind, INITIALIZE)
+        kinds = set(record.kind for record in records)
+        self.assertTrue(set([WRITE, READ]) <= kinds)
+        times = [record.time for record in records]
+        self.assertEqual(times, sorted(times))
+
+    def test_replays_the_session(self):
+        recorded = self.record()
+        for speed in (1, 0):
+            adapter = ReplayAdapter(self.path, speed)
+            self.assertEqual(self.session(SignalDriver(adapter), adapter),
+                             recorded)
+            self.assertEqual(adapter.divergences, 0)
+
+    def test_replays_as_fast_as_possible(self):
+        self.record()
+        recorded = list(read_recording(self.path))[-1].time
+        adapter = ReplayAdapter(self.path, 0)
+        start = time.time()
+        self.session(SignalDriver(adapter), adapter)
+        self.assertLess(time.time() - start, recorded)
+
+    def test_counts_divergences(self):
+        self.record()
+        adapter = ReplayAdapter(self.path, 0)
+        driver = SignalDriver(adapter)
+        driver.wait_ready()
+        driver.send_signal('999999', 200, 3)
+        self.assertGreater(adapter.divergences, 0)
+
+    def test_ignores_a_record_cut_short(self):
+        self.record()
+        records = list(read_recording(self.path))
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        self.assertEqual(list(read_recording(self.path)), records[:-1])
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a recording')
+        self.assertRaises(BadRecordingError, list, read_recording(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
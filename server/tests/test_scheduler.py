@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from collections import Counter
+from datetime import date, datetime
+import math
+import time
+import unittest
+
+from lights_433.config import Schedule, SwitchConfig, Timing
+from lights_433.scheduler import jittered, next_due, Scheduler, sun_times
+from lights_433.transmitter import TransmitFuture
+
+LOCATION = (52.37, 4.90)
+
+
+def local(*args):
+    return time.mktime(datetime(*args).timetuple())
+
+
+def timing(kind, value, jitter=0, days=None):
+    return Timing(kind, value, jitter, days, False)
+
+
+class NextDueTest(unittest.TestCase):
+
+    # 2026-10-13 is a Tuesday.
+
+    def test_daily_times(self):
+        at_2330 = timing('time', 23 * 60 * 60 + 30 * 60)
+        self.assertEqual(next_due(at_2330, local(2026, 10, 13, 10, 0)),
+                         local(2026, 10, 13, 23, 30))
+        self.assertEqual(next_due(at_2330, local(2026, 10, 13, 23, 30)),
+                         local(2026, 10, 14, 23, 30))
+
+    def test_daily_times_on_some_days(self):
+        weekends = timing('time', 7 * 60 * 60, days=frozenset([5, 6]))
+        self.assertEqual(next_due(weekends, local(2026, 10, 13, 10, 0)),
+                         local(2026, 10, 17, 7, 0))
+        self.assertEqual(next_due(weekends, local(2026, 10, 17, 7, 0)),
+                         local(2026, 10, 18, 7, 0))
+
+    def test_sunset(self):
+        before_sunset = timing('sunset', -15 * 60)
+        after = local(2026, 10, 13, 10, 0)
+        self.assertEqual(
+            next_due(before_sunset, after, LOCATION),
+            sun_times(date(2026, 10, 13), *LOCATION)[1] - 15 * 60)
+
+    def test_sunrise_past_polar_night(self):
+        # Svalbard, where the sun does not rise again until February.
+        sunrise = timing('sunrise', 0)
+        due = next_due(sunrise, local(2026, 12, 1), (78.22, 15.65))
+        self.assertEqual(datetime.fromtimestamp(due).month, 2)
+
+    def test_intervals_are_aligned(self):
+        every_90m = timing('every', 90 * 60)
+        after = local(2026, 10, 13, 10, 7)
+        due = next_due(every_90m, after)
+        self.assertEqual(due % (90 * 60), 0)
+        self.assertTrue(after < due <= after + 90 * 60)
+
+    def test_intervals_skip_to_the_next_allowed_day(self):
+        mondays = frozenset([0])
+        self.assertEqual(
+            next_due(timing('every', 60 * 60, days=mondays),
+                     local(2026, 10, 13, 12, 0)),
+            math.ceil(local(2026, 10, 19) / 3600) * 3600)
+        self.assertEqual(
+            next_due(timing('every', 60 * 60, days=mondays),
+                     local(2026, 10, 19, 10, 30)),
+            math.ceil(local(2026, 10, 19, 10, 30) / 3600) * 3600)
+        # Found without stepping through every second of the week.
+        start = time.time()
+        self.assertEqual(next_due(timing('every', 1, days=mondays),
+                                  local(2026, 10, 13, 12, 0)),
+                         local(2026, 10, 19))
+        self.assertLess(time.time() - start, 0.1)
+
+    def test_long_intervals_on_some_days(self):
+        fridays = frozenset([4])
+        due = next_due(timing('every', 2 * 24 * 60 * 60, days=fridays),
+                       local(2026, 10, 13, 12, 0))
+        self.assertEqual(datetime.fromtimestamp(due).weekday(), 4)
+
+    def test_jitter(self):
+        at_noon = timing('time', 12 * 60 * 60, jitter=30 * 60)
+        due = local(2026, 10, 13, 12, 0)
+        for _ in range(100):
+            self.assertLessEqual(abs(jittered(at_noon, due) - due), 30 * 60)
+        self.assertEqual(jittered(timing('time', 0), due), due)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.submitted = []
+
+    def submit(self, commands, priority=None, owner=None):
+        self.submitted.append(commands)
+        futures = [TransmitFuture() for _ in commands]
+        for future in futures:
+            future.set_result()
+        return futures
+
+    def scheduler(self, *schedules):
+        return Scheduler(SwitchConfig(
+            users={}, switches={}, scenes={}, groups={}, events=[],
+            location=LOCATION, schedules=[
+                Schedule('switch:porch=on@%s' % spec, spec_timing,
+                         ('switch', 'porch', 'on'))
+                for spec, spec_timing in schedules]), self.submit)
+
+    def fired(self, scheduler, days):
+        """
+        Steps through whole days well ahead of now, which the scheduler's
+        own thread is left waiting for.
+
+        :returns: `Counter` of (day, schedule index) to times performed
+        """
+        start = local(*(date.today().timetuple()[:3])) + 10 * 24 * 60 * 60
+        scheduler._take_due(start)
+        fired = Counter()
+        for minute in range(0, days * 24 * 60, 5):
+            now = start + minute * 60
+            _, due = scheduler._take_due(now)
+            for index in due:
+                fired[date.fromtimestamp(now), index] += 1
+        return fired
+
+    def test_jittered_schedules_fire_once_a_day(self):
+        scheduler = self.scheduler(
+            ('12:00~3h', timing('time', 12 * 60 * 60, jitter=3 * 60 * 60)),
+            ('sunset~1h', timing('sunset', 0, jitter=60 * 60)))
+        fired = self.fired(scheduler, 30)
+        noon = [count for (_, index), count in fired.items() if index == 0]
+        self.assertEqual(noon, [1] * 30)
+        # Sunset may be jittered across midnight in some time zones.
+        sunset = sum(count for (_, index), count in fired.items()
+                     if index == 1)
+        self.assertTrue(29 <= sunset <= 31)
+
+    def test_schedules_fire_on_their_days_only(self):
+        scheduler = self.scheduler(
+            ('every 1h~10m sat', timing('every', 60 * 60, jitter=10 * 60,
+                                        days=frozenset([5]))))
+        fired = self.fired(scheduler, 21)
+        for (day, _), count in fired.items():
+            if day.weekday() == 5:
+                self.assertTrue(23 <= count <= 24)
+            else:
+                # An occurrence jittered across midnight at most.
+                self.assertEqual(count, 1)
+        # Less one at midnight, should the days start on a Saturday.
+        self.assertTrue(3 * 24 - 1 <= sum(fired.values()) <= 3 * 24)
+
+    def test_reloading_keeps_when_schedules_are_due(self):
+        spec = ('12:00~3h', timing('time', 12 * 60 * 60, jitter=3 * 60 * 60))
+        scheduler = self.scheduler(spec)
+        due = scheduler.status()['schedules'][0]['next']
+        scheduler.reload(scheduler._config)
+        self.assertEqual(scheduler.status()['schedules'][0]['next'], due)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+from threading import Event
+import unittest
+
+from lights_433.adapter.sim import SimulatedAdapter
+from lights_433.server import (ALREADY_SENT, Lights433Server,
+                               UnknownSwitchError)
+
+SWITCH_CONF = """\
+user:alice:pw
+switch:kitchen:14d15c:14d154:189:alice
+switch:hallway:14d35c:14d354:189:alice
+"""
+
+
+class GatedAdapter(SimulatedAdapter):
+    """
+    Holds back writes while the gate is closed.
+    """
+
+    def __init__(self):
+        super(GatedAdapter, self).__init__(
+            baud=0, boot_time=0, reset_hold=0, reset_wait=0, airtime=False)
+        self.gate = Event()
+        self.gate.set()
+        self.writing = Event()
+
+    def write(self, data):
+        self.writing.set()
+        self.gate.wait(5)
+        return super(GatedAdapter, self).write(data)
+
+
+class SubmitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conf_dir = tempfile.mkdtemp()
+        switch_conf = os.path.join(self.conf_dir, 'switches.conf')
+        with open(switch_conf, 'w') as f:
+            f.write(SWITCH_CONF)
+        self.adapter = GatedAdapter()
+        self.server = Lights433Server('127.0.0.1', 0, self.adapter,
+                                      switch_conf, state_ttl=60)
+
+    def tearDown(self):
+        self.adapter.gate.set()
+        self.server.pool.close()
+        shutil.rmtree(self.conf_dir)
+
+    def send(self, *commands):
+        futures = self.server.submit(list(commands))
+        for future in futures:
+            self.assertTrue(future.result(5))
+        return futures
+
+    def test_skips_switches_already_in_the_state(self):
+        self.send(('kitchen', 'on'))
+        self.assertEqual(self.send(('kitchen', 'on'), ('hallway', 'on'))[0],
+                         ALREADY_SENT)
+        self.assertEqual(self.server.states.get('kitchen')['state'], 'on')
+        self.assertNotEqual(
+            self.server.submit([('kitchen', 'on')], force=True)[0],
+            ALREADY_SENT)
+
+    def test_records_states_before_commands_complete(self):
+        for op in ('on', 'off', 'on'):
+            self.send(('kitchen', op))
+            self.assertEqual(self.server.states.get('kitchen')['state'], op)
+
+    def test_sends_states_again_while_others_are_pending(self):
+        self.send(('kitchen', 'on'))
+        # Holds the device, so that the commands submitted next wait.
+        self.adapter.gate.clear()
+        self.adapter.writing.clear()
+        held = self.server.submit([('hallway', 'on')])
+        self.assertTrue(self.adapter.writing.wait(5))
+        pending = self.server.submit([('kitchen', 'off')])
+        again = self.server.submit([('kitchen', 'on')])
+        self.assertNotEqual(again[0], ALREADY_SENT)
+        self.adapter.gate.set()
+        for future in held + pending + again:
+            self.assertTrue(future.result(5))
+        self.assertEqual(self.server.states.get('kitchen')['state'], 'on')
+        self.assertEqual(self.server._sending, {})
+
+    def test_rejects_unknown_switches(self):
+        self.assertRaises(UnknownSwitchError, self.server.submit,
+                          [('kitchen', 'on'), ('attic', 'on')])
+        self.assertEqual(self.server._sending, {})
+        self.assertEqual(self.server.pool.status()['default']['pending'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from lights_433.state import SwitchStates
+
+
+class SwitchStatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.state_dir, 'states.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def test_persists_and_restores(self):
+        states = SwitchStates(self.path, ttl=60)
+        states.record('kitchen', 'on')
+        states.flush()
+        restored = SwitchStates(self.path, ttl=60)
+        self.assertEqual(restored.get('kitchen')['state'], 'on')
+        self.assertTrue(restored.current('kitchen', 'on'))
+        self.assertFalse(restored.current('kitchen', 'off'))
+
+    def test_ignores_unexpected_shapes(self):
+        for persisted in ('not json', '[1, 2]', '{"kitchen": 1}',
+                          '{"kitchen": {"state": "on"}}',
+                          '{"kitchen": {"state": "on", "time": "x"}}',
+                          '{"kitchen": {"state": "dim", "time": 1}}'):
+            with open(self.path, 'w') as f:
+                f.write(persisted)
+            states = SwitchStates(self.path, ttl=60)
+            self.assertEqual(states.get('kitchen'),
+                             dict(state=None, time=None))
+            self.assertFalse(states.current('kitchen', 'on'))
+
+    def test_missing_file(self):
+        states = SwitchStates(self.path)
+        self.assertEqual(states.get('kitchen'), dict(state=None, time=None))
+        states.record('kitchen', 'off')
+        states.flush()
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['kitchen']['state'], 'off')
+
+    def test_persists_in_the_background(self):
+        states = SwitchStates(self.path, persist_delay=0.2)
+        for switch_id in ('kitchen', 'hallway', 'porch'):
+            states.record(switch_id, 'on')
+        self.assertFalse(os.path.exists(self.path))
+        time.sleep(0.4)
+        with open(self.path) as f:
+            self.assertEqual(len(json.load(f)), 3)
+        # Forgetting switches is persisted too.
+        states.retain(['kitchen'])
+        time.sleep(0.4)
+        with open(self.path) as f:
+            self.assertEqual(list(json.load(f)), ['kitchen'])
+
+
+if __name__ == '__main__':
+    unittest.main()
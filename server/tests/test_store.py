@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lights_433.driver import Signal
+from lights_433.store import BadSignalStoreError, SignalStore
+
+
+def signal(message):
+    return Signal(1, 350, message)
+
+
+class SignalStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.store_dir, 'signals')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.store_dir)
+
+    def open(self, **kwargs):
+        store = SignalStore(self.path, block_size=4, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def fill(self, store, count, start=0):
+        # Alternating codes, one a second.
+        for i in range(start, start + count):
+            store.append(signal('aa' if i % 2 else 'bb'), when=1000 + i)
+
+    def test_counts_over_indexed_and_searched_records(self):
+        store = self.open()
+        self.fill(store, 11)
+        self.assertEqual(len(store), 11)
+        self.assertEqual(store.counts(), {'aa': 5, 'bb': 6})
+        # Starting and ending part way through blocks.
+        self.assertEqual(store.counts(1001, 1010), {'aa': 5, 'bb': 4})
+        self.assertEqual(store.count('aa', 1003, 1009), 3)
+        self.assertEqual(store.count('cc'), 0)
+
+    def test_finds_signals(self):
+        store = self.open()
+        self.fill(store, 6)
+        found = store.find('aa', start=1002)
+        self.assertEqual([f.time for f in found], [1003, 1005])
+        self.assertEqual(found[0].signal, signal('aa'))
+        self.assertEqual(len(store.find(limit=2)), 2)
+
+    def test_keeps_records_in_order_when_the_clock_steps_back(self):
+        store = self.open()
+        store.append(signal('aa'), when=1000)
+        store.append(signal('bb'), when=900)
+        self.assertEqual([f.time for f in store.find()], [1000, 1000])
+
+    def test_does_not_store_long_messages(self):
+        store = self.open()
+        self.assertFalse(store.append(signal('ab' * 21)))
+        self.assertEqual(len(store), 0)
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a signal store, but long enough to be one')
+        self.assertRaises(BadSignalStoreError, SignalStore, self.path)
+
+    def test_drops_partial_records(self):
+        store = self.open()
+        self.fill(store, 5)
+        store.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'\x00' * 7)
+        store = self.open()
+        self.fill(store, 3, start=5)
+        self.assertEqual(store.counts(), {'aa': 4, 'bb': 4})
+
+    def test_rebuilds_a_deleted_index(self):
+        store = self.open()
+        self.fill(store, 9)
+        store.close()
+        os.remove(self.path + '.idx')
+        self.open()
+        self.assertEqual(self.open(readonly=True).counts(),
+                         {'aa': 4, 'bb': 5})
+
+    def test_drops_partial_index_entries(self):
+        store = self.open()
+        self.fill(store, 4)
+        store.close()
+        # A crash part way through writing the entry of block 1, of 2 codes.
+        with open(self.path + '.idx', 'ab') as f:
+            f.write(b'\x01\x00\x00\x00\x02\x00\x01\xaa')
+        store = self.open()
+        self.fill(store, 8, start=4)
+        reader = self.open(readonly=True)
+        self.assertEqual(reader.counts(), {'aa': 6, 'bb': 6})
+        self.assertEqual(reader.count('aa', 1004, 1012), 4)
+        self.assertEqual(len(reader._summaries), 3)
+
+    def test_rebuilds_an_index_that_is_not_one(self):
+        with open(self.path + '.idx', 'wb') as f:
+            f.write(b'garbage')
+        store = self.open()
+        self.fill(store, 8)
+        reader = self.open(readonly=True)
+        self.assertEqual(reader.counts(), {'aa': 4, 'bb': 4})
+        self.assertEqual(len(reader._summaries), 2)
+
+    def test_readers_pick_up_appended_signals(self):
+        store = self.open()
+        reader = self.open(readonly=True)
+        self.fill(store, 6)
+        self.assertEqual(len(reader), 6)
+        self.assertEqual(reader.count('bb'), 3)
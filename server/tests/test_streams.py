@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import base64
+import errno
+import json
+import resource
+import socket
+from threading import Event
+import time
+import unittest
+
+from lights_433.auth import Lights433Auth
+from lights_433.driver import Signal
+from lights_433.sniffer import SignalRing
+from lights_433.streams import StreamServer
+
+
+def basic(user, password):
+    return 'Basic ' + base64.b64encode(
+        ('%s:%s' % (user, password)).encode('utf-8')).decode('ascii')
+
+
+class GatedAuth(Lights433Auth):
+
+    def __init__(self):
+        super(GatedAuth, self).__init__(b'secret')
+        self.set_users(dict(alice='pw', slow='pw'))
+        self.gate = Event()
+
+    def check(self, authorization):
+        # Verifying the slow user's credentials takes until the gate opens.
+        if authorization == basic('slow', 'pw'):
+            self.gate.wait(5)
+        return super(GatedAuth, self).check(authorization)
+
+
+class ExhaustedListener(object):
+    """
+    Fails to accept connections as if out of file descriptors, until
+    replenished.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.exhausted = True
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def accept(self):
+        if self.exhausted:
+            raise socket.error(errno.EMFILE, "Too many open files")
+        return self.sock.accept()
+
+
+class FakeServer(object):
+
+    def __init__(self):
+        self.host = '127.0.0.1'
+        self.signals = SignalRing()
+        self.auth = GatedAuth()
+
+
+class StreamServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.streams = StreamServer(self.server, 0, keepalive=60)
+        self.port = self.streams._listener.getsockname()[1]
+        self.clients = []
+
+    def tearDown(self):
+        self.server.auth.gate.set()
+        for client in self.clients:
+            client.close()
+
+    def request(self, target, user='alice', password='pw', method='GET'):
+        client = socket.create_connection(('127.0.0.1', self.port), 5)
+        self.clients.append(client)
+        client.sendall(('%s %s HTTP/1.1\r\nHost: localhost\r\n'
+                        'Authorization: %s\r\n\r\n'
+                        % (method, target, basic(user, password)))
+                       .encode('ascii'))
+        return client
+
+    def response(self, client):
+        """
+        :returns: (status, JSON body) of a response, read until the server
+                  closes the connection
+        """
+        data = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        head, _, body = data.partition(b'\r\n\r\n')
+        return int(head.split()[1]), json.loads(body.decode('utf-8'))
+
+    def read_until(self, client, marker):
+        data = b''
+        while marker not in data:
+            chunk = client.recv(4096)
+            if not chunk:
+                self.fail("disconnected before %r" % marker)
+            data += chunk
+        return data
+
+    def receive(self, message):
+        self.server.signals.append(Signal(1, 350, message))
+
+    def test_long_polls_are_answered_by_signals(self):
+        client = self.request('/signals?since=0&wait=5')
+        time.sleep(0.1)
+        start = time.time()
+        self.receive('abcd')
+        status, body = self.response(client)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(status, 200)
+        self.assertEqual(body['sequence'], 1)
+        self.assertEqual([s['message'] for s in body['signals']], ['abcd'])
+
+    def test_long_polls_expire(self):
+        start = time.time()
+        status, body = self.response(self.request('/signals?wait=0.2'))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual((status, body['signals']), (200, []))
+
+    def test_buffered_signals_are_answered_at_once(self):
+        self.receive('abcd')
+        self.receive('ef01')
+        status, body = self.response(self.request('/signals?since=1&wait=5'))
+        self.assertEqual([s['message'] for s in body['signals']], ['ef01'])
+
+    def test_polls_ahead_wait_for_newer_signals(self):
+        client = self.request('/signals?since=2&wait=5')
+        time.sleep(0.1)
+        self.receive('abcd')
+        self.receive('ef01')
+        time.sleep(0.1)
+        self.receive('2345')
+        status, body = self.response(client)
+        self.assertEqual(body['sequence'], 3)
+        self.assertEqual([s['message'] for s in body['signals']], ['2345'])
+
+    def test_streams_signals(self):
+        client = self.request('/signals/stream')
+        self.assertIn(b'text/event-stream',
+                      self.read_until(client, b'\r\n\r\n'))
+        self.receive('abcd')
+        event = self.read_until(client, b'\n\n')
+        self.assertTrue(event.startswith(b'id: 1\ndata: '))
+        self.assertEqual(json.loads(event[len(b'id: 1\ndata: '):]
+                                    .decode('utf-8'))['message'], 'abcd')
+
+    def test_rejects_bad_requests(self):
+        for request, status in (
+                (self.request('/signals', password='wrong'), 401),
+                (self.request('/signals', user='mallory'), 401),
+                (self.request('/status'), 404),
+                (self.request('/signals', method='POST'), 405),
+                (self.request('/signals?since=latest'), 400)):
+            self.assertEqual(self.response(request)[0], status)
+
+    def test_survives_clients_disconnecting_mid_poll(self):
+        for _ in range(3):
+            self.request('/signals?wait=0.2')
+        time.sleep(0.1)
+        for client in self.clients:
+            client.close()
+        # Past the deadlines of the long polls of the clients gone.
+        time.sleep(0.3)
+        self.receive('abcd')
+        status, body = self.response(self.request('/signals?since=0'))
+        self.assertEqual([s['message'] for s in body['signals']], ['abcd'])
+
+    def test_survives_clients_disconnecting_while_authenticating(self):
+        self.request('/signals?wait=0.2', user='slow').close()
+        time.sleep(0.1)
+        self.server.auth.gate.set()
+        time.sleep(0.1)
+        self.assertEqual(self.response(self.request('/signals'))[0], 200)
+
+    def test_verifies_credentials_off_the_loop(self):
+        client = self.request('/signals/stream')
+        self.read_until(client, b'\r\n\r\n')
+        slow = self.request('/signals?wait=5', user='slow')
+        time.sleep(0.1)
+        # Streams are served while the slow user's credentials are
+        # verified.
+        start = time.time()
+        self.receive('abcd')
+        self.read_until(client, b'\n\n')
+        self.assertLess(time.time() - start, 1)
+        self.server.auth.gate.set()
+        status, body = self.response(slow)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body['signals']), 1)
+
+    def test_survives_running_out_of_file_descriptors(self):
+        listener = ExhaustedListener(self.streams._listener)
+        self.streams._listener = listener
+        client = self.request('/signals')
+        time.sleep(0.2)
+        self.assertIsNotNone(self.streams._accept_resume)
+        listener.exhausted = False
+        # Accepted once the backoff is over.
+        client.settimeout(5)
+        self.assertEqual(self.response(client)[0], 200)
+        self.assertEqual(self.response(self.request('/signals'))[0], 200)
+
+    def test_caps_connections_at_the_file_descriptor_limit(self):
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        streams = StreamServer(self.server, 0, max_connections=10 ** 9)
+        if soft_limit != resource.RLIM_INFINITY:
+            self.assertLess(streams.max_connections, soft_limit)
+
+
+if __name__ == '__main__':
+    unittest.main()
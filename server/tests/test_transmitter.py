@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from threading import Event, Thread
+import time
+import unittest
+
+from lights_433.driver import compile_frame
+from lights_433.transmitter import BULK, Transmitter
+
+
+class FakeDriver(object):
+    """
+    Records each session's frames, holding sessions back while the gate is
+    closed.
+    """
+
+    name = 'fake'
+
+    def __init__(self):
+        self.sessions = []
+        self.gate = Event()
+        self.gate.set()
+        self.sending = Event()
+
+    def send_frames(self, frames):
+        self.sending.set()
+        self.gate.wait(5)
+        self.sessions.append(list(frames))
+
+    def send_frame(self, frame):
+        self.send_frames([frame])
+
+
+class WedgingDriver(FakeDriver):
+    """
+    Receives until stopped, and then hangs while being stopped until
+    unwedged.
+    """
+
+    def __init__(self):
+        super(WedgingDriver, self).__init__()
+        self.listening = Event()
+        self.stopped = Event()
+        self.unwedged = Event()
+
+    def read_signals(self, message_num, radio_timeout):
+        self.listening.set()
+
+        def captures():
+            self.stopped.wait(5)
+            return
+            yield
+        return captures()
+
+    def stop_reading(self):
+        self.unwedged.wait(5)
+        self.stopped.set()
+
+
+class DeafDriver(FakeDriver):
+    """
+    Fails to start receiving, and optionally to be reset.
+    """
+
+    def __init__(self, resets):
+        super(DeafDriver, self).__init__()
+        self.resets = resets
+        self.reconnected = Event()
+
+    def read_signals(self, message_num, radio_timeout):
+        raise IOError("no response")
+
+    def reconnect(self):
+        self.reconnected.set()
+        if not self.resets:
+            raise IOError("still no response")
+
+
+def frame(message, repetitions=5):
+    return compile_frame(message, 189, repetitions)
+
+
+class TransmitterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = FakeDriver()
+
+    def hold(self, transmitter):
+        """
+        Occupies the device, so that what is submitted next waits.
+        """
+        self.driver.gate.clear()
+        transmitter.submit('held', frame('ffffff'))
+        self.assertTrue(self.driver.sending.wait(5))
+
+    def release(self, futures):
+        self.driver.gate.set()
+        for future in futures:
+            self.assertTrue(future.result(5))
+
+    def test_coalesces_waiting_commands(self):
+        transmitter = Transmitter(self.driver)
+        self.hold(transmitter)
+        futures = [transmitter.submit('a', frame('aaaa01')),
+                   transmitter.submit('a', frame('aaaa02')),
+                   transmitter.submit('b', frame('bbbb01'))]
+        self.release(futures)
+        self.assertEqual(self.driver.sessions[1:],
+                         [[frame('aaaa02'), frame('bbbb01')]])
+
+    def test_sends_interactive_before_bulk_and_alternates_owners(self):
+        transmitter = Transmitter(self.driver, max_batch=1)
+        self.hold(transmitter)
+        futures = transmitter.submit_many(
+            [('a1', frame('aaaa01')), ('a2', frame('aaaa02'))],
+            BULK, 'alice')
+        futures += transmitter.submit_many(
+            [('b1', frame('bbbb01')), ('b2', frame('bbbb02'))],
+            BULK, 'bob')
+        futures += transmitter.submit_many([('c1', frame('cccc01'))],
+                                           owner='carol')
+        self.release(futures)
+        self.assertEqual(self.driver.sessions[1:], [
+            [frame('cccc01')], [frame('aaaa01')], [frame('bbbb01')],
+            [frame('aaaa02')], [frame('bbbb02')]])
+
+    def test_limits_session_airtime(self):
+        transmitter = Transmitter(self.driver, max_batch_airtime=0.05)
+        self.hold(transmitter)
+        # About 0.02s of airtime each.
+        futures = transmitter.submit_many(
+            [('s%d' % i, frame('abcd%02d' % i, 1)) for i in range(5)])
+        self.release(futures)
+        self.assertEqual([len(session)
+                          for session in self.driver.sessions[1:]],
+                         [2, 2, 1])
+
+    def test_wedged_device_does_not_block_submitters(self):
+        driver = WedgingDriver()
+        transmitter = Transmitter(driver)
+        transmitter.listen(lambda signal: None)
+        self.assertTrue(driver.listening.wait(5))
+        # Stopping the capture hangs, but only for the first submitter.
+        stopping = Thread(target=transmitter.submit,
+                          args=('a', frame('aaaa01')))
+        stopping.daemon = True
+        stopping.start()
+        time.sleep(0.1)
+        start = time.time()
+        future = transmitter.submit('b', frame('bbbb01'))
+        self.assertEqual(transmitter.status()['pending'], 2)
+        self.assertLess(time.time() - start, 0.5)
+        driver.unwedged.set()
+        self.assertTrue(future.result(5))
+        self.assertEqual(driver.sessions,
+                         [[frame('aaaa01'), frame('bbbb01')]])
+
+    def test_failing_to_start_receiving_resets_the_device(self):
+        driver = DeafDriver(resets=True)
+        transmitter = Transmitter(driver)
+        transmitter.listen(lambda signal: None)
+        self.assertTrue(driver.reconnected.wait(5))
+        time.sleep(0.1)
+        status = transmitter.status()
+        self.assertIn('no response', status['error'])
+        self.assertNotEqual(status['state'], 'down')
+
+    def test_failing_to_reset_a_deaf_device_marks_it_down(self):
+        driver = DeafDriver(resets=False)
+        transmitter = Transmitter(driver)
+        transmitter.listen(lambda signal: None)
+        self.assertTrue(driver.reconnected.wait(5))
+        time.sleep(0.1)
+        self.assertEqual(transmitter.status()['state'], 'down')
+        self.assertGreater(transmitter.retry_after(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()